@@ -0,0 +1,119 @@
+"""
+Backup online dos arquivos SQLite da Fazenda TON.
+
+- copiar(): sqlite3.Connection.backup em passos de poucas páginas, com pausa
+  entre eles. Cada passo só segura uma transação de leitura curta na origem
+  (no WAL, leitores não bloqueiam escritores); se outra conexão escreve no
+  meio, o SQLite recomeça a cópia no passo seguinte. Depois de
+  max_reinicios recomeços a cópia é feita num passo só, para terminar
+  mesmo com escrita constante.
+- verificar_e_comprimir(): PRAGMA integrity_check no snapshot e gzip.
+  Roda fora do processo do bot (`python -m fazenda_ton_bot.backup
+  verificar ...`), para não disputar a CPU/GIL com o event loop.
+- rotacionar(): mantém só os N snapshots mais recentes de cada arquivo.
+
+Restaurar: pare o bot e `gunzip -c db-AAAAMMDD-HHMMSS.sqlite3.gz > db.sqlite3`
+(apague db.sqlite3-wal e -shm antigos).
+"""
+import glob
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import time
+
+
+class _MuitosReinicios(Exception):
+    pass
+
+
+def copiar(origem: sqlite3.Connection, destino: str, paginas: int = 256, pausa: float = 0.02,
+           max_reinicios: int = 5, observar=None) -> dict:
+    """
+    Copia `origem` para o arquivo `destino` (sobrescreve) e retorna as medidas
+    da cópia. `observar(segundos)` é chamado com a duração de cada passo.
+    """
+    st = {"passos": 0, "reinicios": 0, "max_passo_s": 0.0, "passos_s": 0.0, "paginas": 0, "um_passo": False}
+    marca = {"t": time.perf_counter(), "restantes": None}
+
+    def progresso(status, restantes, total):
+        dt = time.perf_counter() - marca["t"]
+        st["passos"] += 1
+        st["passos_s"] += dt
+        st["max_passo_s"] = max(st["max_passo_s"], dt)
+        st["paginas"] = total
+        if observar:
+            observar(dt)
+        # sem recomeço, restantes só diminui; recomeçando a cada passo, fica igual
+        if marca["restantes"] is not None and restantes >= marca["restantes"]:
+            st["reinicios"] += 1
+            if st["reinicios"] > max_reinicios:
+                raise _MuitosReinicios()
+        marca["restantes"] = restantes
+        if restantes and pausa > 0:
+            time.sleep(pausa)
+        marca["t"] = time.perf_counter()
+
+    t0 = time.perf_counter()
+    dst = sqlite3.connect(destino)
+    try:
+        try:
+            origem.backup(dst, pages=paginas, progress=progresso)
+        except _MuitosReinicios:
+            st["um_passo"] = True
+            marca["t"] = time.perf_counter()
+            origem.backup(dst, pages=-1, progress=progresso)
+        # o snapshot sai como arquivo único, sem -wal ao lado
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+    st["segundos"] = time.perf_counter() - t0
+    return st
+
+
+def verificar_e_comprimir(snapshot: str, destino: str) -> dict:
+    """integrity_check no snapshot; se ok, grava `destino` (.gz) e apaga o snapshot."""
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(f"file:{snapshot}?mode=ro", uri=True)
+    try:
+        erros = [r[0] for r in conn.execute("PRAGMA integrity_check")]
+    finally:
+        conn.close()
+    t_check = time.perf_counter() - t0
+    ok = erros == ["ok"]
+    out = {"ok": ok, "integridade": erros[:10], "check_s": t_check, "bytes": os.path.getsize(snapshot)}
+    if not ok:
+        return out
+
+    t0 = time.perf_counter()
+    tmp = destino + ".tmp"
+    with open(snapshot, "rb") as src, gzip.open(tmp, "wb", compresslevel=6) as gz:
+        shutil.copyfileobj(src, gz, 1024 * 1024)
+    os.replace(tmp, destino)
+    os.remove(snapshot)
+    out.update(gzip_s=time.perf_counter() - t0, gz_bytes=os.path.getsize(destino))
+    return out
+
+
+def rotacionar(pasta: str, prefixo: str, manter: int) -> list[str]:
+    """Apaga os snapshots `<prefixo>-*.gz` mais antigos, mantendo `manter`."""
+    arquivos = sorted(glob.glob(os.path.join(pasta, f"{glob.escape(prefixo)}-*.gz")))
+    velhos = arquivos[:-manter] if manter > 0 else []
+    for p in velhos:
+        os.remove(p)
+    return velhos
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 3 or argv[0] != "verificar":
+        print("uso: python -m fazenda_ton_bot.backup verificar <snapshot> <destino.gz>", file=sys.stderr)
+        return 2
+    print(json.dumps(verificar_e_comprimir(argv[1], argv[2])))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
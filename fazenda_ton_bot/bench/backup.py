@@ -0,0 +1,105 @@
+"""
+Mede o backup online: duração, passos, recomeços e o impacto nos escritores.
+
+Semeia um banco temporário com --users usuários e mantém uma thread
+escrevendo (um UPDATE de saldo por transação, --write-rate por segundo)
+enquanto roda, em sequência:
+
+- repouso: nenhum backup (latência de base dos escritores);
+- passos: backup do bot (BACKUP_PAGES páginas por passo + pausa), com a
+  verificação/gzip no subprocesso;
+- um passo: a mesma cópia com pages=-1 (uma única transação de leitura).
+
+Uso:
+    python -m fazenda_ton_bot.bench.backup --users 200000 --write-rate 200
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import threading
+import time
+
+from fazenda_ton_bot.bench.load_dispatcher import _import_bot, _pct, _prepare_env, seed_users
+
+
+class Writer(threading.Thread):
+    def __init__(self, m, uids: range, rate: float):
+        super().__init__(daemon=True)
+        self.m = m
+        self.uids = uids
+        self.intervalo = 1.0 / rate
+        self.amostras = []   # (instante, latência)
+        self.parar = threading.Event()
+
+    def run(self):
+        conn = self.m.db_conn()
+        while not self.parar.is_set():
+            t0 = time.perf_counter()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("UPDATE usuarios SET saldo_cash = saldo_cash + 1 WHERE telegram_id=?",
+                             (random.choice(self.uids),))
+            dt = time.perf_counter() - t0
+            self.amostras.append((t0, dt))
+            time.sleep(max(0.0, self.intervalo - dt))
+
+    def janela(self, de: float, ate: float) -> list[float]:
+        return [dt for t, dt in self.amostras if de <= t < ate]
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=200_000)
+    ap.add_argument("--write-rate", type=float, default=200.0, help="transações de escrita por segundo")
+    ap.add_argument("--idle", type=float, default=3.0, help="segundos medindo sem backup")
+    args = ap.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory(prefix="fazenda-backup-")
+    db_path = os.path.join(tmp.name, "db.sqlite3")
+    os.environ["BACKUP_DIR"] = os.path.join(tmp.name, "backups")
+    _prepare_env(db_path)
+    m = _import_bot()
+    seed_users(db_path, 1, args.users)
+    os.makedirs(m.BACKUP_DIR, exist_ok=True)
+
+    w = Writer(m, range(1, args.users + 1), args.write_rate)
+    w.start()
+    janelas = {}
+
+    t0 = time.perf_counter()
+    time.sleep(args.idle)
+    janelas["repouso"] = (t0, time.perf_counter(), None)
+
+    t0 = time.perf_counter()
+    r = asyncio.run(m.backup_arquivo(db_path, "passos"))
+    janelas["passos"] = (t0, time.perf_counter(), r)
+
+    t0 = time.perf_counter()
+    snapshot = os.path.join(m.BACKUP_DIR, "um-passo.partial")
+    with m.db_conn() as src:
+        r = m.copiar_sqlite(src, snapshot, paginas=-1)
+    janelas["um passo"] = (t0, time.perf_counter(), r)
+
+    w.parar.set()
+    w.join()
+
+    ms = lambda s: f"{s * 1000:7.2f}"
+    print(f"banco: {os.path.getsize(db_path) // 1024} KiB, {args.users} usuários, escritor a {args.write_rate:.0f}/s\n")
+    print(f"{'cenário':<10} {'cópia s':>8} {'passos':>7} {'maior ms':>9} {'recomeços':>9} "
+          f"{'escritas':>8} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for nome, (de, ate, r) in janelas.items():
+        lat = w.janela(de, ate)
+        copia = (f"{r['segundos']:>8.2f} {r['passos']:>7} {r['max_passo_s'] * 1000:>9.1f} "
+                 f"{r['reinicios']:>5}{'*' if r['um_passo'] else ' ':<4}") if r else f"{'-':>8} {'-':>7} {'-':>9} {'-':>9}"
+        print(f"{nome:<10} {copia} {len(lat):>8} {ms(_pct(lat, 50))} {ms(_pct(lat, 99))} {ms(max(lat, default=0))}")
+    r = janelas["passos"][2]
+    print("\n* recomeços além de BACKUP_MAX_RESTARTS: terminou num passo só")
+    print(f"verificação (subprocesso): integrity_check {r['check_s']:.2f}s, gzip {r.get('gzip_s', 0):.2f}s, "
+          f"{r['bytes'] // 1024} → {r.get('gz_bytes', 0) // 1024} KiB")
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
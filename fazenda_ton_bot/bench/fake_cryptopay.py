@@ -0,0 +1,366 @@
+"""
+Servidor local que imita a API do Crypto Pay para testes de carga offline.
+
+Implementa getMe, getBalance, createInvoice, getInvoices, createCheck,
+getChecks, transfer, getTransfers, createPayout e getPayouts, com latência configurável
+e injeção de falhas (METHOD_DISABLED, timeouts, respostas 5xx, erros da API).
+Pagamentos de invoice geram um webhook `invoice_paid` assinado no mesmo
+esquema que `verify_cryptopay_signature` confere.
+
+Uso standalone:
+    python -m fazenda_ton_bot.bench.fake_cryptopay --port 8081 --token TESTE \\
+        --webhook-url http://127.0.0.1:8000/webhook/cryptopay --latency-ms 50 --disable createPayout
+
+No bot: CRYPTOPAY_API=http://127.0.0.1:8081/api CRYPTOPAY_TOKEN=TESTE
+
+Rotas de controle:
+    POST /_fake/pay      {"invoice_id": 1} ou {"hash": "..."}  → marca paga e envia o webhook
+    POST /_fake/config   {"latency": 0.05, "error_rate": 0.1, "disabled": ["createPayout"], ...}
+    GET  /_fake/stats
+"""
+import argparse
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+
+
+def sign_body(body: bytes, token: str) -> str:
+    # mesmo esquema de verify_cryptopay_signature: HMAC-SHA256 com sha256(token) como chave
+    secret = hashlib.sha256((token or "").encode()).digest()
+    return hmac.new(secret, body, hashlib.sha256).hexdigest()
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class ApiError(Exception):
+    def __init__(self, code: int, name: str):
+        super().__init__(name)
+        self.code = code
+        self.name = name
+
+
+def _ids(value) -> set[int]:
+    if not value:
+        return set()
+    if isinstance(value, (list, tuple)):
+        return {int(x) for x in value}
+    return {int(x) for x in str(value).split(",") if x.strip()}
+
+
+class FakeCryptoPay:
+    CONFIG_KEYS = ("latency", "jitter", "error_rate", "timeout_rate", "http5xx_rate", "timeout_s", "disabled")
+
+    def __init__(self, token: str, webhook_url: str = "", latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, timeout_rate: float = 0.0, http5xx_rate: float = 0.0,
+                 timeout_s: float = 35.0, disabled=(), balances: dict | None = None, seed: int | None = None):
+        self.token = token
+        self.webhook_url = webhook_url
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.http5xx_rate = http5xx_rate
+        self.timeout_s = timeout_s
+        self.disabled = set(disabled)
+        self.balances = dict(balances or {"TON": 1_000_000.0, "USDT": 1_000_000.0})
+        self.rng = random.Random(seed)
+
+        self.invoices = {}
+        self.checks = {}
+        self.transfers = {}
+        self.payouts = {}
+        self.spent = {}          # spend_id -> (kind, id), para idempotência
+        self.calls = Counter()
+        self.injected = Counter()
+        self.webhooks = Counter()
+        self._seq = itertools.count(1)
+        self._updates = itertools.count(1)
+        self._client = None
+
+        self.methods = {
+            "getMe": self.get_me,
+            "getBalance": self.get_balance,
+            "createInvoice": self.create_invoice,
+            "getInvoices": self.get_invoices,
+            "createCheck": self.create_check,
+            "getChecks": self.get_checks,
+            "transfer": self.transfer,
+            "getTransfers": self.get_transfers,
+            "createPayout": self.create_payout,
+            "getPayouts": self.get_payouts,
+        }
+        self.app = self._build_app()
+
+    # ----- métodos da API -----
+    def get_me(self, p):
+        return {"app_id": 1, "name": "fake-cryptopay", "payment_processing_bot_username": "CryptoBot"}
+
+    def get_balance(self, p):
+        return [{"currency_code": k, "available": f"{v:.9f}", "onhold": "0"} for k, v in self.balances.items()]
+
+    def create_invoice(self, p):
+        iid = next(self._seq)
+        h = uuid.uuid4().hex[:12]
+        inv = {
+            "invoice_id": iid,
+            "hash": h,
+            "currency_type": p.get("currency_type", "crypto"),
+            "asset": p.get("asset"),
+            "fiat": p.get("fiat"),
+            "amount": str(p.get("amount")),
+            "accepted_assets": p.get("accepted_assets"),
+            "payload": p.get("payload"),
+            "description": p.get("description"),
+            "status": "active",
+            "bot_invoice_url": f"https://t.me/CryptoBot?start=IV{h}",
+            "pay_url": f"https://t.me/CryptoBot?start=IV{h}",
+            "created_at": _now_iso(),
+        }
+        self.invoices[iid] = inv
+        return inv
+
+    def get_invoices(self, p):
+        ids = _ids(p.get("invoice_ids"))
+        status = p.get("status")
+        items = [self.invoices[i] for i in ids if i in self.invoices] if ids else list(self.invoices.values())
+        if status:
+            items = [i for i in items if i["status"] == status]
+        offset, count = int(p.get("offset") or 0), int(p.get("count") or 100)
+        return {"items": items[offset:offset + count]}
+
+    def _spend(self, asset: str, amount: float):
+        if amount <= 0:
+            raise ApiError(400, "AMOUNT_INVALID")
+        if self.balances.get(asset, 0.0) + 1e-12 < amount:
+            raise ApiError(400, "NOT_ENOUGH_COINS")
+        self.balances[asset] -= amount
+
+    def create_check(self, p):
+        asset, amount = p.get("asset", "TON"), float(p.get("amount") or 0)
+        self._spend(asset, amount)
+        cid = next(self._seq)
+        h = uuid.uuid4().hex[:12]
+        chk = {"check_id": cid, "hash": h, "asset": asset, "amount": f"{amount:.9f}",
+               "bot_check_url": f"https://t.me/CryptoBot?start=CQ{h}", "status": "active",
+               "created_at": _now_iso()}
+        self.checks[cid] = chk
+        return chk
+
+    def get_checks(self, p):
+        ids = _ids(p.get("check_ids"))
+        items = [self.checks[i] for i in ids if i in self.checks] if ids else list(self.checks.values())
+        return {"items": items}
+
+    def _idempotent(self, kind: str, spend_id: str | None, store: dict, make):
+        if spend_id and spend_id in self.spent:
+            k, oid = self.spent[spend_id]
+            if k != kind:
+                raise ApiError(400, "SPEND_ID_ALREADY_USED")
+            return store[oid]
+        obj = make()
+        if spend_id:
+            self.spent[spend_id] = (kind, obj["id"])
+        return obj
+
+    def transfer(self, p):
+        asset, amount = p.get("asset", "TON"), float(p.get("amount") or 0)
+
+        def make():
+            self._spend(asset, amount)
+            tid = next(self._seq)
+            t = {"id": tid, "transfer_id": tid, "user_id": p.get("user_id"), "asset": asset,
+                 "amount": f"{amount:.9f}", "spend_id": p.get("spend_id"), "status": "completed",
+                 "completed_at": _now_iso()}
+            self.transfers[tid] = t
+            return t
+        return self._idempotent("transfer", p.get("spend_id"), self.transfers, make)
+
+    def get_transfers(self, p):
+        ids = _ids(p.get("transfer_ids"))
+        items = [self.transfers[i] for i in ids if i in self.transfers] if ids else list(self.transfers.values())
+        if p.get("spend_id"):
+            items = [t for t in items if t.get("spend_id") == p["spend_id"]]
+        return {"items": items}
+
+    def create_payout(self, p):
+        asset, amount = p.get("asset", "TON"), float(p.get("amount") or 0)
+
+        def make():
+            self._spend(asset, amount)
+            pid = next(self._seq)
+            po = {"id": pid, "payout_id": pid, "address": p.get("address"), "asset": asset,
+                  "amount": f"{amount:.9f}", "spend_id": p.get("spend_id"), "status": "completed",
+                  "completed_at": _now_iso()}
+            self.payouts[pid] = po
+            return po
+        return self._idempotent("payout", p.get("spend_id"), self.payouts, make)
+
+    def get_payouts(self, p):
+        ids = _ids(p.get("payout_ids"))
+        items = [self.payouts[i] for i in ids if i in self.payouts] if ids else list(self.payouts.values())
+        if p.get("spend_id"):
+            items = [po for po in items if po.get("spend_id") == p["spend_id"]]
+        return {"items": items}
+
+    # ----- webhook -----
+    async def pay_invoice(self, invoice_id: int | None = None, hash_: str | None = None) -> int:
+        inv = self.invoices.get(int(invoice_id)) if invoice_id else None
+        if inv is None and hash_:
+            inv = next((i for i in self.invoices.values() if i["hash"] == hash_), None)
+        if inv is None:
+            raise KeyError("invoice não encontrada")
+        if inv["status"] != "paid":
+            inv.update(status="paid", paid_at=_now_iso(), paid_amount=inv["amount"])
+        if not self.webhook_url:
+            return 0
+        body = json.dumps({
+            "update_id": next(self._updates),
+            "update_type": "invoice_paid",
+            "request_date": _now_iso(),
+            "payload": inv,
+        }).encode()
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=30)
+        r = await self._client.post(
+            self.webhook_url, content=body,
+            headers={"content-type": "application/json", "crypto-pay-api-signature": sign_body(body, self.token)},
+        )
+        self.webhooks[r.status_code] += 1
+        return r.status_code
+
+    # ----- HTTP -----
+    def _build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.api_route("/api/{method}", methods=["GET", "POST"])
+        async def api(method: str, request: Request):
+            self.calls[method] += 1
+            if request.headers.get("crypto-pay-api-token") != self.token:
+                return JSONResponse({"ok": False, "error": {"code": 401, "name": "UNAUTHORIZED"}}, status_code=401)
+
+            delay = self.latency + (self.rng.uniform(0, self.jitter) if self.jitter else 0.0)
+            if delay:
+                await asyncio.sleep(delay)
+
+            roll = self.rng.random()
+            if roll < self.timeout_rate:
+                self.injected["timeout"] += 1
+                await asyncio.sleep(self.timeout_s)
+            elif roll < self.timeout_rate + self.http5xx_rate:
+                self.injected["5xx"] += 1
+                return PlainTextResponse("Bad Gateway", status_code=502)
+
+            fn = self.methods.get(method)
+            if fn is None:
+                return JSONResponse({"ok": False, "error": {"code": 405, "name": "METHOD_NOT_FOUND"}}, status_code=405)
+            if method in self.disabled:
+                self.injected["METHOD_DISABLED"] += 1
+                return JSONResponse({"ok": False, "error": {"code": 405, "name": "METHOD_DISABLED"}}, status_code=405)
+            if self.rng.random() < self.error_rate:
+                self.injected["api_error"] += 1
+                return JSONResponse({"ok": False, "error": {"code": 500, "name": "INTERNAL_ERROR"}}, status_code=500)
+
+            if request.method == "POST" and (await request.body()):
+                params = await request.json()
+            else:
+                params = dict(request.query_params)
+            try:
+                return {"ok": True, "result": fn(params)}
+            except ApiError as e:
+                return JSONResponse({"ok": False, "error": {"code": e.code, "name": e.name}}, status_code=e.code)
+
+        @app.post("/_fake/pay")
+        async def fake_pay(request: Request):
+            data = await request.json()
+            try:
+                status = await self.pay_invoice(data.get("invoice_id"), data.get("hash"))
+            except KeyError as e:
+                return JSONResponse({"ok": False, "error": str(e)}, status_code=404)
+            return {"ok": True, "webhook_status": status}
+
+        @app.post("/_fake/config")
+        async def fake_config(request: Request):
+            data = await request.json()
+            for k in self.CONFIG_KEYS:
+                if k in data:
+                    setattr(self, k, set(data[k]) if k == "disabled" else float(data[k]))
+            return {k: (sorted(getattr(self, k)) if k == "disabled" else getattr(self, k)) for k in self.CONFIG_KEYS}
+
+        @app.get("/_fake/stats")
+        async def fake_stats():
+            return {
+                "calls": dict(self.calls),
+                "injected": dict(self.injected),
+                "webhooks": {str(k): v for k, v in self.webhooks.items()},
+                "invoices": len(self.invoices),
+                "paid": sum(1 for i in self.invoices.values() if i["status"] == "paid"),
+                "checks": len(self.checks),
+                "transfers": len(self.transfers),
+                "payouts": len(self.payouts),
+                "balances": self.balances,
+            }
+
+        return app
+
+
+def serve_in_thread(app, port: int, host: str = "127.0.0.1") -> uvicorn.Server:
+    """Sobe um app ASGI com uvicorn numa thread própria (sem lifespan) e espera ficar pronto."""
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning", lifespan="off"))
+    threading.Thread(target=server.run, name=f"uvicorn-{port}", daemon=True).start()
+    deadline = time.time() + 10
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError(f"servidor na porta {port} não subiu")
+        time.sleep(0.01)
+    return server
+
+
+def add_fault_args(ap: argparse.ArgumentParser):
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fração de respostas INTERNAL_ERROR")
+    ap.add_argument("--timeout-rate", type=float, default=0.0, help="fração de requisições que travam por --timeout-s")
+    ap.add_argument("--http5xx-rate", type=float, default=0.0, help="fração de respostas 502")
+    ap.add_argument("--timeout-s", type=float, default=35.0)
+    ap.add_argument("--disable", action="append", default=[], help="método que responde METHOD_DISABLED")
+    ap.add_argument("--seed", type=int, default=None)
+
+
+def fake_from_args(args, token: str, webhook_url: str) -> FakeCryptoPay:
+    return FakeCryptoPay(
+        token, webhook_url,
+        latency=args.latency_ms / 1000.0, jitter=args.jitter_ms / 1000.0,
+        error_rate=args.error_rate, timeout_rate=args.timeout_rate, http5xx_rate=args.http5xx_rate,
+        timeout_s=args.timeout_s, disabled=args.disable, seed=args.seed,
+    )
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--token", default="fake-cryptopay-token")
+    ap.add_argument("--webhook-url", default="")
+    add_fault_args(ap)
+    args = ap.parse_args(argv)
+    fake = fake_from_args(args, args.token, args.webhook_url)
+    uvicorn.run(fake.app, host=args.host, port=args.port, log_level="info")
+
+
+if __name__ == "__main__":
+    main()
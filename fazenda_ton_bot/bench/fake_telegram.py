@@ -0,0 +1,91 @@
+"""
+Sessão falsa do aiogram para benchmarks: em vez de chamar a API do Telegram,
+registra cada método enviado e devolve uma resposta plausível.
+"""
+import asyncio
+import itertools
+from collections import defaultdict
+from datetime import datetime
+
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.types import Update, Message, Chat, User, CallbackQuery
+
+FAKE_TOKEN = "123456:BENCHbenchBENCHbench"
+
+
+class FakeSession(BaseSession):
+    def __init__(self, latency: float = 0.0, keep_last: int = 8):
+        super().__init__()
+        self.latency = latency
+        self.calls = defaultdict(int)                          # nome do método -> quantidade
+        self.sent = defaultdict(list)                         # chat_id -> últimas mensagens
+        self.keep_last = keep_last
+        self._msg_ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        name = type(method).__name__
+        self.calls[name] += 1
+        if getattr(method, "__returning__", None) is Message:
+            chat_id = getattr(method, "chat_id", None) or 0
+            msg = Message(
+                message_id=next(self._msg_ids),
+                date=datetime.now(),
+                chat=Chat(id=chat_id, type="private"),
+                text=getattr(method, "text", None),
+                reply_markup=getattr(method, "reply_markup", None)
+                if hasattr(getattr(method, "reply_markup", None), "inline_keyboard") else None,
+            )
+            sent = self.sent[chat_id]
+            sent.append(msg)
+            if len(sent) > self.keep_last:
+                del sent[0]
+            return msg
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def last_callback(self, chat_id: int, prefix: str) -> str | None:
+        """Procura, da mensagem mais recente para a mais antiga, um botão inline cujo callback_data começa com prefix."""
+        for msg in reversed(self.sent.get(chat_id, [])):
+            kb = msg.reply_markup
+            for row in (kb.inline_keyboard if kb else []):
+                for btn in row:
+                    if btn.callback_data and btn.callback_data.startswith(prefix):
+                        return btn.callback_data
+        return None
+
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+
+def make_bot(latency: float = 0.0) -> Bot:
+    return Bot(FAKE_TOKEN, session=FakeSession(latency=latency))
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, uid: int) -> User:
+        return User(id=uid, is_bot=False, first_name=f"u{uid}")
+
+    def message(self, uid: int, text: str) -> Update:
+        n = next(self._ids)
+        return Update(update_id=n, message=Message(
+            message_id=n, date=datetime.now(), chat=Chat(id=uid, type="private"),
+            from_user=self._user(uid), text=text,
+        ))
+
+    def callback(self, uid: int, data: str) -> Update:
+        n = next(self._ids)
+        return Update(update_id=n, callback_query=CallbackQuery(
+            id=str(n), from_user=self._user(uid), chat_instance=str(uid), data=data,
+            message=Message(message_id=n, date=datetime.now(), chat=Chat(id=uid, type="private"), text="-"),
+        ))
@@ -0,0 +1,237 @@
+"""
+Teste de carga do Dispatcher com usuários simulados.
+
+Monta o `dp` do bot com uma sessão falsa (nada vai para o Telegram) e um
+banco SQLite temporário, e faz milhares de usuários concorrentes percorrerem
+os fluxos reais: /start, 🛒 Comprar → buy:, 🐾 Meus Animais → collect:,
+venda de materiais, swap: e bônus diário.
+
+Uso:
+    python -m fazenda_ton_bot.bench.load_dispatcher --users 2000 --concurrency 500
+    python -m fazenda_ton_bot.bench.load_dispatcher --users 4000 --procs 4   # contenção entre processos
+
+Relata updates/s, latência p50/p95/p99 por update e por etapa, e esperas de
+lock do SQLite (escritas acima de --lock-ms e erros "database is locked").
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import multiprocessing as mp
+
+from fazenda_ton_bot.bench.fake_telegram import FAKE_TOKEN, FakeSession, UpdateFactory
+
+WRITE_OPS = {"INSERT", "UPDATE", "DELETE", "REPLACE"}
+
+
+def _prepare_env(db_path: str):
+    os.environ["DB_PATH"] = db_path
+    os.environ.setdefault("TOKEN", FAKE_TOKEN)
+    os.environ.setdefault("PRICE_CACHE_SECONDS", str(10 ** 9))  # nunca buscar preço na rede
+    os.environ.setdefault("PROFILE_SAMPLE_RATE", "0")
+    os.environ.setdefault("LOOP_BLOCK_THRESHOLD", "0")
+
+
+def _import_bot():
+    from fazenda_ton_bot import bot_main
+    logging.getLogger("aiogram").setLevel(logging.WARNING)  # uma linha INFO por update distorce a medição
+    bot_main.migrate()
+    bot_main._TON_CACHE["ts"] = time.time()
+    return bot_main
+
+
+def seed_users(db_path: str, first_uid: int, n: int):
+    """Cria usuários com saldo, materiais e uma galinha produzindo há um dia."""
+    ontem = (datetime.now() - timedelta(days=1)).isoformat()
+    agora = datetime.now().isoformat()
+    conn = sqlite3.connect(db_path, timeout=30)
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO usuarios (telegram_id, saldo_cash, saldo_cash_pagamentos, saldo_ton, "
+            "saldo_materiais, criado_em) VALUES (?, 1000, 500, 0, 5000, ?)",
+            [(uid, agora) for uid in range(first_uid, first_uid + n)],
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO inventario (telegram_id, animal, quantidade, ultima_coleta) VALUES (?, 'Galinha', 1, ?)",
+            [(uid, ontem) for uid in range(first_uid, first_uid + n)],
+        )
+    conn.close()
+
+
+class Simulator:
+    def __init__(self, m, session: FakeSession, lock_ms: float):
+        self.m = m
+        self.bot = m.Bot(FAKE_TOKEN, session=session)
+        self.session = session
+        self.updates = UpdateFactory()
+        self.latencies = []
+        self.by_step = defaultdict(list)
+        self.lock_waits = []
+        self.lock_errors = 0
+        self._install_lock_probe(lock_ms / 1000.0)
+
+    def _install_lock_probe(self, threshold: float):
+        # db_conn resolve _TimedConnection em tempo de chamada; trocamos por uma
+        # subclasse que mede escritas lentas (espera pelo lock de escrita do SQLite).
+        sim = self
+        base = self.m._TimedConnection
+        label = self.m._sql_label
+
+        class _ProbeConnection(base):
+            def execute(self, sql, parameters=(), /):
+                t0 = time.perf_counter()
+                try:
+                    return super().execute(sql, parameters)
+                except sqlite3.OperationalError as e:
+                    if "locked" in str(e):
+                        sim.lock_errors += 1
+                    raise
+                finally:
+                    dt = time.perf_counter() - t0
+                    if dt >= threshold and label(sql)[0] in WRITE_OPS:
+                        sim.lock_waits.append(dt)
+
+        self.m._TimedConnection = _ProbeConnection
+
+    def disable_rate_limit(self):
+        for observer in (self.m.router.message, self.m.router.callback_query):
+            for mw in observer.middleware:
+                if isinstance(mw, self.m.RateLimitMiddleware):
+                    mw.calls = 10 ** 9
+
+    async def _feed(self, step: str, update):
+        t0 = time.perf_counter()
+        await self.m.get_dispatcher().feed_update(self.bot, update)
+        dt = time.perf_counter() - t0
+        self.latencies.append(dt)
+        self.by_step[step].append(dt)
+
+    async def message(self, step: str, uid: int, text: str):
+        await self._feed(step, self.updates.message(uid, text))
+
+    async def callback(self, step: str, uid: int, data: str | None):
+        if data:
+            await self._feed(step, self.updates.callback(uid, data))
+
+    async def user_flow(self, uid: int):
+        await self.message("start", uid, "/start")
+        await self.message("comprar", uid, "🛒 Comprar")
+        await self.callback("buy", uid, "buy:Galinha")
+        await self.message("meus_animais", uid, "🐾 Meus Animais")
+        await self.callback("collect", uid, self.session.last_callback(uid, "collect:"))
+        await self.message("trocas", uid, "🔄 Trocas")
+        await self.callback("materials", uid, self.session.last_callback(uid, "materials:"))
+        await self.callback("swap_menu", uid, "ton:swap_menu")
+        await self.callback("swap", uid, self.session.last_callback(uid, "swap:20:"))
+        await self.message("bonus", uid, "🎁 Bonus")
+        await self.callback("bonus_claim", uid, self.session.last_callback(uid, "bonus:"))
+
+    async def run(self, uids, concurrency: int):
+        sem = asyncio.Semaphore(concurrency)
+
+        async def one(uid):
+            async with sem:
+                await self.user_flow(uid)
+
+        await asyncio.gather(*(one(uid) for uid in uids))
+
+
+def run_slice(db_path: str, first_uid: int, n: int, concurrency: int, tg_latency: float,
+              lock_ms: float, keep_rate_limit: bool) -> dict:
+    _prepare_env(db_path)
+    m = _import_bot()
+    sim = Simulator(m, FakeSession(latency=tg_latency), lock_ms)
+    if not keep_rate_limit:
+        sim.disable_rate_limit()
+
+    t0 = time.perf_counter()
+    asyncio.run(sim.run(range(first_uid, first_uid + n), concurrency))
+    elapsed = time.perf_counter() - t0
+    return {
+        "elapsed": elapsed,
+        "latencies": sim.latencies,
+        "by_step": dict(sim.by_step),
+        "lock_waits": sim.lock_waits,
+        "lock_errors": sim.lock_errors,
+        "tg_calls": sim.session.total_calls(),
+        "drops": sum(m.RATELIMIT_DROPS._values.values()),
+    }
+
+
+def _pct(xs, p):
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100.0 * (len(xs) - 1))))]
+
+
+def report(results: list[dict], wall: float):
+    lat = [x for r in results for x in r["latencies"]]
+    waits = [x for r in results for x in r["lock_waits"]]
+    steps = defaultdict(list)
+    for r in results:
+        for k, v in r["by_step"].items():
+            steps[k].extend(v)
+
+    ms = lambda s: f"{s * 1000:8.2f}"
+    print(f"updates:       {len(lat)} em {wall:.2f}s  →  {len(lat) / wall:.0f} updates/s")
+    print(f"latência (ms): p50 {ms(_pct(lat, 50))}  p95 {ms(_pct(lat, 95))}  p99 {ms(_pct(lat, 99))}  max {ms(max(lat, default=0))}")
+    print(f"telegram:      {sum(r['tg_calls'] for r in results)} chamadas registradas, {sum(r['drops'] for r in results)} drops do rate limit")
+    print(f"sqlite locks:  {len(waits)} escritas lentas, {sum(waits) * 1000:.0f} ms no total, "
+          f"{sum(r['lock_errors'] for r in results)} erros 'database is locked'")
+    print("\netapa             n     p50 ms   p95 ms   p99 ms")
+    for k, v in steps.items():
+        print(f"{k:<14} {len(v):>6} {ms(_pct(v, 50))} {ms(_pct(v, 95))} {ms(_pct(v, 99))}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--concurrency", type=int, default=500, help="usuários simultâneos por processo")
+    ap.add_argument("--procs", type=int, default=1, help="processos (simula workers do gunicorn)")
+    ap.add_argument("--tg-latency-ms", type=float, default=0.0, help="latência simulada por chamada ao Telegram")
+    ap.add_argument("--lock-ms", type=float, default=5.0, help="escrita acima disso conta como espera de lock")
+    ap.add_argument("--keep-rate-limit", action="store_true", help="não desativa o RateLimitMiddleware")
+    ap.add_argument("--db", default="", help="caminho do SQLite (padrão: arquivo temporário)")
+    args = ap.parse_args(argv)
+
+    tmp = None
+    db_path = args.db
+    if not db_path:
+        tmp = tempfile.TemporaryDirectory(prefix="fazenda-bench-")
+        db_path = os.path.join(tmp.name, "db.sqlite3")
+
+    # cria o schema e semeia os usuários antes de iniciar a carga
+    _prepare_env(db_path)
+    _import_bot()
+    first_uid = 10_000_000
+    seed_users(db_path, first_uid, args.users)
+
+    per = -(-args.users // args.procs)
+    slices = [(first_uid + i * per, min(per, args.users - i * per)) for i in range(args.procs) if args.users - i * per > 0]
+    common = (args.concurrency, args.tg_latency_ms / 1000.0, args.lock_ms, args.keep_rate_limit)
+
+    t0 = time.perf_counter()
+    if args.procs == 1:
+        results = [run_slice(db_path, *slices[0], *common)]
+    else:
+        with ProcessPoolExecutor(args.procs, mp_context=mp.get_context("spawn")) as ex:
+            futs = [ex.submit(run_slice, db_path, a, n, *common) for a, n in slices]
+            results = [f.result() for f in futs]
+    wall = time.perf_counter() - t0
+
+    print(f"db: {db_path}  usuários: {args.users}  processos: {args.procs}  concorrência: {args.concurrency}\n")
+    report(results, wall)
+    if tmp:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""
+Benchmark ponta a ponta dos caminhos de dinheiro contra o Crypto Pay falso.
+
+Depósito: usuário toca "R$ 10" → criar_invoice_cryptopay (createInvoice) →
+o fake marca a invoice como paga e envia o webhook assinado para
+/webhook/cryptopay do bot, que credita o cash.
+
+Saque: usuário toca "Pagamento" e envia o valor → processar_saque
+(createPayout e, se desabilitado, createCheck; o getBalance vem do cache do cofre).
+
+Saque preso: reserva 1 TON (saldo 5 → 4), o createPayout sai mas o
+set_status não roda (processo caiu), created_at recua 30 min e a
+reconciliação roda — com getPayouts ela fecha como 'done'; sem getPayouts
+a linha fica para o admin. Nos dois casos o saldo tem de continuar 4
+(estornar pagaria duas vezes). Roda sem as falhas injetadas; sai com erro
+se algum caso divergir.
+
+Uso:
+    python -m fazenda_ton_bot.bench.money_paths --deposits 500 --payouts 300 --latency-ms 30
+    python -m fazenda_ton_bot.bench.money_paths --payouts 200 --disable createPayout --http5xx-rate 0.05
+"""
+import argparse
+import asyncio
+import os
+import re
+import socket
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+from fazenda_ton_bot.bench.fake_cryptopay import add_fault_args, fake_from_args, serve_in_thread
+from fazenda_ton_bot.bench.fake_telegram import FAKE_TOKEN, FakeSession, UpdateFactory
+from fazenda_ton_bot.bench.load_dispatcher import _import_bot, _pct, _prepare_env
+
+BENCH_CRYPTOPAY_TOKEN = "bench-cryptopay-token"
+WALLET = "UQ" + "A" * 46
+INVOICE_HASH_RE = re.compile(r"start=IV(\w+)")
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class MoneyBench:
+    def __init__(self, m, session: FakeSession, fake_url: str):
+        self.m = m
+        self.bot = m.Bot(FAKE_TOKEN, session=session)
+        self.session = session
+        self.updates = UpdateFactory()
+        self.fake_url = fake_url
+        self.client = httpx.AsyncClient(timeout=60)
+
+    async def deposit(self, uid: int) -> tuple[float, str]:
+        t0 = time.perf_counter()
+        await self.m.get_dispatcher().feed_update(self.bot, self.updates.message(uid, "R$ 10"))
+        last = self.session.sent[uid][-1].text if self.session.sent.get(uid) else ""
+        mt = INVOICE_HASH_RE.search(last or "")
+        if not mt:
+            return time.perf_counter() - t0, "invoice_error"
+        r = await self.client.post(f"{self.fake_url}/_fake/pay", json={"hash": mt.group(1)})
+        status = r.json().get("webhook_status")
+        return time.perf_counter() - t0, "ok" if status == 200 else f"webhook_{status}"
+
+    async def payout(self, uid: int) -> tuple[float, str]:
+        t0 = time.perf_counter()
+        await self.m.get_dispatcher().feed_update(self.bot, self.updates.message(uid, "Pagamento"))
+        await self.m.get_dispatcher().feed_update(self.bot, self.updates.message(uid, "0.1"))
+        last = self.session.sent[uid][-1].text if self.session.sent.get(uid) else ""
+        if last.startswith("✅ Saque enviado"):
+            outcome = "payout"
+        elif last.startswith("✅ Saque criado como *Check"):
+            outcome = "check"
+        elif "estornado" in last or "Não foi possível" in last:
+            outcome = "refunded"
+        else:
+            outcome = "other"
+        return time.perf_counter() - t0, outcome
+
+    async def run(self, fn, uids, concurrency: int):
+        sem = asyncio.Semaphore(concurrency)
+        lat, outcomes = [], Counter()
+
+        async def one(uid):
+            async with sem:
+                dt, outcome = await fn(uid)
+                lat.append(dt)
+                outcomes[outcome] += 1
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(uid) for uid in uids))
+        return time.perf_counter() - t0, lat, outcomes
+
+
+async def saque_preso(m, fake, db_path: str, uid: int, com_payouts: bool) -> tuple[bool, str]:
+    st = m.storage()
+    await st.users.ensure(uid)
+    await st.users.set_balance(uid, "ton", 5.0)
+    idemp = m.new_idempotency_key(uid)
+    wid, motivo = await m.reservar_saque(uid, 1.0, WALLET, idemp)
+    if not wid:
+        return False, f"reserva recusada: {motivo}"
+    await m.cryptopay_transfer_ton_to_address(1.0, WALLET, idemp)   # set_status "perdido"
+    conn = sqlite3.connect(db_path, timeout=30)
+    with conn:
+        conn.execute("UPDATE withdrawals SET created_at=datetime(created_at, '-30 minutes') WHERE id=?", (wid,))
+    fake.disabled = set() if com_payouts else {"getPayouts"}
+    res = await m.reconciliar_saques(uid)
+    status = conn.execute("SELECT status FROM withdrawals WHERE id=?", (wid,)).fetchone()[0]
+    conn.close()
+    m.invalidate_saldos(uid)
+    saldo = (await st.users.balances(uid))["ton"]
+    esperado = "done" if com_payouts else "processing"
+    ok = abs(saldo - 4.0) < 1e-9 and status == esperado and res["estornado"] == 0
+    return ok, f"{res} | status {status} | saldo {saldo:.1f}"
+
+
+def _print(label: str, wall: float, lat, outcomes):
+    ms = lambda s: f"{s * 1000:.1f}"
+    n = len(lat)
+    print(f"{label}: {n} em {wall:.2f}s → {n / wall if wall else 0:.1f}/s | "
+          f"p50 {ms(_pct(lat, 50))} ms  p95 {ms(_pct(lat, 95))} ms  p99 {ms(_pct(lat, 99))} ms | "
+          + ", ".join(f"{k}={v}" for k, v in sorted(outcomes.items())))
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--deposits", type=int, default=300)
+    ap.add_argument("--payouts", type=int, default=200)
+    ap.add_argument("--concurrency", type=int, default=50)
+    ap.add_argument("--client-timeout", type=float, default=2.0, help="CRYPTOPAY_TIMEOUT usado pelo bot")
+    add_fault_args(ap)
+    args = ap.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory(prefix="fazenda-money-")
+    db_path = os.path.join(tmp.name, "db.sqlite3")
+    fake_port, bot_port = _free_port(), _free_port()
+    fake_url = f"http://127.0.0.1:{fake_port}"
+
+    fake = fake_from_args(args, BENCH_CRYPTOPAY_TOKEN, f"http://127.0.0.1:{bot_port}/webhook/cryptopay")
+    serve_in_thread(fake.app, fake_port)
+
+    _prepare_env(db_path)
+    os.environ["CRYPTOPAY_API"] = f"{fake_url}/api"
+    os.environ["CRYPTOPAY_TOKEN"] = BENCH_CRYPTOPAY_TOKEN
+    os.environ["CRYPTOPAY_TIMEOUT"] = str(args.client_timeout)
+    m = _import_bot()
+    m.get_bot().session = FakeSession()  # notificações do webhook não saem para o Telegram
+    serve_in_thread(m.get_app(), bot_port)
+    m.refresh_app_balances()  # o loop de refresh do cofre só roda no on_startup
+
+    dep_uids = range(20_000_000, 20_000_000 + args.deposits)
+    pay_uids = range(30_000_000, 30_000_000 + args.payouts)
+    conn = sqlite3.connect(db_path, timeout=30)
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO usuarios (telegram_id, saldo_ton, carteira_ton, criado_em) VALUES (?, 1.0, ?, datetime('now'))",
+            [(uid, WALLET) for uid in pay_uids],
+        )
+    conn.close()
+
+    bench = MoneyBench(m, FakeSession(), fake_url)
+    for mw in list(m.router.message.middleware):
+        if isinstance(mw, m.RateLimitMiddleware):
+            mw.calls = 10 ** 9
+
+    async def go():
+        res = {}
+        if args.deposits:
+            res["depósitos"] = await bench.run(bench.deposit, dep_uids, args.concurrency)
+        if args.payouts:
+            res["saques"] = await bench.run(bench.payout, pay_uids, args.concurrency)
+        await bench.client.aclose()
+        # cenário determinístico: sem as falhas injetadas na carga
+        faults = {k: getattr(fake, k) for k in fake.CONFIG_KEYS}
+        fake.latency = fake.jitter = fake.error_rate = fake.timeout_rate = fake.http5xx_rate = 0.0
+        presos = {
+            "com getPayouts": await saque_preso(m, fake, db_path, 40_000_001, True),
+            "sem getPayouts": await saque_preso(m, fake, db_path, 40_000_002, False),
+        }
+        for k, v in faults.items():
+            setattr(fake, k, v)
+        return res, presos
+
+    results, presos = asyncio.run(go())
+
+    print(f"fake: latência {args.latency_ms} ms, erros {args.error_rate}, timeouts {args.timeout_rate}, "
+          f"5xx {args.http5xx_rate}, desabilitados {args.disable or '-'}\n")
+    for label, (wall, lat, outcomes) in results.items():
+        _print(label, wall, lat, outcomes)
+
+    conn = sqlite3.connect(db_path)
+    credited = conn.execute("SELECT COUNT(*), COALESCE(SUM(cash),0) FROM pagamentos").fetchone()
+    statuses = dict(conn.execute("SELECT status, COUNT(*) FROM withdrawals GROUP BY status").fetchall())
+    conn.close()
+    print(f"\npagamentos creditados: {credited[0]} ({credited[1]} cash) | withdrawals: {statuses}")
+    print(f"chamadas ao fake: {dict(fake.calls)} | falhas injetadas: {dict(fake.injected)}")
+    print()
+    for label, (ok, txt) in presos.items():
+        print(f"saque preso, {label}: {'ok' if ok else 'FALHOU'} — {txt}")
+    tmp.cleanup()
+    if not all(ok for ok, _ in presos.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Micro-benchmark do custo de roteamento por update (só escolher o handler).
+
+Todos os handlers são trocados por no-ops e os middlewares do bot ficam de
+fora, então o tempo medido em feed_update é o do Dispatcher + avaliação de
+filtros. Compara:
+
+- tabela: o router do bot como está (menu_dispatch com dict lookup primeiro);
+- cadeia: os mesmos textos de menu como `F.text == ...` (+ StateFilter), um
+  handler por texto, na frente dos demais handlers — como era antes. Colocar
+  todos os menus no início favorece a cadeia (na versão antiga alguns vinham
+  depois de lambdas e handlers de estado).
+
+Uso:
+    python -m fazenda_ton_bot.bench.routing --iterations 2000
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+from aiogram import Bot, Dispatcher, F, Router
+from aiogram.dispatcher.event.handler import FilterObject, HandlerObject
+from aiogram.filters import StateFilter
+
+from fazenda_ton_bot.bench.fake_telegram import FAKE_TOKEN, FakeSession, UpdateFactory
+from fazenda_ton_bot.bench.load_dispatcher import _import_bot, _prepare_env
+
+SAMPLES = [
+    "💰 Meu Saldo",        # primeiro menu registrado
+    "❓ Ajuda/Suporte",    # último menu registrado
+    "R$ 50",               # menu com StateFilter(None)
+    "trocar 250",          # fallback por lambda
+    "37,90",               # fallback com parse de valor
+    "bom dia",             # nada casa: cadeia inteira
+]
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def _noop_handler(h: HandlerObject) -> HandlerObject:
+    return HandlerObject(callback=_noop, filters=h.filters, flags=h.flags)
+
+
+def build_routers(m) -> tuple[Router, Router]:
+    originais = m.router.message.handlers
+
+    tabela = Router(name="tabela")
+    tabela.message.handlers = [_noop_handler(h) for h in originais]
+    for route in m.MENU_ROUTES.values():
+        route.handler = _noop
+        route.wants_state = False
+
+    cadeia = Router(name="cadeia")
+    for text, route in m.MENU_ROUTES.items():
+        filters = [FilterObject(F.text == text)]
+        if route.states is not m.ANY_STATE:
+            filters.insert(0, FilterObject(StateFilter(*route.states)))
+        cadeia.message.handlers.append(HandlerObject(callback=_noop, filters=filters))
+    cadeia.message.handlers += [_noop_handler(h) for h in originais if h.callback is not m.menu_dispatch]
+    return tabela, cadeia
+
+
+async def measure(router: Router, iterations: int) -> dict[str, float]:
+    dp = Dispatcher()
+    dp.include_router(router)
+    bot = Bot(FAKE_TOKEN, session=FakeSession())
+    updates = UpdateFactory()
+    out = {}
+    for text in SAMPLES:
+        batch = [updates.message(1000 + i % 50, text) for i in range(iterations)]
+        for u in batch[:50]:
+            await dp.feed_update(bot, u)
+        t0 = time.perf_counter()
+        for u in batch:
+            await dp.feed_update(bot, u)
+        out[text] = (time.perf_counter() - t0) / iterations
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--iterations", type=int, default=2000)
+    args = ap.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory(prefix="fazenda-routing-")
+    _prepare_env(os.path.join(tmp.name, "db.sqlite3"))
+    m = _import_bot()
+    logging.getLogger("aiogram.event").setLevel(logging.WARNING)
+    tabela, cadeia = build_routers(m)
+
+    res_tabela = asyncio.run(measure(tabela, args.iterations))
+    res_cadeia = asyncio.run(measure(cadeia, args.iterations))
+
+    us = lambda s: f"{s * 1e6:8.1f}"
+    print(f"{len(m.MENU_ROUTES)} textos na tabela, {len(m.router.message.handlers)} handlers de mensagem no router\n")
+    print(f"{'texto':<20} {'cadeia µs':>10} {'tabela µs':>10}")
+    for text in SAMPLES:
+        print(f"{text:<20} {us(res_cadeia[text]):>10} {us(res_tabela[text]):>10}")
+    print(f"{'média':<20} {us(statistics.mean(res_cadeia.values())):>10} {us(statistics.mean(res_tabela.values())):>10}")
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Mede o custo de import e de startup de um worker.
+
+- import: `import fazenda_ton_bot.bot_main` em subprocessos limpos (mediana);
+- montagem: get_dispatcher() e create_app();
+- migrate(): banco novo vs. banco já em dia;
+- warm_up(): etapas em paralelo vs. a soma delas (o que seria em sequência).
+
+As fontes externas são simuladas com latência fixa: Telegram via FakeSession,
+Crypto Pay via o servidor falso e o preço do TON por um stub.
+
+Uso:
+    python -m fazenda_ton_bot.bench.startup --runs 5 --tg-latency-ms 150 --cryptopay-latency-ms 200 --price-latency-ms 400
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from fazenda_ton_bot.bench.fake_cryptopay import FakeCryptoPay, serve_in_thread
+from fazenda_ton_bot.bench.fake_telegram import FakeSession
+from fazenda_ton_bot.bench.load_dispatcher import _prepare_env
+from fazenda_ton_bot.bench.money_paths import BENCH_CRYPTOPAY_TOKEN, _free_port
+
+
+def measure_import(runs: int, env: dict) -> list[float]:
+    code = "import time; t=time.perf_counter(); import fazenda_ton_bot.bot_main; print(time.perf_counter()-t)"
+    out = []
+    for _ in range(runs):
+        r = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+        out.append(float(r.stdout.strip().splitlines()[-1]))
+    return out
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--tg-latency-ms", type=float, default=150.0)
+    ap.add_argument("--cryptopay-latency-ms", type=float, default=200.0)
+    ap.add_argument("--price-latency-ms", type=float, default=400.0)
+    args = ap.parse_args(argv)
+
+    tmp = tempfile.TemporaryDirectory(prefix="fazenda-startup-")
+    db_path = os.path.join(tmp.name, "db.sqlite3")
+    port = _free_port()
+    fake = FakeCryptoPay(BENCH_CRYPTOPAY_TOKEN, latency=args.cryptopay_latency_ms / 1000.0)
+    serve_in_thread(fake.app, port)
+
+    _prepare_env(db_path)
+    os.environ["CRYPTOPAY_API"] = f"http://127.0.0.1:{port}/api"
+    os.environ["CRYPTOPAY_TOKEN"] = BENCH_CRYPTOPAY_TOKEN
+
+    imports = measure_import(args.runs, dict(os.environ))
+
+    t0 = time.perf_counter()
+    from fazenda_ton_bot import bot_main as m
+    t_import = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    m.get_dispatcher()
+    t_dp = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    m.create_app()
+    t_app = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    m.migrate()
+    t_mig_new = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    m.migrate()
+    t_mig_ok = time.perf_counter() - t0
+
+    m.get_bot().session = FakeSession(latency=args.tg_latency_ms / 1000.0)
+    price_latency = args.price_latency_ms / 1000.0
+
+    def fake_price():
+        time.sleep(price_latency)
+        return m.FALLBACK_TON_BRL
+
+    m.get_ton_price_brl = fake_price
+
+    t0 = time.perf_counter()
+    phases = asyncio.run(m.warm_up())
+    t_warm = time.perf_counter() - t0
+
+    ms = lambda s: f"{s * 1000:.1f} ms"
+    print(f"import (subprocesso, {args.runs}x): mediana {ms(statistics.median(imports))}, "
+          f"min {ms(min(imports))}, max {ms(max(imports))}")
+    print(f"import (neste processo):          {ms(t_import)}")
+    print(f"get_dispatcher():                 {ms(t_dp)}")
+    print(f"create_app():                     {ms(t_app)}")
+    print(f"migrate() banco novo:             {ms(t_mig_new)}")
+    print(f"migrate() banco em dia:           {ms(t_mig_ok)}")
+    print("warm_up() por etapa:              " + ", ".join(f"{k} {ms(v)}" for k, v in phases.items()))
+    print(f"warm_up() paralelo:               {ms(t_warm)}  (sequencial seria ~{ms(sum(phases.values()))})")
+    tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
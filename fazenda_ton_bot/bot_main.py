@@ -1,25 +1,292 @@
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import hashlib
 import random
 import hmac
 import requests
 import httpx
-import re, uuid, time, os, sqlite3, json, logging
-from collections import defaultdict
+import re, uuid, time, os, sqlite3, json, logging, socket, atexit
+import bisect, functools, threading, contextvars, heapq, sys, traceback, inspect
+import csv, io, zlib, glob, collections
+from collections import OrderedDict, defaultdict, deque, Counter as _StackCounter
 
-from aiogram import Bot, Dispatcher, F, types, BaseMiddleware
+from aiogram import Bot, Dispatcher, Router, F, types, BaseMiddleware
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter, TelegramBadRequest
 
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, APIRouter, Request, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 import uvicorn
 
 from aiohttp import ClientTimeout  # (mantido para compatibilidade)
 
-logging.basicConfig(level=logging.INFO)
+from fazenda_ton_bot.storage import (
+    Storage, SqliteStorage, ShardedSqliteStorage, PostgresStorage, SALDOS_VAZIOS, coletar_producao, shard_paths,
+    auto_vacuum_incremental,
+)
+from fazenda_ton_bot.backup import copiar as copiar_sqlite, rotacionar as rotacionar_backups
+from fazenda_ton_bot.logs import LOG_CONTEXT, configurar as configurar_logs, contexto_log, parse_amostragem
+
+# ===== MÉTRICAS (formato texto do Prometheus, agregação em processo) =====
+# Cada observação é só um bisect + incremento sob lock; a serialização em
+# texto acontece apenas quando alguém faz GET /metrics.
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip()
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_METRICS = []
+
+def _fmt_labels(names, values, extra: str = "") -> str:
+    parts = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        parts.append(f'{n}="{v}"')
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values = defaultdict(float)
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def inc(self, *label_values, amount: float = 1.0):
+        with self._lock:
+            self._values[label_values] += amount
+
+    def value(self, *label_values) -> float:
+        with self._lock:
+            return self._values.get(label_values, 0.0)
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        for lv, v in items:
+            yield f"{self.name}{_fmt_labels(self.labels, lv)} {v}"
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        with self._lock:
+            self._values[label_values] = float(value)
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [contagens por bucket, soma, total]
+        self._lock = threading.Lock()
+        _METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            st = self._values.get(label_values)
+            if st is None:
+                st = self._values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                st[0][i] += 1
+            st[1] += value
+            st[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = sorted((lv, (list(st[0]), st[1], st[2])) for lv, st in self._values.items())
+        for lv, (counts, total, n) in items:
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                le_label = 'le="%s"' % le
+                yield f"{self.name}_bucket{_fmt_labels(self.labels, lv, le_label)} {acc}"
+            inf_label = 'le="+Inf"'
+            yield f"{self.name}_bucket{_fmt_labels(self.labels, lv, inf_label)} {n}"
+            yield f"{self.name}_sum{_fmt_labels(self.labels, lv)} {total}"
+            yield f"{self.name}_count{_fmt_labels(self.labels, lv)} {n}"
+
+def render_metrics() -> str:
+    out = []
+    for m in _METRICS:
+        out.append(f"# HELP {m.name} {m.help}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(m.render())
+    return "\n".join(out) + "\n"
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Latência dos handlers do aiogram", ("event", "handler"))
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Exceções levantadas pelos handlers", ("event", "handler"))
+HTTP_SECONDS = Histogram("http_request_seconds", "Latência das rotas FastAPI", ("method", "route"))
+HTTP_REQUESTS = Counter("http_requests_total", "Requisições HTTP por status", ("method", "route", "status"))
+DB_CONNECT_SECONDS = Histogram("db_connect_seconds", "Tempo para abrir conexão SQLite (inclui PRAGMAs)")
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Tempo das queries executadas via db_conn", ("op", "table"))
+CRYPTOPAY_SECONDS = Histogram("cryptopay_call_seconds", "Latência das chamadas à API do Crypto Pay", ("method",))
+CRYPTOPAY_ERRORS = Counter("cryptopay_errors_total", "Erros nas chamadas ao Crypto Pay", ("method", "kind"))
+PRICE_FETCH_SECONDS = Histogram("price_fetch_seconds", "Tempo de cada tentativa de busca de preço", ("source", "result"))
+RATELIMIT_DROPS = Counter("ratelimit_drops_total", "Updates descartados pelo RateLimitMiddleware", ("event",))
+LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "Atraso do event loop medido por sleep periódico")
+LOOP_LAG_LAST = Gauge("event_loop_lag_last_seconds", "Último atraso medido do event loop")
+LOOP_BLOCKS = Counter("event_loop_blocks_total", "Bloqueios do event loop acima do limite", ("handler",))
+STARTUP_SECONDS = Gauge("startup_seconds", "Duração de cada etapa do startup", ("phase",))
+IS_LEADER = Gauge("leader", "1 se este processo detém o lease dos singletons")
+LEADER_CHANGES = Counter("leader_changes_total", "Vezes que este processo assumiu ou perdeu a liderança", ("event",))
+LOOP_BLOCK_SECONDS = Histogram("event_loop_block_seconds", "Duração dos bloqueios detectados pelo watchdog", ("handler",))
+AUTO_COLLECT_ROWS = Counter("auto_collect_users_total", "Usuários creditados pela coleta automática")
+BALANCE_CACHE = Counter("balance_cache_total", "Leituras do cache de saldos por resultado (hit/miss/evict)", ("result",))
+COOLDOWN_CLAIMS = Counter("cooldown_claims_total", "Resgates de recompensas com intervalo por resultado (ok/indice/banco)", ("reward", "result"))
+INVOICE_CACHE = Counter("invoice_cache_total", "Links de depósito reaproveitados por resultado (hit/miss/paga/evict)", ("result",))
+REMINDERS_SENT = Counter("farm_reminders_total", "Lembretes de fazenda cheia por resultado", ("result",))
+AUTO_COLLECT_RATE = Gauge("auto_collect_rows_per_second", "Vazão da última rodada de coleta automática")
+SQLITE_WAL_BYTES = Gauge("sqlite_wal_bytes", "Tamanho do arquivo -wal após o último checkpoint da manutenção", ("db",))
+SQLITE_CHECKPOINT_SECONDS = Histogram("sqlite_checkpoint_seconds", "Duração dos checkpoints do WAL feitos pela manutenção", ("mode",))
+SQLITE_CHECKPOINT_BUSY = Counter("sqlite_checkpoint_busy_total", "Checkpoints que não copiaram o WAL inteiro (leitores/escritores ativos)", ("mode",))
+SQLITE_MAINT_SECONDS = Histogram("sqlite_maintenance_seconds", "Duração das etapas de manutenção do SQLite", ("task",))
+SQLITE_FREELIST_PAGES = Gauge("sqlite_freelist_pages", "Páginas livres no arquivo após a última manutenção", ("db",))
+SQLITE_VACUUM_PAGES_TOTAL = Counter("sqlite_vacuum_pages_total", "Páginas devolvidas ao disco pelo incremental_vacuum", ("db",))
+BACKUP_BUCKETS = (0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+BACKUP_SECONDS = Histogram("sqlite_backup_seconds", "Duração do backup por fase (copia, verificacao)", ("phase",), buckets=BACKUP_BUCKETS)
+BACKUP_STEP_SECONDS = Histogram("sqlite_backup_step_seconds", "Duração de cada passo da backup API (leitura segurada na origem)")
+BACKUP_RESTARTS = Counter("sqlite_backup_restarts_total", "Cópias recomeçadas porque a origem mudou no meio")
+BACKUP_FAILURES = Counter("sqlite_backup_failures_total", "Backups que falharam", ("reason",))
+BACKUP_LAST_OK = Gauge("sqlite_backup_last_success_timestamp", "Unix time do último snapshot verificado", ("db",))
+BACKUP_BYTES = Gauge("sqlite_backup_bytes", "Tamanho do último snapshot comprimido", ("db",))
+ARCHIVED_ROWS = Counter("archived_rows_total", "Linhas movidas para o banco de arquivo", ("table",))
+INVOICES_CREDITED = Counter("invoices_credited_total", "Invoices pagas creditadas, por origem (webhook/conferencia)", ("source",))
+WITHDRAW_RECONCILED = Counter("withdraw_reconciled_total", "Saques presos resolvidos pela reconciliação (done/estornado/ambiguo)", ("result",))
+ARCHIVE_SECONDS = Histogram("archive_run_seconds", "Duração de cada rodada de arquivamento", buckets=BACKUP_BUCKETS)
+
+# Contadores por update (preenchidos pelo UpdateProfilerMiddleware)
+_UPDATE_STATS = contextvars.ContextVar("update_stats", default=None)
+
+def _update_stats_add(kind: str, seconds: float):
+    st = _UPDATE_STATS.get()
+    if st is not None:
+        st[kind + "_calls"] += 1
+        st[kind + "_s"] += seconds
+
+# ===== Logs (JSON, fila + listener, amostragem) =====
+# O event loop só enfileira (fila limitada: cheia → descarta e conta); uma
+# thread escreve no stderr. Cada linha leva update_id/user_id/handler/
+# duration_ms do update em andamento (LogContextMiddleware). INFO dos
+# loggers de LOG_SAMPLE ("logger=fração,...") é amostrado; WARNING+ sempre sai.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()   # json | text
+LOG_SAMPLE = parse_amostragem(os.getenv("LOG_SAMPLE", "aiogram.event=0.05,httpx=0.1"))
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOGS_DROPPED = Counter("log_records_dropped_total", "Registros de log descartados (amostragem/fila_cheia)", ("reason", "logger"))
+
+LOG_LISTENER = configurar_logs(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE, LOG_QUEUE_SIZE, ao_descartar=LOGS_DROPPED.inc)
+atexit.register(LOG_LISTENER.stop)
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+async def _loop_lag_monitor():
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL)
+        LOOP_LAG_SECONDS.observe(lag)
+        LOOP_LAG_LAST.set(lag)
+
+# ===== Watchdog de bloqueio do event loop =====
+# Um heartbeat agendado no loop atualiza um carimbo; uma thread separada confere
+# o carimbo e, se o loop ficou parado além do limite (I/O síncrono, time.sleep,
+# sqlite3 pesado...), captura a pilha da thread do loop e identifica o handler.
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.2"))  # 0 desativa
+
+class LoopWatchdog:
+    def __init__(self, threshold: float = LOOP_BLOCK_THRESHOLD, keep: int = 50):
+        self.threshold = threshold
+        self.interval = max(threshold / 2, 0.005)
+        self.blocks = deque(maxlen=keep)  # bloqueios já encerrados (útil em testes)
+        self.loop = None
+        self.loop_thread = None
+        self._beat = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop=None):
+        # precisa ser chamado de dentro da thread do loop
+        self.loop = loop or asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self.loop.call_soon(self._tick)
+        self._thread = threading.Thread(target=self._run, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _tick(self):
+        self._beat = time.monotonic()
+        if not self._stop.is_set():
+            self.loop.call_later(self.interval, self._tick)
+
+    def _run(self):
+        current = None
+        while not self._stop.wait(self.interval):
+            lag = time.monotonic() - self._beat - self.interval
+            if lag >= self.threshold:
+                if current is None:
+                    frame = sys._current_frames().get(self.loop_thread)
+                    current = {
+                        "ts": _iso_now(),
+                        "handler": _handler_name_from_frame(frame),
+                        "stack": "".join(traceback.format_stack(frame)) if frame else "",
+                    }
+                    logging.warning(
+                        "[watchdog] event loop bloqueado há %.0f ms (handler=%s)\n%s",
+                        lag * 1000, current["handler"], current["stack"],
+                    )
+                current["blocked_s"] = lag
+            elif current is not None:
+                LOOP_BLOCKS.inc(current["handler"])
+                LOOP_BLOCK_SECONDS.observe(current["blocked_s"], current["handler"])
+                logging.warning(
+                    "[watchdog] event loop liberado após ~%.0f ms (handler=%s)",
+                    current["blocked_s"] * 1000, current["handler"],
+                )
+                self.blocks.append(current)
+                current = None
+
+_HANDLER_CODES = {}
+
+def _handler_name_from_frame(frame) -> str:
+    if not _HANDLER_CODES:
+        for observer in (router.message, router.callback_query):
+            for h in observer.handlers:
+                code = getattr(h.callback, "__code__", None)
+                if code is not None:
+                    _HANDLER_CODES[code] = h.callback.__name__
+        for route in MENU_ROUTES.values():
+            _HANDLER_CODES[route.handler.__code__] = route.handler.__name__
+        for route in api.routes:
+            code = getattr(getattr(route, "endpoint", None), "__code__", None)
+            if code is not None:
+                _HANDLER_CODES[code] = f"http:{route.path}"
+    while frame is not None:
+        name = _HANDLER_CODES.get(frame.f_code)
+        if name:
+            return name
+        frame = frame.f_back
+    return "?"
+
+LOOP_WATCHDOG = LoopWatchdog()
 
 # ===== MATERIAIS / CONVERSÕES =====
 MATERIAIS_DIVISOR = 1000.0        # cada 1000 materiais viram 1 "unidade base"
@@ -43,13 +310,21 @@ def _is_sane_brl(p: float) -> bool:
     return 0.1 <= p <= 1000.0
 
 def _try_with_retries(fn, attempts=(0.0, 0.5, 1.0)):
+    source = getattr(fn, "__name__", "?").strip("_")
     for delay in attempts:
+        t0 = time.perf_counter()
         try:
             v = float(fn())
             if v > 0:
+                dt = time.perf_counter() - t0
+                PRICE_FETCH_SECONDS.observe(dt, source, "ok")
+                _update_stats_add("price", dt)
                 return v
         except Exception:
             pass
+        dt = time.perf_counter() - t0
+        PRICE_FETCH_SECONDS.observe(dt, source, "fail")
+        _update_stats_add("price", dt)
         if delay:
             time.sleep(delay)
     return 0.0
@@ -147,7 +422,8 @@ PRICE_REFRESH_SECONDS = int(os.getenv("PRICE_REFRESH_SECONDS", "45"))
 async def _refresh_price_loop():
     while True:
         try:
-            _ = get_ton_price_brl()
+            # requests + retries: numa thread, para não travar o loop (e a renovação do lease)
+            _ = await asyncio.to_thread(get_ton_price_brl)
         except Exception:
             pass
         await asyncio.sleep(PRICE_REFRESH_SECONDS)
@@ -182,195 +458,407 @@ db_dir = os.path.dirname(DB_PATH)
 if db_dir:
     os.makedirs(db_dir, exist_ok=True)
 
+# Os checkpoints do WAL ficam com a tarefa de manutenção do líder (ver
+# "Manutenção do SQLite"). O auto-checkpoint de cada conexão vira só rede de
+# segurança, com limiar bem acima do padrão do SQLite (1000 páginas), para não
+# cair no commit de um update qualquer.
+SQLITE_CHECKPOINT_INTERVAL = int(os.getenv("SQLITE_CHECKPOINT_INTERVAL", "30"))  # 0 desliga a manutenção
+SQLITE_WAL_AUTOCHECKPOINT = int(os.getenv(
+    "SQLITE_WAL_AUTOCHECKPOINT", "10000" if SQLITE_CHECKPOINT_INTERVAL > 0 else "1000"
+))
+
 def _column_exists(conn, table, column):
     cur = conn.execute(f"PRAGMA table_info({table})")
     return any(r[1] == column for r in cur.fetchall())
 
-def sweep_old_withdraw_locks(user_id: int | None = None, max_age_minutes: int = 15) -> int:
-    """
-    Marca como 'failed' quaisquer withdrawals 'pending'/'processing' mais antigos que max_age_minutes.
-    Retorna quantos registros foram atualizados.
-    """
-    with db_conn() as c:
-        if user_id is not None:
-            res = c.execute(
-                """
-                UPDATE withdrawals
-                   SET status='failed', updated_at=CURRENT_TIMESTAMP
-                 WHERE status IN ('pending','processing')
-                   AND created_at <= DATETIME('now', ?)
-                   AND user_id = ?
-                """,
-                (f'-{max_age_minutes} minutes', user_id)
-            )
-        else:
-            res = c.execute(
-                """
-                UPDATE withdrawals
-                   SET status='failed', updated_at=CURRENT_TIMESTAMP
-                 WHERE status IN ('pending','processing')
-                   AND created_at <= DATETIME('now', ?)
-                """,
-                (f'-{max_age_minutes} minutes',)
-            )
-        return res.rowcount or 0
-
-
-def db_conn():
-    conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None)
+_SQL_TABLE_RE = re.compile(
+    r'\b(?:FROM|INTO|UPDATE|TABLE(?:\s+IF\s+NOT\s+EXISTS)?|ON)\s+([A-Za-z_][A-Za-z0-9_]*)',
+    re.IGNORECASE,
+)
+
+@functools.lru_cache(maxsize=1024)
+def _sql_label(sql: str) -> tuple[str, str]:
+    # rótulos de baixa cardinalidade: (operação, tabela)
+    s = sql.lstrip()
+    op = s.split(None, 1)[0].upper() if s else "?"
+    m = _SQL_TABLE_RE.search(s)
+    return op, (m.group(1) if m else "-")
+
+class _TimedConnection(sqlite3.Connection):
+    def execute(self, sql, parameters=(), /):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            dt = time.perf_counter() - t0
+            DB_QUERY_SECONDS.observe(dt, *_sql_label(sql))
+            _update_stats_add("db", dt)
+
+def db_conn(path: str | None = None):
+    t0 = time.perf_counter()
+    conn = sqlite3.connect(path or DB_PATH, timeout=30, isolation_level=None, factory=_TimedConnection)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL;")
     conn.execute("PRAGMA synchronous=NORMAL;")
     conn.execute("PRAGMA busy_timeout=30000;")
+    if SQLITE_WAL_AUTOCHECKPOINT != 1000:
+        conn.execute(f"PRAGMA wal_autocheckpoint={SQLITE_WAL_AUTOCHECKPOINT};")
+    DB_CONNECT_SECONDS.observe(time.perf_counter() - t0)
     return conn
 
-def init_db():
-    with db_conn() as c:
-        c.execute('''CREATE TABLE IF NOT EXISTS usuarios (
-            telegram_id INTEGER PRIMARY KEY,
-            saldo_cash REAL DEFAULT 0,
-            saldo_ton REAL DEFAULT 0,
-            carteira_ton TEXT,
-            criado_em TEXT
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS animais (
-            nome TEXT PRIMARY KEY,
-            preco INTEGER,
-            rendimento REAL,
-            emoji TEXT
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS inventario (
-            telegram_id INTEGER,
-            animal TEXT,
-            quantidade INTEGER DEFAULT 0,
-            ultima_coleta TEXT,
-            PRIMARY KEY (telegram_id, animal)
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS indicacoes (
-            quem INTEGER PRIMARY KEY,
-            por  INTEGER,
-            criado_em TEXT
-        )''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS pagamentos (
-            invoice_id TEXT PRIMARY KEY,
-            user_id INTEGER,
-            valor_reais REAL,
-            cash INTEGER,
-            criado_em TEXT
-        )''')
-        c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_pagamentos_invoice
-                       ON pagamentos(invoice_id)''')
-
-        c.execute('''CREATE TABLE IF NOT EXISTS saques (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER,
-            valor_ton REAL,
-            carteira TEXT,
-            status TEXT DEFAULT 'pendente',
-            criado_em TEXT,
-            pago_em TEXT
-        )''')
-
-def cadastrar_animais():
-    animais = [
-        ('Galinha', 100,    800,    '🐔'),
-        ('Porco',   500,   4000,    '🐖'),
-        ('Vaca',   1500,  15000,    '🐄'),
-        ('Boi',    2500,  25000,    '🐂'),
-        ('Ovelha', 5000,  60000,    '🐑'),
-        ('Coelho',10000, 120000,    '🐇'),
-        ('Cabra', 20000, 280000,    '🐐'),
-        ('Cavalo',50000, 900000,    '🐎'),
-    ]
-    with db_conn() as c:
-        for nome, preco, rendimento, emoji in animais:
-            c.execute(
-                """
-                INSERT INTO animais (nome, preco, rendimento, emoji)
-                VALUES (?,?,?,?)
-                ON CONFLICT(nome) DO UPDATE SET
-                    preco=excluded.preco,
-                    rendimento=excluded.rendimento,
-                    emoji=excluded.emoji
-                """,
-                (nome, preco, rendimento, emoji)
-            )
-
-def ensure_schema():
-    with db_conn() as c:
-        if not _column_exists(c, "usuarios", "carteira_ton"):
-            c.execute("ALTER TABLE usuarios ADD COLUMN carteira_ton TEXT")
-        if not _column_exists(c, "usuarios", "saldo_cash"):
-            c.execute("ALTER TABLE usuarios ADD COLUMN saldo_cash REAL DEFAULT 0.0")
-        if not _column_exists(c, "usuarios", "saldo_cash_pagamentos"):
-            c.execute("ALTER TABLE usuarios ADD COLUMN saldo_cash_pagamentos REAL DEFAULT 0.0")
-        if not _column_exists(c, "usuarios", "saldo_ton"):
-            c.execute("ALTER TABLE usuarios ADD COLUMN saldo_ton REAL DEFAULT 0.0")
-        if not _column_exists(c, "usuarios", "saldo_materiais"):
-            c.execute("ALTER TABLE usuarios ADD COLUMN saldo_materiais REAL DEFAULT 0.0")
-         # Controle de bônus diário (carimbo da última coleta)
-        if not _column_exists(c, "usuarios", "ultimo_bonus"):
-            c.execute("ALTER TABLE usuarios ADD COLUMN ultimo_bonus TEXT")    
-
+def init_db(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS usuarios (
+        telegram_id INTEGER PRIMARY KEY,
+        saldo_cash REAL DEFAULT 0,
+        saldo_ton REAL DEFAULT 0,
+        carteira_ton TEXT,
+        criado_em TEXT
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS animais (
+        nome TEXT PRIMARY KEY,
+        preco INTEGER,
+        rendimento REAL,
+        emoji TEXT
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS inventario (
+        telegram_id INTEGER,
+        animal TEXT,
+        quantidade INTEGER DEFAULT 0,
+        ultima_coleta TEXT,
+        PRIMARY KEY (telegram_id, animal)
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS indicacoes (
+        quem INTEGER PRIMARY KEY,
+        por  INTEGER,
+        criado_em TEXT
+    )''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS pagamentos (
+        invoice_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        valor_reais REAL,
+        cash INTEGER,
+        criado_em TEXT
+    )''')
+    c.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_pagamentos_invoice
+                   ON pagamentos(invoice_id)''')
+
+    c.execute('''CREATE TABLE IF NOT EXISTS saques (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER,
+        valor_ton REAL,
+        carteira TEXT,
+        status TEXT DEFAULT 'pendente',
+        criado_em TEXT,
+        pago_em TEXT
+    )''')
+
+ANIMAIS = [
+    ('Galinha', 100,    800,    '🐔'),
+    ('Porco',   500,   4000,    '🐖'),
+    ('Vaca',   1500,  15000,    '🐄'),
+    ('Boi',    2500,  25000,    '🐂'),
+    ('Ovelha', 5000,  60000,    '🐑'),
+    ('Coelho',10000, 120000,    '🐇'),
+    ('Cabra', 20000, 280000,    '🐐'),
+    ('Cavalo',50000, 900000,    '🐎'),
+]
+
+def cadastrar_animais(c):
+    for nome, preco, rendimento, emoji in ANIMAIS:
         c.execute(
             """
-            UPDATE inventario
-               SET ultima_coleta = COALESCE(ultima_coleta, ?)
-             WHERE ultima_coleta IS NULL OR TRIM(ultima_coleta) = ''
+            INSERT INTO animais (nome, preco, rendimento, emoji)
+            VALUES (?,?,?,?)
+            ON CONFLICT(nome) DO UPDATE SET
+                preco=excluded.preco,
+                rendimento=excluded.rendimento,
+                emoji=excluded.emoji
             """,
-            (datetime.now().isoformat(),)
+            (nome, preco, rendimento, emoji)
         )
 
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS withdrawals (
-          id INTEGER PRIMARY KEY AUTOINCREMENT,
-          user_id INTEGER NOT NULL,
-          requested_ton REAL NOT NULL,
-          wallet TEXT NOT NULL,
-          status TEXT NOT NULL CHECK(status IN ('pending','processing','done','failed')) DEFAULT 'pending',
-          idempotency_key TEXT UNIQUE NOT NULL,
-          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-          updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+def ensure_schema(c):
+    if not _column_exists(c, "usuarios", "carteira_ton"):
+        c.execute("ALTER TABLE usuarios ADD COLUMN carteira_ton TEXT")
+    if not _column_exists(c, "usuarios", "saldo_cash"):
+        c.execute("ALTER TABLE usuarios ADD COLUMN saldo_cash REAL DEFAULT 0.0")
+    if not _column_exists(c, "usuarios", "saldo_cash_pagamentos"):
+        c.execute("ALTER TABLE usuarios ADD COLUMN saldo_cash_pagamentos REAL DEFAULT 0.0")
+    if not _column_exists(c, "usuarios", "saldo_ton"):
+        c.execute("ALTER TABLE usuarios ADD COLUMN saldo_ton REAL DEFAULT 0.0")
+    if not _column_exists(c, "usuarios", "saldo_materiais"):
+        c.execute("ALTER TABLE usuarios ADD COLUMN saldo_materiais REAL DEFAULT 0.0")
+     # Controle de bônus diário (carimbo da última coleta)
+    if not _column_exists(c, "usuarios", "ultimo_bonus"):
+        c.execute("ALTER TABLE usuarios ADD COLUMN ultimo_bonus TEXT")    
+
+    c.execute(
+        """
+        UPDATE inventario
+           SET ultima_coleta = COALESCE(ultima_coleta, ?)
+         WHERE ultima_coleta IS NULL OR TRIM(ultima_coleta) = ''
+        """,
+        (datetime.now().isoformat(),)
+    )
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS withdrawals (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER NOT NULL,
+      requested_ton REAL NOT NULL,
+      wallet TEXT NOT NULL,
+      status TEXT NOT NULL CHECK(status IN ('pending','processing','done','failed')) DEFAULT 'pending',
+      idempotency_key TEXT UNIQUE NOT NULL,
+      created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+      updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS cb_tokens (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        payload TEXT,
+        expires_at INTEGER NOT NULL,
+        used INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_indicacoes_por ON indicacoes(por)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_inventario_uid ON inventario(telegram_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_pag_user ON pagamentos(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_wd_user ON withdrawals(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_wd_status ON withdrawals(status, updated_at)")
+
+# ===== Catálogo de animais (em memória) =====
+# O catálogo só muda via migração; cada processo carrega uma vez e reutiliza.
+_ANIMAIS_CACHE = {}
+
+def get_animais() -> list[dict]:
+    if not _ANIMAIS_CACHE:
+        with db_conn() as c:
+            rows = c.execute("SELECT nome, preco, rendimento, emoji FROM animais ORDER BY preco ASC").fetchall()
+        _ANIMAIS_CACHE.update((r["nome"], dict(r)) for r in rows)
+    return list(_ANIMAIS_CACHE.values())
+
+def get_animal(nome: str) -> dict | None:
+    if not _ANIMAIS_CACHE:
+        get_animais()
+    return _ANIMAIS_CACHE.get(nome)
+
+# ===== Migrações versionadas =====
+# Cada migração roda uma única vez, em ordem, dentro de uma transação, e
+# grava sua versão em schema_version. Com o banco em dia, migrate() é só um
+# SELECT. Para mudar o schema (ou o catálogo de animais), acrescente uma nova
+# entrada no fim de MIGRATIONS — nunca edite uma já aplicada.
+def _migration_base(c):
+    # bancos antigos (sem schema_version) passam por aqui também: tudo é idempotente
+    init_db(c)
+    ensure_schema(c)
+
+def _migration_broadcasts(c):
+    c.execute("ALTER TABLE usuarios ADD COLUMN bloqueado_em TEXT")
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            texto TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('running','done','cancelled')) DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_uid INTEGER NOT NULL DEFAULT 0,
+            enviados INTEGER NOT NULL DEFAULT 0,
+            bloqueados INTEGER NOT NULL DEFAULT 0,
+            falhas INTEGER NOT NULL DEFAULT 0,
+            criado_em TEXT,
+            atualizado_em TEXT
         )
-        """)
+    """)
 
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS cb_tokens (
-            id TEXT PRIMARY KEY,
+def _migration_lembretes(c):
+    c.execute("ALTER TABLE usuarios ADD COLUMN lembrete_em TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_inv_coleta ON inventario(ultima_coleta, telegram_id)")
+
+def _migration_leases(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            nome TEXT PRIMARY KEY,
+            dono TEXT NOT NULL,
+            expira_em REAL NOT NULL,
+            adquirido_em REAL NOT NULL
+        )
+    """)
+
+def _migration_invoices(c):
+    c.execute("""
+        CREATE TABLE IF NOT EXISTS invoices (
+            invoice_id TEXT PRIMARY KEY,
             user_id INTEGER NOT NULL,
-            action TEXT NOT NULL,
-            payload TEXT,
-            expires_at INTEGER NOT NULL,
-            used INTEGER NOT NULL DEFAULT 0,
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+            valor_reais REAL NOT NULL,
+            url TEXT,
+            status TEXT NOT NULL DEFAULT 'active',
+            criado_em TEXT NOT NULL
+        )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_invoices_abertas ON invoices(status, criado_em)")
+
+def _migration_broadcasts_failed(c):
+    # o SQLite não altera CHECK: recria a tabela com 'failed' e copia as linhas
+    c.execute("""
+        CREATE TABLE broadcasts_v7 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER NOT NULL,
+            texto TEXT NOT NULL,
+            status TEXT NOT NULL CHECK(status IN ('running','done','cancelled','failed')) DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            last_uid INTEGER NOT NULL DEFAULT 0,
+            enviados INTEGER NOT NULL DEFAULT 0,
+            bloqueados INTEGER NOT NULL DEFAULT 0,
+            falhas INTEGER NOT NULL DEFAULT 0,
+            criado_em TEXT,
+            atualizado_em TEXT
         )
+    """)
+    c.execute("INSERT INTO broadcasts_v7 SELECT * FROM broadcasts")
+    c.execute("DROP TABLE broadcasts")
+    c.execute("ALTER TABLE broadcasts_v7 RENAME TO broadcasts")
+
+def _migration_drop_inv_coleta(c):
+    # o lembrete pagina por idx_inventario_uid; ninguém mais lê este índice,
+    # e toda coleta/compra o reescreve (ultima_coleta)
+    c.execute("DROP INDEX IF EXISTS idx_inv_coleta")
+
+MIGRATIONS = [
+    (1, "schema base: tabelas, colunas legadas e índices", _migration_base),
+    (2, "catálogo de animais", cadastrar_animais),
+    (3, "broadcasts e usuarios.bloqueado_em", _migration_broadcasts),
+    (4, "lembrete de fazenda cheia (usuarios.lembrete_em, idx_inv_coleta)", _migration_lembretes),
+    (5, "leases para eleição de líder", _migration_leases),
+    (6, "invoices criadas pelo bot (conferência sem webhook)", _migration_invoices),
+    (7, "broadcasts.status aceita 'failed'", _migration_broadcasts_failed),
+    (8, "remove idx_inv_coleta (lembrete pagina por idx_inventario_uid)", _migration_drop_inv_coleta),
+]
+
+def schema_version(c) -> int:
+    try:
+        row = c.execute("SELECT MAX(version) AS v FROM schema_version").fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return int(row["v"] or 0)
+
+def migrate() -> int:
+    """Aplica as migrações pendentes e retorna a versão final do schema."""
+    latest = MIGRATIONS[-1][0]
+    with db_conn() as c:
+        if schema_version(c) >= latest:
+            return latest
+        if auto_vacuum_incremental(c):
+            logging.info("[migrate] banco novo com auto_vacuum=INCREMENTAL")
+        c.execute("BEGIN IMMEDIATE")  # outro worker pode estar migrando ao mesmo tempo
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                descricao TEXT,
+                aplicada_em TEXT
+            )
         """)
+        current = schema_version(c)
+        for version, descricao, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            fn(c)
+            c.execute(
+                "INSERT INTO schema_version (version, descricao, aplicada_em) VALUES (?, ?, ?)",
+                (version, descricao, datetime.now().isoformat())
+            )
+            logging.info("[migrate] v%s aplicada: %s", version, descricao)
+        _ANIMAIS_CACHE.clear()
+        return latest
+
+# ===== Backend de persistência (repositórios) =====
+# Os handlers usam storage().<repo>; o SQL de cada backend fica em storage.py.
+# STORAGE_BACKEND=sqlite (padrão) usa o DB_PATH acima, ou SQLITE_SHARDS>1
+# arquivos ao lado dele (db.shard0.sqlite3, ...) para as tabelas por usuário;
+# =postgres usa um pool asyncpg em DATABASE_URL, aberto no on_startup.
+# schema_version, broadcasts (o progresso; destinatários vêm de storage()) e o
+# lease de líder ficam sempre no DB_PATH. Coleta automática, lembretes,
+# exportações e arquivamento ainda leem usuarios/inventario/withdrawals direto
+# do DB_PATH: com shards ou Postgres o bot não sobe com eles ligados.
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+SQLITE_SHARDS = int(os.getenv("SQLITE_SHARDS", "0"))
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "2"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "20"))
+_STORAGE: dict[str, Storage] = {}
+
+def storage() -> Storage:
+    st = _STORAGE.get("st")
+    if st is None:
+        if STORAGE_BACKEND != "sqlite":
+            raise RuntimeError(f"storage {STORAGE_BACKEND!r} não inicializado (init_storage no startup)")
+        arq = arquivo_conn if arquivo_ativo() else None
+        if SQLITE_SHARDS > 1:
+            st = ShardedSqliteStorage(db_conn, DB_PATH, shard_paths(DB_PATH, SQLITE_SHARDS), arq)
+            st.create_schema(ANIMAIS)
+        else:
+            st = SqliteStorage(db_conn, arq)
+        _STORAGE["st"] = st
+    return st
+
+def _recursos_so_db_path() -> list[str]:
+    """Recursos ligados que só funcionam com tudo no DB_PATH (SQLite sem shards)."""
+    ligados = {
+        "AUTO_COLLECT_INTERVAL": AUTO_COLLECT_INTERVAL > 0,
+        "LEMBRETE_INTERVAL": LEMBRETE_INTERVAL > 0,
+        "EXPORT_TOKEN": bool(EXPORT_TOKEN),
+        "ARCHIVE_DAYS": ARCHIVE_DAYS > 0,
+    }
+    return [k for k, v in ligados.items() if v]
 
-        c.execute("CREATE INDEX IF NOT EXISTS idx_indicacoes_por ON indicacoes(por)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_inventario_uid ON inventario(telegram_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_pag_user ON pagamentos(user_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_wd_user ON withdrawals(user_id)")
+def _storage_fora_do_db_path() -> bool:
+    return STORAGE_BACKEND != "sqlite" or SQLITE_SHARDS > 1
 
-# cria tudo primeiro, depois prossegue
-init_db()
-cadastrar_animais()
-ensure_schema()
+async def init_storage() -> Storage:
+    if _storage_fora_do_db_path() and _recursos_so_db_path():
+        raise RuntimeError(
+            f"STORAGE_BACKEND={STORAGE_BACKEND} SQLITE_SHARDS={SQLITE_SHARDS}: "
+            f"{', '.join(_recursos_so_db_path())} ainda leem o DB_PATH; desligue-os ou use SQLite sem shards"
+        )
+    if "st" not in _STORAGE:
+        if STORAGE_BACKEND == "postgres":
+            st = await PostgresStorage.open(DATABASE_URL, PG_POOL_MIN, PG_POOL_MAX)
+            await st.create_schema(ANIMAIS)
+            _STORAGE["st"] = st
+        elif STORAGE_BACKEND != "sqlite":
+            raise RuntimeError(f"STORAGE_BACKEND inválido: {STORAGE_BACKEND!r} (use sqlite ou postgres)")
+    st = storage()
+    logging.info("[storage] backend %s", st.backend)
+    return st
+
+async def close_storage():
+    st = _STORAGE.pop("st", None)
+    if st is not None:
+        await st.close()
 
 # ========= CRYPTO PAY ==========
 CRYPTOPAY_TOKEN = (os.getenv("CRYPTOPAY_TOKEN") or "").strip()
-CRYPTOPAY_API = "https://pay.crypt.bot/api"
+CRYPTOPAY_API = (os.getenv("CRYPTOPAY_API") or "https://pay.crypt.bot/api").rstrip("/")
+CRYPTOPAY_TIMEOUT = float(os.getenv("CRYPTOPAY_TIMEOUT", "30"))
 
 CASH_POR_REAL = int(os.getenv("CASH_POR_REAL", "100"))
 REF_PCT = float(os.getenv("REF_PCT", "4"))
 
 # ========= BOT / APP ==========
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
-app = FastAPI()
+# Handlers e rotas são registrados em routers (baratos de criar no import).
+# Bot, Dispatcher e FastAPI só são montados sob demanda — ver get_bot(),
+# get_dispatcher() e create_app() no fim do arquivo.
+router = Router(name="fazenda")
+api = APIRouter()
 
 # ===== Rate Limit Middleware =====
 class RateLimitMiddleware(BaseMiddleware):
@@ -387,43 +875,398 @@ class RateLimitMiddleware(BaseMiddleware):
             while q and now - q[0] > self.per:
                 q.pop(0)
             if len(q) >= self.calls:
+                RATELIMIT_DROPS.inc(type(event).__name__)
                 return  # silencioso
             q.append(now)
         return await handler(event, data)
 
-dp.message.middleware(RateLimitMiddleware(calls=5, per_seconds=2))
-dp.callback_query.middleware(RateLimitMiddleware(calls=8, per_seconds=2))
+# ===== Métricas e contexto de log por handler =====
+def _handler_name(data) -> str:
+    # mensagens roteadas pela tabela de menus chegam todas em menu_dispatch
+    route = data.get("menu_route")
+    if route is not None:
+        return route.handler.__name__
+    return getattr(getattr(data.get("handler"), "callback", None), "__name__", "?")
+
+class LogContextMiddleware(BaseMiddleware):
+    # no dispatcher (Update): update_id, user_id e o início; no router: o handler.
+    # O "Update id=… is handled" do aiogram sai depois do reset; logs.py tira o
+    # update_id dos args dele (user_id/handler não chegam a esse registro)
+    async def __call__(self, handler, event, data):
+        if isinstance(event, types.Update):
+            user = data.get("event_from_user")
+            token = contexto_log(update_id=event.update_id, user_id=getattr(user, "id", None),
+                                 t0=time.perf_counter())
+        else:
+            token = contexto_log(handler=_handler_name(data))
+        try:
+            return await handler(event, data)
+        finally:
+            LOG_CONTEXT.reset(token)
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        kind = type(event).__name__
+        name = _handler_name(data)
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(kind, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, kind, name)
+
+# ===== Profiler de updates lentos =====
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0.01"))   # fração de updates amostrados
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))        # intervalo entre amostras (s)
+SLOW_UPDATES_KEEP = int(os.getenv("SLOW_UPDATES_KEEP", "20"))            # quantos updates lentos guardar
+
+class _StackSampler:
+    """
+    Amostra periodicamente a pilha da thread do event loop enquanto um update
+    amostrado está em andamento. Como o loop é compartilhado, as amostras podem
+    incluir outras tasks que rodaram durante os awaits do handler.
+    """
+    def __init__(self, thread_id: int, interval: float = PROFILE_INTERVAL, depth: int = 12):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.depth = depth
+        self.samples = _StackCounter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="update-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.depth:
+                code = frame.f_code
+                stack.append(f"{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def stop(self, top: int = 3):
+        self._stop.set()
+        self._thread.join()
+        total = sum(self.samples.values())
+        return [(stack, n / total) for stack, n in self.samples.most_common(top)] if total else []
+
+class SlowUpdates:
+    """Mantém os N updates mais lentos (min-heap pela duração)."""
+    def __init__(self, keep: int = SLOW_UPDATES_KEEP):
+        self.keep = keep
+        self._heap = []
+        self._seq = 0
+
+    def record(self, entry: dict):
+        self._seq += 1
+        item = (entry["total_s"], self._seq, entry)
+        if len(self._heap) < self.keep:
+            heapq.heappush(self._heap, item)
+        elif item[0] > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def slowest(self, n: int | None = None) -> list[dict]:
+        items = sorted(self._heap, reverse=True)
+        return [e for _, _, e in items[:n]]
+
+    def clear(self):
+        self._heap.clear()
+
+SLOW_UPDATES = SlowUpdates()
+
+class UpdateProfilerMiddleware(BaseMiddleware):
+    def __init__(self, sample_rate: float = PROFILE_SAMPLE_RATE, slow: SlowUpdates = SLOW_UPDATES):
+        self.sample_rate = sample_rate
+        self.slow = slow
 
-@app.get("/")
+    async def __call__(self, handler, event, data):
+        stats = {"db_calls": 0, "db_s": 0.0, "cryptopay_calls": 0, "cryptopay_s": 0.0,
+                 "price_calls": 0, "price_s": 0.0}
+        token = _UPDATE_STATS.set(stats)
+        sampler = None
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            sampler = _StackSampler(threading.get_ident()).start()
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            total = time.perf_counter() - t0
+            _UPDATE_STATS.reset(token)
+            stacks = sampler.stop() if sampler else None
+            what = getattr(event, "data", None) or getattr(event, "text", None) or ""
+            self.slow.record({
+                "ts": _iso_now(),
+                "event": type(event).__name__,
+                "handler": _handler_name(data),
+                "user_id": getattr(getattr(event, "from_user", None), "id", None),
+                "what": what[:32],
+                "total_s": total,
+                **stats,
+                "stacks": stacks,
+            })
+
+router.message.middleware(LogContextMiddleware())
+router.callback_query.middleware(LogContextMiddleware())
+router.message.middleware(RateLimitMiddleware(calls=5, per_seconds=2))
+router.callback_query.middleware(RateLimitMiddleware(calls=8, per_seconds=2))
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+router.message.middleware(UpdateProfilerMiddleware())
+router.callback_query.middleware(UpdateProfilerMiddleware())
+
+async def http_metrics_middleware(request: Request, call_next):
+    t0 = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = getattr(request.scope.get("route"), "path", None) or "<unmatched>"
+        HTTP_SECONDS.observe(time.perf_counter() - t0, request.method, route)
+        HTTP_REQUESTS.inc(request.method, route, str(status))
+
+@api.get("/metrics")
+async def metrics(request: Request):
+    if METRICS_TOKEN:
+        auth = request.headers.get("authorization") or ""
+        if not hmac.compare_digest(auth, f"Bearer {METRICS_TOKEN}"):
+            raise HTTPException(status_code=403, detail="forbidden")
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@api.get("/")
 async def root():
     return {"ok": True, "service": "fazendinha_bot"}
 
-@app.get("/healthz")
+@api.get("/healthz")
 async def healthz():
     return {"ok": True}
 
+# ===== Exportações (contabilidade) =====
+# GET /export/{tabela}?fmt=csv|ndjson&since=<ISO>&gzip=1 com "Authorization: Bearer $EXPORT_TOKEN".
+# As linhas saem em páginas por chave (keyset: WHERE chave > última ORDER BY chave LIMIT n),
+# cada página numa leitura curta e já escrita na resposta, então a memória fica
+# constante qualquer que seja o tamanho da tabela. O gerador é síncrono: o Starlette
+# o consome numa thread, fora do event loop.
+EXPORT_TOKEN = (os.getenv("EXPORT_TOKEN") or "").strip()
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "1000"))
+
+# tabela -> (chave do keyset, coluna usada no "since", coluna gravada em UTC?)
+# criado_em é datetime.now().isoformat() (hora local, "T"); os timestamps de
+# withdrawals vêm de CURRENT_TIMESTAMP (UTC, espaço). Comparar o texto cru
+# misturaria os dois: o "since" é convertido para o fuso da coluna e os dois
+# lados passam por datetime() do SQLite.
+EXPORTS = {
+    "usuarios":    ("telegram_id", "criado_em", False),
+    "pagamentos":  ("invoice_id", "criado_em", False),
+    "withdrawals": ("id", "updated_at", True),
+}
+
+def _parse_since(since: str) -> datetime:
+    """ISO 8601; sem fuso vale a hora local do servidor. ValueError se inválido."""
+    dt = datetime.fromisoformat(since)
+    return dt if dt.tzinfo else dt.astimezone()
+
+def _export_rows(tabela: str, since: datetime | None):
+    # linhas arquivadas saem primeiro, depois as do banco quente (ver "Arquivamento")
+    fontes = ["arq", "main"] if tabela in ARQUIVAVEIS and arquivo_ativo() else ["main"]
+    for fonte in fontes:
+        yield from _export_fonte(fonte, tabela, since)
+
+def _export_fonte(fonte: str, tabela: str, since: datetime | None):
+    key, since_col, utc = EXPORTS[tabela]
+    if since:
+        since = (since.astimezone(timezone.utc) if utc else since.astimezone()).replace(tzinfo=None)
+        since = since.isoformat(sep=" ", timespec="seconds")
+    last = None
+    while True:
+        conds, params = [], []
+        if since:
+            conds.append(f"datetime({since_col}) >= datetime(?)")
+            params.append(since)
+        if last is not None:
+            conds.append(f"{key} > ?")
+            params.append(last)
+        where = " AND ".join(conds) or "1"
+        with (arquivo_conn() if fonte == "arq" else db_conn()) as c:
+            cur = c.execute(
+                f"SELECT * FROM {fonte}.{tabela} WHERE {where} ORDER BY {key} LIMIT ?",
+                (*params, EXPORT_CHUNK)
+            )
+            cols = [d[0] for d in cur.description]
+            rows = [tuple(r) for r in cur]
+        if not rows:
+            return
+        yield cols, rows
+        if len(rows) < EXPORT_CHUNK:
+            return
+        last = rows[-1][cols.index(key)]
+
+def _export_stream(tabela: str, fmt: str, since: datetime | None, compress: bool):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    header_done = False
+    for cols, rows in _export_rows(tabela, since):
+        buf = io.StringIO()
+        if fmt == "csv":
+            w = csv.writer(buf)
+            if not header_done:
+                w.writerow(cols)
+                header_done = True
+            w.writerows(rows)
+        else:
+            for r in rows:
+                buf.write(json.dumps(dict(zip(cols, r)), ensure_ascii=False))
+                buf.write("\n")
+        data = buf.getvalue().encode("utf-8")
+        if gz:
+            data = gz.compress(data)
+        if data:
+            yield data
+    if gz:
+        yield gz.flush()
+
+@api.get("/export/{tabela}")
+async def export_tabela(tabela: str, request: Request, fmt: str = "csv", since: str | None = None, gzip: int = 0):
+    auth = request.headers.get("authorization") or ""
+    if not EXPORT_TOKEN or not hmac.compare_digest(auth, f"Bearer {EXPORT_TOKEN}"):
+        raise HTTPException(status_code=403, detail="forbidden")
+    if tabela not in EXPORTS:
+        raise HTTPException(status_code=404, detail="tabela desconhecida")
+    if fmt not in {"csv", "ndjson"}:
+        raise HTTPException(status_code=400, detail="fmt deve ser csv ou ndjson")
+    try:
+        desde = _parse_since(since) if since else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="since deve ser uma data ISO 8601")
+
+    filename = f"{tabela}.{fmt}" + (".gz" if gzip else "")
+    media = "text/csv; charset=utf-8" if fmt == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _export_stream(tabela, fmt, desde, bool(gzip)),
+        media_type="application/gzip" if gzip else media,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
 # ========= CRYPTO PAY HELPERS =========
 def cryptopay_call(method: str, payload: dict):
+    t0 = time.perf_counter()
     try:
         r = requests.post(
             f"{CRYPTOPAY_API}/{method}",
             json=payload,
             headers={"Crypto-Pay-API-Token": CRYPTOPAY_TOKEN},
-            timeout=30
+            timeout=CRYPTOPAY_TIMEOUT
         )
         ct = r.headers.get("content-type","")
         data = r.json() if "application/json" in ct else {"ok": False, "description": r.text}
     except Exception as e:
+        CRYPTOPAY_ERRORS.inc(method, "network")
         raise RuntimeError(f"CryptoPay network error on {method}: {e}")
+    finally:
+        dt = time.perf_counter() - t0
+        CRYPTOPAY_SECONDS.observe(dt, method)
+        _update_stats_add("cryptopay", dt)
 
     if not data.get("ok"):
+        CRYPTOPAY_ERRORS.inc(method, "api")
         raise RuntimeError(f"CryptoPay error on {method}: {data}")
     return data["result"]
 
+CRYPTOPAY_PAGE = 1000        # máximo de itens por página nos get* do Crypto Pay
+CRYPTOPAY_MAX_PAGES = int(os.getenv("CRYPTOPAY_MAX_PAGES", "20"))
+
+def cryptopay_data(s: str | None) -> datetime | None:
+    """Datas do Crypto Pay (ISO 8601 em UTC, com 'Z') → datetime com fuso."""
+    if not s:
+        return None
+    try:
+        return datetime.fromisoformat(s.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+def cryptopay_listar(method: str, params: dict, campo_data: str, desde: datetime,
+                     achou=None) -> tuple[list[dict], bool]:
+    """
+    Pagina um get* do Crypto Pay (que lista do mais novo para o mais antigo)
+    até uma página inteira ficar antes de `desde`, a página vir incompleta ou
+    `achou(itens)` dizer que já basta. Custa uma chamada por página da janela,
+    não uma por item procurado. Retorna (itens, truncado): truncado quando
+    parou em CRYPTOPAY_MAX_PAGES ainda dentro da janela — "não achei" então
+    não prova nada.
+    """
+    itens, offset = [], 0
+    for _ in range(CRYPTOPAY_MAX_PAGES):
+        res = cryptopay_call(method, {**params, "offset": offset, "count": CRYPTOPAY_PAGE})
+        pagina = res.get("items", []) if isinstance(res, dict) else (res or [])
+        itens.extend(pagina)
+        if len(pagina) < CRYPTOPAY_PAGE or (achou and achou(itens)):
+            break
+        datas = [cryptopay_data(i.get(campo_data)) for i in pagina]
+        if all(d is not None and d < desde for d in datas):
+            break
+        offset += len(pagina)
+    else:
+        logging.warning("[cryptopay] %s: parou em %s páginas sem sair da janela", method, CRYPTOPAY_MAX_PAGES)
+        return itens, True
+    return itens, False
+
 def get_app_balances():
     return cryptopay_call("getBalance", {})
 
-def criar_invoice_cryptopay(user_id: int, valor_reais: float) -> str:
+# ===== Cofre do App: cache do getBalance + reservas locais =====
+# O saldo do app é atualizado em background; no caminho do usuário, a decisão
+# é local: disponível no último snapshot menos o que já está reservado em
+# withdrawals (em andamento, ou concluído depois do snapshot).
+APP_BALANCE_REFRESH_SECONDS = int(os.getenv("APP_BALANCE_REFRESH_SECONDS", "30"))
+_APP_BALANCE_CACHE = {"balances": None, "ts": 0.0, "snapshot_at": ""}
+
+def refresh_app_balances():
+    # carimbo tirado ANTES da chamada (1s de folga): tudo que concluir depois
+    # dele continua contando como reservado até o próximo snapshot
+    snapshot_at = (datetime.now(timezone.utc) - timedelta(seconds=1)).strftime("%Y-%m-%d %H:%M:%S")
+    bals = get_app_balances()
+    _APP_BALANCE_CACHE.update(balances=bals, ts=time.time(), snapshot_at=snapshot_at)
+    return bals
+
+async def _refresh_app_balance_loop():
+    while True:
+        try:
+            await asyncio.to_thread(refresh_app_balances)
+        except Exception as e:
+            logging.warning("[cofre] refresh do getBalance falhou: %s", e)
+        await asyncio.sleep(APP_BALANCE_REFRESH_SECONDS)
+
+def cached_app_available(code: str = "TON") -> float | None:
+    bals = _APP_BALANCE_CACHE["balances"]
+    if bals is None:
+        return None
+    for b in bals:
+        if _balance_code(b) == code:
+            return float(b.get("available") or 0)
+    return 0.0
+
+async def reservar_saque(user_id: int, amount_ton: float, wallet: str, idemp: str) -> tuple[int | None, str]:
+    """
+    Numa única transação: confere o cofre em cache menos as reservas, a trava
+    de saque em processamento, debita o saldo TON do usuário e registra o
+    withdrawal já como 'processing'.
+    Retorna (id, "ok") ou (None, motivo) com motivo em {"cofre", "lock", "saldo"}.
+    """
+    avail = cached_app_available("TON")
+    if avail is None:
+        logging.warning("[cofre] sem snapshot do getBalance; saque segue sem checagem do cofre")
+    return await storage().withdrawals.reserve(
+        user_id, amount_ton, wallet, idemp, avail, _APP_BALANCE_CACHE["snapshot_at"]
+    )
+
+async def criar_invoice_cryptopay(user_id: int, valor_reais: float) -> str:
     payload = {
         "currency_type": "fiat",
         "fiat": "BRL",
@@ -432,15 +1275,98 @@ def criar_invoice_cryptopay(user_id: int, valor_reais: float) -> str:
         "payload": str(user_id),
         "description": "Depósito Fazendinha"
     }
-    inv = cryptopay_call("createInvoice", payload)
-    return inv.get("bot_invoice_url") or inv.get("pay_url")
+    if INVOICE_EXPIRES_IN > 0:
+        payload["expires_in"] = INVOICE_EXPIRES_IN
+    inv = await asyncio.to_thread(cryptopay_call, "createInvoice", payload)
+    url = inv.get("bot_invoice_url") or inv.get("pay_url")
+    INVOICES.put(user_id, valor_reais, str(inv.get("invoice_id")), url)
+    # guardada para a conferência periódica (se o webhook não chegar)
+    try:
+        await storage().payments.record_invoice(str(inv["invoice_id"]), user_id, valor_reais, url)
+    except Exception as e:
+        logging.warning("[cryptopay] invoice %s não foi registrada: %s", inv.get("invoice_id"), e)
+    return url
+
+# ===== Cache de invoices em aberto (depósito) =====
+# Tocar de novo em "R$ 10" (ou no mesmo valor digitado) devolve o link da
+# invoice ainda não paga em vez de criar outra: LRU por (usuário, centavos)
+# com TTL INVOICE_CACHE_TTL, sempre abaixo do expires_in da invoice
+# (INVOICE_EXPIRES_IN) para nunca entregar um link vencido. O crédito da
+# invoice (webhook ou conferência) derruba a entrada; como o webhook pode
+# cair em outro worker, o acerto ainda confere pagamentos no banco (uma
+# leitura local, não uma ida ao Crypto Pay). Toques simultâneos esperam a
+# mesma criação.
+INVOICE_EXPIRES_IN = int(os.getenv("INVOICE_EXPIRES_IN", "3600"))
+INVOICE_CACHE_TTL = float(os.getenv("INVOICE_CACHE_TTL", "900"))
+if INVOICE_EXPIRES_IN > 0:
+    INVOICE_CACHE_TTL = min(INVOICE_CACHE_TTL, INVOICE_EXPIRES_IN - 60)
+INVOICE_CACHE_SIZE = int(os.getenv("INVOICE_CACHE_SIZE", "10000"))
+
+class InvoiceCache:
+    def __init__(self, size: int = INVOICE_CACHE_SIZE, ttl: float = INVOICE_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()   # (uid, centavos) -> (monotonic, invoice_id, url)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _chave(uid: int, reais: float) -> tuple[int, int]:
+        return uid, int(round(reais * 100))
+
+    def get(self, uid: int, reais: float):
+        """(invoice_id, url) ainda dentro do TTL, ou None."""
+        with self._lock:
+            item = self._data.get(self._chave(uid, reais))
+            if item and time.monotonic() - item[0] < self.ttl:
+                self._data.move_to_end(self._chave(uid, reais))
+                return item[1], item[2]
+            return None
+
+    def put(self, uid: int, reais: float, invoice_id: str, url: str):
+        if self.ttl <= 0 or not url:
+            return
+        with self._lock:
+            self._data[self._chave(uid, reais)] = (time.monotonic(), invoice_id, url)
+            self._data.move_to_end(self._chave(uid, reais))
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                INVOICE_CACHE.inc("evict")
+
+    def invalidate(self, uid: int, reais: float, invoice_id: str | None = None):
+        with self._lock:
+            item = self._data.get(self._chave(uid, reais))
+            if item and (invoice_id is None or item[1] == invoice_id):
+                del self._data[self._chave(uid, reais)]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+INVOICES = InvoiceCache()
+_INVOICES_EM_CURSO: dict[tuple[int, int], asyncio.Future] = {}
+
+async def link_deposito(user_id: int, valor_reais: float) -> str:
+    hit = INVOICES.get(user_id, valor_reais)
+    if hit:
+        if not await storage().payments.credited(hit[0]):
+            INVOICE_CACHE.inc("hit")
+            return hit[1]
+        INVOICE_CACHE.inc("paga")
+        INVOICES.invalidate(user_id, valor_reais, hit[0])
+    else:
+        INVOICE_CACHE.inc("miss")
 
-def ensure_user(user_id: int):
-    with db_conn() as c:
-        c.execute(
-            "INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)",
-            (user_id, datetime.now().isoformat())
-        )
+    chave = InvoiceCache._chave(user_id, valor_reais)
+    fut = _INVOICES_EM_CURSO.get(chave)
+    if fut is None:
+        fut = asyncio.ensure_future(criar_invoice_cryptopay(user_id, valor_reais))
+        _INVOICES_EM_CURSO[chave] = fut
+        fut.add_done_callback(lambda _: _INVOICES_EM_CURSO.pop(chave, None))
+    return await asyncio.shield(fut)
+
+async def ensure_user(user_id: int):
+    if await storage().users.ensure(user_id):
+        invalidate_saldos(user_id)
 
 # === TECLADOS / BOTÕES ===
 def sacar_keyboard():
@@ -492,35 +1418,18 @@ def _balance_code(b: dict) -> str:
         .upper()
     )
 
-def cb_new(user_id: int, action: str, payload: str = "", ttl: int = 600) -> str:
-    token = uuid.uuid4().hex[:8]
-    exp = int(time.time()) + ttl
-    with db_conn() as c:
-        c.execute(
-            "INSERT OR REPLACE INTO cb_tokens (id, user_id, action, payload, expires_at, used, created_at) "
-            "VALUES (?, ?, ?, ?, ?, 0, ?)",
-            (token, user_id, action, payload, exp, _iso_now())
-        )
-    return token
+async def cb_new(user_id: int, action: str, payload: str = "", ttl: int = 600) -> str:
+    return await storage().tokens.new(user_id, action, payload, ttl)
 
-def cb_check_and_use(token: str, user_id: int, action: str) -> tuple[bool, str | None, str]:
-    now = int(time.time())
-    with db_conn() as c:
-        row = c.execute(
-            "SELECT user_id, action, payload, expires_at, used FROM cb_tokens WHERE id=?",
-            (token,)
-        ).fetchone()
-        if not row:
-            return False, None, "Essa interação expirou. Por favor, tente novamente."
-        if int(row["user_id"]) != int(user_id) or row["action"] != action:
-            return False, None, "Essa interação não é mais válida. Por favor, tente novamente."
-        if int(row["used"]) == 1:
-            return False, None, "Essa interação já foi usada. Por favor, tente novamente."
-        if int(row["expires_at"]) < now:
-            return False, None, "Essa interação expirou. Por favor, tente novamente."
-        c.execute("UPDATE cb_tokens SET used=1 WHERE id=?", (token,))
-        payload = row["payload"] if row["payload"] is not None else ""
-        return True, payload, ""
+_CB_ERROS = {
+    "expirado": "Essa interação expirou. Por favor, tente novamente.",
+    "invalido": "Essa interação não é mais válida. Por favor, tente novamente.",
+    "usado":    "Essa interação já foi usada. Por favor, tente novamente.",
+}
+
+async def cb_check_and_use(token: str, user_id: int, action: str) -> tuple[bool, str | None, str]:
+    ok, payload, motivo = await storage().tokens.use(token, user_id, action)
+    return ok, payload, _CB_ERROS.get(motivo, "")
 
 def _fmt_tempo_restante(delta: timedelta) -> str:
     # arredonda para cima os minutos se houver segundos
@@ -556,15 +1465,8 @@ def _produzido_desde(rendimento_dia: float, quantidade: int, ultima_coleta_iso:
     por_seg = (rendimento_dia * quantidade) / 86400.0
     return max(0.0, por_seg * segundos)
 
-def get_producao_usuario(uid: int):
-    with db_conn() as c:
-        rows = c.execute("""
-            SELECT i.animal, i.quantidade, i.ultima_coleta, a.rendimento, a.emoji
-            FROM inventario i
-            JOIN animais a ON a.nome = i.animal
-            WHERE i.telegram_id = ?
-            ORDER BY a.preco ASC
-        """, (uid,)).fetchall()
+async def get_producao_usuario(uid: int):
+    rows = await storage().inventory.production(uid)
 
     itens, total = [], 0.0
     for r in rows:
@@ -578,53 +1480,101 @@ def get_producao_usuario(uid: int):
         total += prod
     return itens, total
 
-def set_wallet(user_id: int, wallet: str):
-    ensure_user(user_id)
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET carteira_ton=? WHERE telegram_id=?", (wallet, user_id))
-
-def get_wallet(user_id: int):
-    with db_conn() as c:
-        r = c.execute("SELECT carteira_ton FROM usuarios WHERE telegram_id=?", (user_id,)).fetchone()
-        return r["carteira_ton"] if r and r["carteira_ton"] else None
-
-def get_balances(user_id: int):
-    with db_conn() as c:
-        r = c.execute("SELECT saldo_cash, saldo_cash_pagamentos, saldo_ton FROM usuarios WHERE telegram_id=?", (user_id,)).fetchone()
-        if not r: return 0.0, 0.0, 0.0
-        return r["saldo_cash"], r["saldo_cash_pagamentos"], r["saldo_ton"]
-
-def get_user_materiais(user_id: int) -> float:
-    with db_conn() as c:
-        r = c.execute(
-            "SELECT COALESCE(saldo_materiais,0) AS m FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-        return float(r["m"]) if r else 0.0
-
-def debit_cash_payments_and_credit_ton(user_id: int, amount_ton: float, ton_brl_price: float, cash_por_real: int):
-    cash_needed = amount_ton * ton_brl_price * cash_por_real
-    with db_conn() as c:
-        row = c.execute("SELECT saldo_cash_pagamentos, saldo_ton FROM usuarios WHERE telegram_id=?", (user_id,)).fetchone()
-        if not row:
-            raise ValueError("Usuário não encontrado.")
-        if row["saldo_cash_pagamentos"] + 1e-9 < cash_needed:
-            raise ValueError("Saldo de pagamentos insuficiente.")
-        c.execute(
-            "UPDATE usuarios SET saldo_cash_pagamentos=saldo_cash_pagamentos-?, saldo_ton=saldo_ton+? WHERE telegram_id=?",
-            (cash_needed, amount_ton, user_id)
-        )
-
-def create_withdraw(user_id: int, requested_ton: float, wallet: str, idemp: str):
-    with db_conn() as c:
-        c.execute("""INSERT INTO withdrawals (user_id, requested_ton, wallet, status, idempotency_key)
-                     VALUES (?,?,?,?,?)""", (user_id, requested_ton, wallet, 'pending', idemp))
-        row = c.execute("SELECT last_insert_rowid() id").fetchone()
-        return row["id"] if row else None
-
-def set_withdraw_status(wid: int, status: str):
-    with db_conn() as c:
-        c.execute("UPDATE withdrawals SET status=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (status, wid))
+async def set_wallet(user_id: int, wallet: str):
+    await storage().users.set_wallet(user_id, wallet)
+    invalidate_saldos(user_id)
+
+async def get_wallet(user_id: int):
+    return await storage().users.wallet(user_id)
+
+# ===== Cache de saldos (leitura) =====
+# Snapshot das colunas de saldo por telegram_id, LRU limitado a SALDOS_CACHE_SIZE
+# com TTL curto. Só para telas (start, saldo, trocas, menus de swap/saque):
+# quem decide débito/crédito lê direto do banco. Todo UPDATE em colunas de saldo
+# chama invalidate_saldos() depois do commit; o TTL cobre escritas feitas por
+# outros processos (workers) e por SQL manual.
+SALDOS_CACHE_SIZE = int(os.getenv("SALDOS_CACHE_SIZE", "10000"))
+SALDOS_CACHE_TTL = float(os.getenv("SALDOS_CACHE_TTL", "5"))
+
+class SaldosCache:
+    def __init__(self, size: int = SALDOS_CACHE_SIZE, ttl: float = SALDOS_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()   # uid -> (monotonic, snapshot)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, uid: int):
+        with self._lock:
+            item = self._data.get(uid)
+            if item and time.monotonic() - item[0] < self.ttl:
+                self._data.move_to_end(uid)
+                self.hits += 1
+                BALANCE_CACHE.inc("hit")
+                return item[1]
+            self.misses += 1
+            BALANCE_CACHE.inc("miss")
+            return None
+
+    def put(self, uid: int, snap: dict):
+        with self._lock:
+            self._data[uid] = (time.monotonic(), snap)
+            self._data.move_to_end(uid)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+                BALANCE_CACHE.inc("evict")
+
+    def invalidate(self, *uids: int):
+        with self._lock:
+            for uid in uids:
+                self._data.pop(uid, None)
+
+    def invalidate_range(self, de: int, ate: int):
+        with self._lock:
+            for uid in [u for u in self._data if de <= u <= ate]:
+                del self._data[uid]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+SALDOS = SaldosCache()
+
+def invalidate_saldos(*uids: int):
+    SALDOS.invalidate(*uids)
+
+async def get_saldos(user_id: int) -> dict:
+    snap = SALDOS.get(user_id)
+    if snap is not None:
+        return snap
+    snap = await storage().users.balances(user_id) or dict(SALDOS_VAZIOS)
+    SALDOS.put(user_id, snap)
+    return snap
+
+async def get_balances(user_id: int):
+    s = await get_saldos(user_id)
+    return s["cash"], s["pag"], s["ton"]
+
+async def get_user_materiais(user_id: int) -> float:
+    return await storage().users.materials(user_id)
+
+# O handler do saque e a reconciliação (saques presos) podem terminar o mesmo
+# withdrawal: os dois passam por settle(), que só mexe em saque ainda em
+# andamento. Quem chega depois recebe False e não estorna nem conclui de novo.
+async def concluir_saque(wid: int) -> bool:
+    return (await storage().withdrawals.settle([wid], []))["done"] == 1
+
+async def estornar_saque(wid: int, user_id: int) -> bool:
+    estornos = (await storage().withdrawals.settle([], [wid]))["estornos"]
+    invalidate_saldos(user_id)
+    return bool(estornos)
+
+SAQUE_JA_FINALIZADO = "ℹ️ Este saque já foi finalizado pela conferência automática. Confira seu saldo TON."
 
 class CryptoPayError(Exception):
     pass
@@ -648,8 +1598,8 @@ async def cryptopay_transfer_ton_to_user(amount_ton: float, crypto_user_id: int,
         "Idempotency-Key": idempotency_key
     }
     payload = {"asset": "TON", "amount": str(amount_ton), "user_id": crypto_user_id}
-    async with httpx.AsyncClient(timeout=30) as cli:
-        r = await cli.post("https://pay.crypt.bot/api/transfer", headers=headers, json=payload)
+    async with httpx.AsyncClient(timeout=CRYPTOPAY_TIMEOUT) as cli:
+        r = await cli.post(f"{CRYPTOPAY_API}/transfer", headers=headers, json=payload)
         data = r.json() if r.headers.get("content-type","").startswith("application/json") else {"ok": False, "description": r.text}
         if r.status_code != 200 or not data.get("ok"):
             raise CryptoPayError(f"transfer falhou: {data}")
@@ -659,6 +1609,78 @@ def criar_check_ton(amount_ton: float) -> dict:
     payload = {"asset": "TON", "amount": f"{amount_ton:.9f}"}
     return cryptopay_call("createCheck", payload)
 
+# ===== Cooldowns (bônus diário e recompensas com intervalo) =====
+# Índice em memória uid -> próximo instante liberado, LRU limitado a
+# COOLDOWN_INDEX_SIZE. Clique antes da hora é recusado sem abrir conexão; o
+# resgate em si é um UPDATE condicional (... WHERE ultimo <= agora - intervalo
+# RETURNING saldo), então o banco é quem decide: o índice de um worker só fica
+# desatualizado "para mais" (outro worker resgatou) e aí o UPDATE recusa e
+# corrige a entrada. Reset de admin chama esquecer() neste processo.
+COOLDOWN_INDEX_SIZE = int(os.getenv("COOLDOWN_INDEX_SIZE", "50000"))
+
+class Cooldown:
+    def __init__(self, campo: str, intervalo: timedelta, saldo: str = "cash", size: int = COOLDOWN_INDEX_SIZE):
+        self.campo = campo          # chave de CAMPOS_COOLDOWN
+        self.intervalo = intervalo
+        self.saldo = saldo          # chave de CAMPOS_SALDO
+        self.size = size
+        self._proximo = OrderedDict()   # uid -> datetime | None (None = liberado)
+        self._lock = threading.Lock()
+
+    def _lembrar(self, uid: int, ultimo: str | None):
+        try:
+            proximo = datetime.fromisoformat(ultimo) + self.intervalo if ultimo else None
+        except ValueError:
+            proximo = None
+        with self._lock:
+            self._proximo[uid] = proximo
+            self._proximo.move_to_end(uid)
+            while len(self._proximo) > self.size:
+                self._proximo.popitem(last=False)
+        return proximo
+
+    def esquecer(self, *uids: int):
+        with self._lock:
+            for uid in uids:
+                self._proximo.pop(uid, None)
+
+    def falta_local(self, uid: int, agora: datetime | None = None) -> timedelta | None:
+        """Quanto falta segundo o índice; None se liberado ou se o uid não está indexado."""
+        with self._lock:
+            if uid not in self._proximo:
+                return None
+            self._proximo.move_to_end(uid)
+            proximo = self._proximo[uid]
+        agora = agora or datetime.now()
+        return proximo - agora if proximo and proximo > agora else None
+
+    async def falta(self, uid: int, agora: datetime | None = None) -> timedelta | None:
+        with self._lock:
+            conhecido = uid in self._proximo
+        if not conhecido:
+            self._lembrar(uid, await storage().users.last_claim(uid, self.campo))
+        return self.falta_local(uid, agora)
+
+    async def resgatar(self, uid: int, valor: float, agora: datetime | None = None):
+        """(novo saldo, None) se creditou; (None, quanto falta) se ainda não pode."""
+        agora = agora or datetime.now()
+        falta = self.falta_local(uid, agora)
+        if falta:
+            COOLDOWN_CLAIMS.inc(self.campo, "indice")
+            return None, falta
+        novo, ultimo = await storage().users.claim_reward(
+            uid, self.campo, self.saldo, valor, agora.isoformat(), (agora - self.intervalo).isoformat()
+        )
+        if novo is not None:
+            self._lembrar(uid, agora.isoformat())
+            COOLDOWN_CLAIMS.inc(self.campo, "ok")
+            return novo, None
+        proximo = self._lembrar(uid, ultimo)
+        COOLDOWN_CLAIMS.inc(self.campo, "banco")
+        return None, (proximo - agora if proximo and proximo > agora else timedelta(0))
+
+BONUS_DIARIO = Cooldown("bonus", timedelta(hours=24))
+
 # ===== Assinatura do webhook (oficial) =====
 def verify_cryptopay_signature(body: bytes, signature: str, token: str) -> bool:
     secret = hashlib.sha256((token or "").encode()).digest()
@@ -666,7 +1688,7 @@ def verify_cryptopay_signature(body: bytes, signature: str, token: str) -> bool:
     return hmac.compare_digest((signature or "").lower(), computed.lower())
 
 # ========= WEBHOOK CRYPTO PAY =========
-@app.post("/webhook/cryptopay")
+@api.post("/webhook/cryptopay")
 async def cryptopay_webhook(request: Request):
     signature = (
         request.headers.get("Crypto-Pay-API-Signature")
@@ -686,18 +1708,26 @@ async def cryptopay_webhook(request: Request):
 
     payload = data.get("payload") or {}
     inv = payload.get("invoice") or payload
+    await creditar_invoice_paga(inv, "webhook")
+    return {"ok": True}
 
+async def creditar_invoice_paga(inv: dict, origem: str) -> bool:
+    """
+    Credita uma invoice paga (objeto Invoice do Crypto Pay), venha ela do
+    webhook ou da conferência periódica. Idempotente por invoice_id: True só
+    para quem creditou de fato.
+    """
     invoice_id = str(inv.get("invoice_id") or inv.get("id") or "").strip()
     if not invoice_id:
-        logging.warning("[cryptopay] webhook sem invoice_id: %r", data)
-        return {"ok": True}
+        logging.warning("[cryptopay] %s sem invoice_id: %r", origem, inv)
+        return False
 
     user_id_str = str(inv.get("payload") or inv.get("custom_payload") or "").strip()
     try:
         user_id = int(user_id_str)
     except Exception:
-        logging.warning("[cryptopay] webhook sem user_id(payload): %r", data)
-        return {"ok": True}
+        logging.warning("[cryptopay] %s sem user_id(payload): %r", origem, inv)
+        return False
 
     raw_reais = (
         inv.get("price_amount") or
@@ -712,59 +1742,38 @@ async def cryptopay_webhook(request: Request):
         reais = 0.0
 
     cash = int(round(reais * CASH_POR_REAL))
-
-    # grava pagamento e credita
-    with db_conn() as c:
+    # o link dessa invoice não serve mais para um novo depósito
+    INVOICES.invalidate(user_id, reais, invoice_id)
+
+    # grava pagamento e credita (idempotente por invoice_id)
+    res = await storage().payments.credit_invoice(invoice_id, user_id, reais, cash, REF_PCT)
+    # paga (creditada agora ou antes): sai da conferência, venha de onde vier
+    await storage().payments.close_invoices([invoice_id], "paid")
+    if res is None:
+        return False
+    INVOICES_CREDITED.inc(origem)
+    if origem != "webhook":
+        logging.warning("[cryptopay] invoice %s creditada via %s (webhook não chegou)", invoice_id, origem)
+    ref_id = res["ref_id"]
+    if ref_id and res["bonus"] > 0:
         try:
-            c.execute(
-                "INSERT INTO pagamentos (invoice_id, user_id, valor_reais, cash, criado_em) VALUES (?,?,?,?,?)",
-                (invoice_id, user_id, reais, cash, datetime.now().isoformat())
-            )
-        except sqlite3.IntegrityError:
-            return {"ok": True}
-
-        c.execute(
-            "INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)",
-            (user_id, datetime.now().isoformat())
-        )
-
-        if cash > 0:
-            c.execute(
-                "UPDATE usuarios SET saldo_cash = COALESCE(saldo_cash,0) + ? WHERE telegram_id=?",
-                (cash, user_id)
+            await get_bot().send_message(
+                ref_id,
+                f"🎁 Bônus de indicação: +{res['bonus']} cash (amigo depositou R$ {reais:.2f})."
             )
+        except Exception:
+            pass
 
-        row = c.execute("SELECT por FROM indicacoes WHERE quem=?", (user_id,)).fetchone()
-        if row:
-            ref_id = int(row["por"])
-            bonus = int(round(cash * REF_PCT / 100.0))
-            if bonus > 0:
-                c.execute(
-                    "INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)",
-                    (ref_id, datetime.now().isoformat())
-                )
-                c.execute(
-                    "UPDATE usuarios SET saldo_cash = COALESCE(saldo_cash,0) + ? WHERE telegram_id=?",
-                    (bonus, ref_id)
-                )
-                try:
-                    await bot.send_message(
-                        ref_id,
-                        f"🎁 Bônus de indicação: +{bonus} cash (amigo depositou R$ {reais:.2f})."
-                    )
-                except Exception:
-                    pass
-
+    invalidate_saldos(user_id, *([ref_id] if ref_id else []))
     if cash > 0:
         try:
-            await bot.send_message(
+            await get_bot().send_message(
                 user_id,
                 f"✅ Pagamento confirmado!\nR$ {reais:.2f} → {cash} cash creditados."
             )
         except Exception:
             pass
-
-    return {"ok": True}
+    return True
 
 # ========= UI / MENUS =========
 def kb_voltar():
@@ -787,35 +1796,61 @@ def menu():
 
 
 # ========= HANDLERS =========
-@dp.message(Command('start'))
+# ===== Roteamento dos menus por tabela =====
+# Os textos exatos dos botões vão direto para o handler por um dict lookup, em
+# vez de passar pela cadeia de filtros do aiogram (um F.text == ... por handler,
+# avaliados em sequência). `states` reproduz em que estados FSM o handler
+# antigo ganhava a mensagem; fora deles ela segue pela cadeia normal
+# (handlers de estado, parse de valor, "trocar N"...).
+ANY_STATE = None
+
+class _MenuRoute:
+    __slots__ = ("handler", "states", "wants_state")
+
+    def __init__(self, handler, states):
+        self.handler = handler
+        self.states = states
+        self.wants_state = "state" in inspect.signature(handler).parameters
+
+MENU_ROUTES: dict[str, _MenuRoute] = {}
+
+def menu_route(*texts: str, states=ANY_STATE):
+    def deco(fn):
+        route = _MenuRoute(fn, frozenset(states) if states is not ANY_STATE else ANY_STATE)
+        for t in texts:
+            MENU_ROUTES[t] = route
+        return fn
+    return deco
+
+def _menu_filter(msg: types.Message, raw_state: str | None = None):
+    route = MENU_ROUTES.get(msg.text)
+    if route is None or (route.states is not ANY_STATE and raw_state not in route.states):
+        return False
+    return {"menu_route": route}
+
+@router.message(_menu_filter)
+async def menu_dispatch(msg: types.Message, state: FSMContext, menu_route: _MenuRoute):
+    if menu_route.wants_state:
+        return await menu_route.handler(msg, state)
+    return await menu_route.handler(msg)
+
+@router.message(Command('start'))
 async def start(msg: types.Message):
     user_id = msg.from_user.id
-    with db_conn() as c:
-        c.execute(
-            "INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)",
-            (user_id, datetime.now().isoformat())
-        )
+    # voltou a falar com o bot → volta a receber broadcasts
+    novo = await storage().users.touch(user_id)
 
     parts = (msg.text or "").split()
     ref_id = None
     if len(parts) >= 2 and parts[0] == '/start' and parts[1].isdigit():
         ref_id = int(parts[1])
     if ref_id and ref_id != user_id:
-        with db_conn() as c:
-            c.execute(
-                "INSERT OR IGNORE INTO indicacoes (quem, por, criado_em) VALUES (?, ?, ?)",
-                (user_id, ref_id, datetime.now().isoformat())
-            )
+        await storage().referrals.register(user_id, ref_id)
 
-    with db_conn() as c:
-        row = c.execute("SELECT COALESCE(saldo_cash,0), COALESCE(saldo_cash_pagamentos,0), COALESCE(saldo_ton,0) FROM usuarios WHERE telegram_id=?", (user_id,)).fetchone()
-        saldo_cash, saldo_pag, saldo_ton = (row[0], row[1], row[2]) if row else (0, 0, 0)
-
-        rendimento_dia = c.execute("""
-            SELECT SUM(quantidade * rendimento)
-            FROM inventario JOIN animais ON inventario.animal = animais.nome
-            WHERE inventario.telegram_id=?
-        """, (user_id,)).fetchone()[0] or 0
+    if novo:
+        invalidate_saldos(user_id)
+    saldo_cash, saldo_pag, saldo_ton = await get_balances(user_id)
+    rendimento_dia = await storage().inventory.daily_yield(user_id)
 
     texto = (
         "🌾 *Bem-vindo à Fazenda TON!*\n\n"
@@ -827,23 +1862,13 @@ async def start(msg: types.Message):
     ).replace(",", ".")
     await msg.answer(texto, reply_markup=menu(), parse_mode="Markdown")
 
-@dp.message(F.text == "💰 Meu Saldo")
+@menu_route("💰 Meu Saldo")
 async def saldo(msg: types.Message):
-    user_id = msg.from_user.id
-    with db_conn() as c:
-        r = c.execute("""
-            SELECT 
-                COALESCE(saldo_cash,0)               AS cash_disp,
-                COALESCE(saldo_cash_pagamentos,0)    AS cash_pag,
-                COALESCE(saldo_ton,0)                AS saldo_ton,
-                COALESCE(saldo_materiais,0)          AS mats
-            FROM usuarios WHERE telegram_id=?
-        """, (user_id,)).fetchone()
-
-    cash_disp   = r["cash_disp"] if r else 0
-    cash_pag    = r["cash_pag"]  if r else 0
-    saldo_ton   = r["saldo_ton"] if r else 0
-    materiais   = r["mats"]      if r else 0
+    r = await get_saldos(msg.from_user.id)
+    cash_disp   = r["cash"]
+    cash_pag    = r["pag"]
+    saldo_ton   = r["ton"]
+    materiais   = r["mats"]
 
     texto = (
         "📊 *Seus saldos*\n\n"
@@ -856,30 +1881,14 @@ async def saldo(msg: types.Message):
     )
     await msg.answer(texto, parse_mode="Markdown")
 
-@dp.message(F.text.in_(["🎁 Bonus", "🎁Bonus"]))
+@menu_route("🎁 Bonus", "🎁Bonus")
 async def bonus_menu(msg: types.Message):
     user_id = msg.from_user.id
-    ensure_user(user_id)
+    await ensure_user(user_id)
 
-    # Lê último bônus e calcula o que falta
-    with db_conn() as c:
-        r = c.execute(
-            "SELECT ultimo_bonus FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-        ultimo = (r["ultimo_bonus"] if r else None)
-
-    agora = datetime.now()
-    faltam_txt = ""
-    if ultimo:
-        try:
-            dt_last = datetime.fromisoformat(ultimo)
-            proximo = dt_last + timedelta(hours=24)
-            if proximo > agora:
-                faltam = proximo - agora
-                faltam_txt = _fmt_tempo_restante(faltam)
-        except Exception:
-            pass
+    # quanto falta (índice em memória; só vai ao banco na primeira vez)
+    faltam = await BONUS_DIARIO.falta(user_id)
+    faltam_txt = _fmt_tempo_restante(faltam) if faltam else ""
 
     texto = (
         "<b>Bônus diário</b>\n\n"
@@ -891,14 +1900,14 @@ async def bonus_menu(msg: types.Message):
         texto += f"\n\n⏳ Falta: <b>{faltam_txt}</b> para você poder pegar novamente."
 
     # botão inline com timeout de 30s (via cb_tokens)
-    tok = cb_new(user_id, action="daily_bonus", payload="get", ttl=30)
+    tok = await cb_new(user_id, action="daily_bonus", payload="get", ttl=30)
     kb = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="🎁Pegar Bonus🎁", callback_data=f"bonus:{tok}")]
     ])
 
     await msg.answer(texto, parse_mode="HTML", reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("bonus:"))
+@router.callback_query(F.data.startswith("bonus:"))
 async def pegar_bonus_cb(call: types.CallbackQuery):
     user_id = call.from_user.id
 
@@ -908,49 +1917,31 @@ async def pegar_bonus_cb(call: types.CallbackQuery):
     except Exception:
         return await call.answer("Essa interação expirou. Por favor, tente novamente.", show_alert=True)
 
-    ok, payload, err = cb_check_and_use(token, user_id, action="daily_bonus")
-    if not ok:
-        return await call.answer(err, show_alert=True)
+    async def ainda_nao(faltam: timedelta):
+        # mantém a mensagem pedida (20 horas) + mostra quanto falta
+        await call.message.answer(
+            "⚠️ Você já recebeu um bônus nas últimas 20 horas.\n"
+            f"⏳ Tente novamente em: <b>{_fmt_tempo_restante(faltam)}</b>.",
+            parse_mode="HTML"
+        )
+        return await call.answer()
 
-    # Re-checa janela de 24h (evita corrida)
-    agora = datetime.now()
-    with db_conn() as c:
-        r = c.execute(
-            "SELECT COALESCE(saldo_cash,0) AS cash, ultimo_bonus FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-        saldo_cash = float(r["cash"]) if r else 0.0
-        ultimo = r["ultimo_bonus"] if r else None
+    # clique antes da hora: recusa pelo índice, sem tocar no banco
+    faltam = BONUS_DIARIO.falta_local(user_id)
+    if faltam:
+        return await ainda_nao(faltam)
 
-    if ultimo:
-        try:
-            dt_last = datetime.fromisoformat(ultimo)
-            proximo = dt_last + timedelta(hours=24)
-            if proximo > agora:
-                # mantém a mensagem pedida (20 horas) + mostra quanto falta
-                faltam = proximo - agora
-                faltam_txt = _fmt_tempo_restante(faltam)
-                await call.message.answer(
-                    "⚠️ Você já recebeu um bônus nas últimas 20 horas.\n"
-                    f"⏳ Tente novamente em: <b>{faltam_txt}</b>.",
-                    parse_mode="HTML"
-                )
-                return await call.answer()
-        except Exception:
-            pass
+    ok, payload, err = await cb_check_and_use(token, user_id, action="daily_bonus")
+    if not ok:
+        return await call.answer(err, show_alert=True)
 
-    # Tudo ok → sorteia 10..100 e credita SOMENTE em saldo_cash
+    # sorteia 10..100 e credita SOMENTE em saldo_cash; a janela de 24h é
+    # re-checada no próprio UPDATE (dois cliques/workers ao mesmo tempo: um só credita)
     valor = random.randint(10, 100)
-    novo_saldo = saldo_cash + valor
-
-    with db_conn() as c:
-        c.execute(
-            "UPDATE usuarios SET saldo_cash = COALESCE(saldo_cash,0) + ?, ultimo_bonus = ? WHERE telegram_id=?",
-            (valor, agora.isoformat(), user_id)
-        )
-        r2 = c.execute("SELECT COALESCE(saldo_cash,0) AS s FROM usuarios WHERE telegram_id=?",
-                       (user_id,)).fetchone()
-        novo_saldo = float(r2["s"]) if r2 else novo_saldo
+    novo_saldo, faltam = await BONUS_DIARIO.resgatar(user_id, valor)
+    if novo_saldo is None:
+        return await ainda_nao(faltam)
+    invalidate_saldos(user_id)
 
     await call.message.answer(
         "🎉 <b>Bônus resgatado!</b>\n\n"
@@ -963,12 +1954,10 @@ async def pegar_bonus_cb(call: types.CallbackQuery):
 
 
 
-@dp.message(F.text == "🛒 Comprar")
+@menu_route("🛒 Comprar")
 async def comprar(msg: types.Message):
     await msg.answer("Escolha um animal para comprar:", reply_markup=kb_voltar())
-    with db_conn() as c:
-        rows = c.execute("SELECT nome, preco, rendimento, emoji FROM animais ORDER BY preco ASC").fetchall()
-    for nome, preco, rendimento, emoji in [(r["nome"], r["preco"], r["rendimento"], r["emoji"]) for r in rows]:
+    for nome, preco, rendimento, emoji in [(r["nome"], r["preco"], r["rendimento"], r["emoji"]) for r in get_animais()]:
         card = (
             f"{emoji} *{nome}*\n"
             f"📈 Rende: *{int(rendimento):,}* Materiais/dia\n"
@@ -977,57 +1966,38 @@ async def comprar(msg: types.Message):
         kb_inline = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text=f"Comprar {emoji}", callback_data=f"buy:{nome}")]])
         await msg.answer(card, reply_markup=kb_inline, parse_mode="Markdown")
 
-@dp.callback_query(F.data.startswith("buy:"))
+@router.callback_query(F.data.startswith("buy:"))
 async def comprar_animal_cb(call: types.CallbackQuery):
     nome = call.data.split("buy:", 1)[1]
     user_id = call.from_user.id
 
-    with db_conn() as c:
-        r = c.execute("SELECT preco, rendimento, emoji FROM animais WHERE nome=?", (nome,)).fetchone()
-        if not r:
-            await call.answer("Animal não encontrado.", show_alert=True)
-            return
-        preco, rendimento, emoji = r["preco"], r["rendimento"], r["emoji"]
-
-        row = c.execute("SELECT saldo_cash FROM usuarios WHERE telegram_id=?", (user_id,)).fetchone()
-        saldo = row["saldo_cash"] if row else 0
-
-        if saldo < preco:
-            await call.message.answer(f"⚠️ Cash insuficientes para comprar {emoji}!")
-            await call.answer("Saldo insuficiente", show_alert=False)
-            return
+    r = get_animal(nome)
+    if not r:
+        await call.answer("Animal não encontrado.", show_alert=True)
+        return
+    preco, rendimento, emoji = r["preco"], r["rendimento"], r["emoji"]
 
-        c.execute("UPDATE usuarios SET saldo_cash=saldo_cash-? WHERE telegram_id=?", (preco, user_id))
-        agora = datetime.now().isoformat()
-        c.execute(
-            "INSERT OR IGNORE INTO inventario (telegram_id, animal, quantidade, ultima_coleta) VALUES (?, ?, 0, ?)",
-            (user_id, nome, agora)
-        )
-        c.execute(
-            "UPDATE inventario SET quantidade=quantidade+1, ultima_coleta=? WHERE telegram_id=? AND animal=?",
-            (agora, user_id, nome)
-        )
+    if not await storage().inventory.buy(user_id, nome, preco, datetime.now().isoformat()):
+        await call.message.answer(f"⚠️ Cash insuficientes para comprar {emoji}!")
+        await call.answer("Saldo insuficiente", show_alert=False)
+        return
+    invalidate_saldos(user_id)
 
     await call.message.answer(f"✅ Você comprou com sucesso {emoji}!")
     await call.answer()
 
-@dp.message(F.text == "⬅️ Voltar")
+@menu_route("⬅️ Voltar")
 async def voltar(msg: types.Message, state: FSMContext):
     await state.clear()          # <<< garante sair de qualquer FSM
     await start(msg)
 
 
-@dp.message(F.text == "🐾 Meus Animais")
+@menu_route("🐾 Meus Animais")
 async def meus_animais(msg: types.Message):
     user_id = msg.from_user.id
-    with db_conn() as c:
-        c.execute("""
-            UPDATE inventario
-               SET ultima_coleta = COALESCE(ultima_coleta, ?)
-             WHERE telegram_id = ? AND (ultima_coleta IS NULL OR TRIM(ultima_coleta) = '')
-        """, (_iso_now(), user_id))
+    await storage().inventory.fill_missing_collect(user_id, _iso_now())
 
-    itens, total = get_producao_usuario(user_id)
+    itens, total = await get_producao_usuario(user_id)
     if not itens:
         return await msg.answer("Você ainda não possui animais. Compre um na loja!")
 
@@ -1039,12 +2009,12 @@ async def meus_animais(msg: types.Message):
         linhas.append(f"{it['emoji']} {it['animal']} (*{it['qtd']}*):  *{it['produzido']:.0f}* 🧱")
     linhas.append(f"\n📈 *Total Produzido:* *{total:.0f}* 🧱")
 
-    tok = cb_new(user_id, action="collect", payload="all", ttl=30)
+    tok = await cb_new(user_id, action="collect", payload="all", ttl=30)
     kb = types.InlineKeyboardMarkup(inline_keyboard=[[types.InlineKeyboardButton(text="📥 Coletar rendimento", callback_data=f"collect:{tok}")]])
 
     await msg.answer("\n".join(linhas).replace(",", "."), parse_mode="Markdown", reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("collect:"))
+@router.callback_query(F.data.startswith("collect:"))
 async def coletar_rendimento_cb(call: types.CallbackQuery):
     user_id = call.from_user.id
 
@@ -1053,26 +2023,14 @@ async def coletar_rendimento_cb(call: types.CallbackQuery):
     except Exception:
         return await call.answer("Essa interação expirou. Por favor, tente novamente.", show_alert=True)
 
-    ok, payload, err = cb_check_and_use(token, user_id, action="collect")
+    ok, payload, err = await cb_check_and_use(token, user_id, action="collect")
     if not ok:
         return await call.answer(err, show_alert=True)
 
-    itens, total = get_producao_usuario(user_id)
-    total = float(f"{total:.6f}")
-    if total <= 0.01:
+    n, total, novo_saldo = await storage().inventory.collect(user_id, _iso_now())
+    if not n:
         return await call.answer("Nada para coletar agora 🙂", show_alert=True)
-
-    agora = _iso_now()
-    with db_conn() as c:
-        c.execute("""
-            UPDATE usuarios
-               SET saldo_materiais = COALESCE(saldo_materiais, 0) + ?
-             WHERE telegram_id = ?
-        """, (total, user_id))
-        c.execute("UPDATE inventario SET ultima_coleta = ? WHERE telegram_id = ?", (agora, user_id))
-        r = c.execute("SELECT COALESCE(saldo_materiais,0) AS s FROM usuarios WHERE telegram_id=?",
-                      (user_id,)).fetchone()
-        novo_saldo = r["s"] if r else 0.0
+    invalidate_saldos(user_id)
 
     await call.message.answer(
         "📥 *Coleta concluída!*\n\n"
@@ -1084,7 +2042,7 @@ async def coletar_rendimento_cb(call: types.CallbackQuery):
     await call.answer()
 
 # ===== Depósito via Crypto Pay (BRL) =====
-@dp.message(StateFilter("*"), F.text == "➕ Depositar")
+@menu_route("➕ Depositar")
 async def depositar_menu(msg: types.Message, state: FSMContext):
     await state.clear()  # <<< limpa qualquer estado pendente
     kb = types.ReplyKeyboardMarkup(
@@ -1105,14 +2063,14 @@ def _parse_reais(txt: str):
     except:
         return None
 
-@dp.message(StateFilter(None), F.text.in_(["R$ 10","R$ 25","R$ 50","R$ 100"]))
+@menu_route("R$ 10", "R$ 25", "R$ 50", "R$ 100", states={None})
 async def gerar_link_padrao(msg: types.Message):
     if not CRYPTOPAY_TOKEN:
         await msg.answer("Configuração de pagamento ausente. Avise o suporte.")
         return
     val = _parse_reais(msg.text)
     try:
-        url = criar_invoice_cryptopay(msg.from_user.id, val)
+        url = await link_deposito(msg.from_user.id, val)
     except Exception:
         await msg.answer("Erro ao criar cobrança. Tente novamente.")
         return
@@ -1121,11 +2079,13 @@ async def gerar_link_padrao(msg: types.Message):
         "Assim que o pagamento for confirmado, eu credito seus cash. ⏳"
     )
 
-@dp.message(StateFilter(None), F.text == "Outro valor (R$)")
+@menu_route("Outro valor (R$)", states={None})
 async def outro_valor(msg: types.Message):
     await msg.answer("Envie o valor desejado em reais. Ex.: 37,90")
 
-@dp.message(StateFilter(None), lambda m: _parse_reais(m.text) is not None and "R$" not in m.text and "TON" not in m.text)
+_VALOR_RE = re.compile(r"\s*[\d.,]+\s*")
+
+@router.message(StateFilter(None), lambda m: m.text is not None and _VALOR_RE.fullmatch(m.text) and _parse_reais(m.text) is not None)
 async def gerar_link_custom(msg: types.Message):
     if not CRYPTOPAY_TOKEN:
         await msg.answer("Configuração de pagamento ausente. Avise o suporte.")
@@ -1135,7 +2095,7 @@ async def gerar_link_custom(msg: types.Message):
         await msg.answer("Valor mínimo: R$ 1,00.")
         return
     try:
-        url = criar_invoice_cryptopay(msg.from_user.id, val)
+        url = await link_deposito(msg.from_user.id, val)
     except Exception:
         await msg.answer("Erro ao criar cobrança. Tente novamente.")
         return
@@ -1145,10 +2105,10 @@ async def gerar_link_custom(msg: types.Message):
     )
 
 # ===== Troca cash -> TON =====
-@dp.message(F.text == "🔄 Trocas")
+@menu_route("🔄 Trocas")
 async def trocas_menu(msg: types.Message):
     user_id = msg.from_user.id
-    total_mats = int(get_user_materiais(user_id))
+    total_mats = int((await get_saldos(user_id))["mats"])
 
     texto = (
         "Você pode vender sua produção de Materiais e receber 🧾 *Cash de Pagamento*,\n"
@@ -1161,14 +2121,14 @@ async def trocas_menu(msg: types.Message):
         f"Quantidade mínima: *{int(MATERIAIS_MIN_VENDA)}* 🧱"
     )
 
-    tok = cb_new(user_id, action="materials", payload="convert_all", ttl=30)
+    tok = await cb_new(user_id, action="materials", payload="convert_all", ttl=30)
     kb = types.InlineKeyboardMarkup(inline_keyboard=[
         [types.InlineKeyboardButton(text="🔄 Vender Materiais", callback_data=f"materials:{tok}")],
         [types.InlineKeyboardButton(text="🔄 Trocar cash por TON", callback_data="ton:swap_menu")],
     ])
     await msg.answer(texto, reply_markup=kb, parse_mode="Markdown")
 
-@dp.callback_query(F.data.startswith("materials:"))
+@router.callback_query(F.data.startswith("materials:"))
 async def converter_materiais_cb(call: types.CallbackQuery):
     user_id = call.from_user.id
     try:
@@ -1176,28 +2136,24 @@ async def converter_materiais_cb(call: types.CallbackQuery):
     except Exception:
         return await call.answer("Essa interação expirou. Por favor, tente novamente.", show_alert=True)
 
-    ok, payload, err = cb_check_and_use(token, user_id, action="materials")
+    ok, payload, err = await cb_check_and_use(token, user_id, action="materials")
     if not ok:
         return await call.answer(err, show_alert=True)
 
-    mats = get_user_materiais(user_id)
+    mats = await get_user_materiais(user_id)
     if mats < MATERIAIS_MIN_VENDA:
         return await call.answer("Você precisa de pelo menos 2000 Materiais para converter.", show_alert=True)
 
     unidades = int(mats // MATERIAIS_DIVISOR)
     usado = int(unidades * MATERIAIS_DIVISOR)
-    sobra = mats - usado
     to_pag  = int(unidades * MATERIAIS_PCT_PAG)
     to_cash = int(unidades * MATERIAIS_PCT_CASH)
 
-    with db_conn() as c:
-        c.execute("""
-            UPDATE usuarios
-               SET saldo_materiais = ?,
-                   saldo_cash_pagamentos = COALESCE(saldo_cash_pagamentos,0) + ?,
-                   saldo_cash = COALESCE(saldo_cash,0) + ?
-             WHERE telegram_id = ?
-        """, (sobra, to_pag, to_cash, user_id))
+    # débito relativo e condicional: uma coleta concorrente não se perde
+    sobra = await storage().users.sell_materials(user_id, usado, to_pag, to_cash)
+    invalidate_saldos(user_id)
+    if sobra is None:
+        return await call.answer("Você precisa de pelo menos 2000 Materiais para converter.", show_alert=True)
 
     texto = (
         "✅ Venda de materiais bem sucedida!\n\n"
@@ -1208,15 +2164,10 @@ async def converter_materiais_cb(call: types.CallbackQuery):
     await call.message.answer(texto)
     await call.answer()
 
-@dp.callback_query(F.data == "ton:swap_menu")
+@router.callback_query(F.data == "ton:swap_menu")
 async def abrir_swap_ton_cb(call: types.CallbackQuery):
     user_id = call.from_user.id
-    with db_conn() as c:
-        row = c.execute(
-            "SELECT COALESCE(saldo_cash_pagamentos,0) FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-    saldo_pag = row[0] if row else 0
+    saldo_pag = (await get_saldos(user_id))["pag"]
 
     preco_brl = get_ton_price_brl()
     cash_por_ton = max(1, int(round(preco_brl * CASH_POR_REAL)))
@@ -1229,11 +2180,11 @@ async def abrir_swap_ton_cb(call: types.CallbackQuery):
         "Escolha um valor (mín. `20` cash) ou digite, exemplo: `trocar 250`"
     )
 
-    tok20  = cb_new(user_id, action="swap", payload="20",  ttl=30)
-    tok50  = cb_new(user_id, action="swap", payload="50",  ttl=30)
-    tok100 = cb_new(user_id, action="swap", payload="100", ttl=30)
-    tok500 = cb_new(user_id, action="swap", payload="500", ttl=30)
-    tokall = cb_new(user_id, action="swap", payload="all", ttl=30)
+    tok20  = await cb_new(user_id, action="swap", payload="20",  ttl=30)
+    tok50  = await cb_new(user_id, action="swap", payload="50",  ttl=30)
+    tok100 = await cb_new(user_id, action="swap", payload="100", ttl=30)
+    tok500 = await cb_new(user_id, action="swap", payload="500", ttl=30)
+    tokall = await cb_new(user_id, action="swap", payload="all", ttl=30)
 
     kb = types.InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -1249,15 +2200,10 @@ async def abrir_swap_ton_cb(call: types.CallbackQuery):
     await call.message.answer(texto, parse_mode="Markdown", reply_markup=kb)
     await call.answer()
 
-@dp.message(F.text == "🔄 Trocar cash por TON")
+@menu_route("🔄 Trocar cash por TON")
 async def trocar_cash(msg: types.Message):
     user_id = msg.from_user.id
-    with db_conn() as c:
-        row = c.execute(
-            "SELECT COALESCE(saldo_cash_pagamentos,0) FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-    saldo_pag = row[0] if row else 0
+    saldo_pag = (await get_saldos(user_id))["pag"]
 
     preco_brl = get_ton_price_brl()
     cash_por_ton = max(1, int(round(preco_brl * CASH_POR_REAL)))
@@ -1270,11 +2216,11 @@ async def trocar_cash(msg: types.Message):
         "Escolha um valor (mín. `20` cash) ou digite: `trocar 250`"
     )
 
-    tok20  = cb_new(user_id, action="swap", payload="20",  ttl=30)
-    tok50  = cb_new(user_id, action="swap", payload="50",  ttl=30)
-    tok100 = cb_new(user_id, action="swap", payload="100", ttl=30)
-    tok500 = cb_new(user_id, action="swap", payload="500", ttl=30)
-    tokall = cb_new(user_id, action="swap", payload="all", ttl=30)
+    tok20  = await cb_new(user_id, action="swap", payload="20",  ttl=30)
+    tok50  = await cb_new(user_id, action="swap", payload="50",  ttl=30)
+    tok100 = await cb_new(user_id, action="swap", payload="100", ttl=30)
+    tok500 = await cb_new(user_id, action="swap", payload="500", ttl=30)
+    tokall = await cb_new(user_id, action="swap", payload="all", ttl=30)
 
     kb = types.InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -1289,7 +2235,7 @@ async def trocar_cash(msg: types.Message):
     ])
     await msg.answer(texto, parse_mode="Markdown", reply_markup=kb)
 
-@dp.callback_query(F.data.startswith("swap:"))
+@router.callback_query(F.data.startswith("swap:"))
 async def swap_cb(call: types.CallbackQuery):
     user_id = call.from_user.id
     try:
@@ -1297,18 +2243,13 @@ async def swap_cb(call: types.CallbackQuery):
     except Exception:
         return await call.answer("Essa interação expirou. Por favor, tente novamente.", show_alert=True)
 
-    ok, payload, err = cb_check_and_use(token, user_id, action="swap")
+    ok, payload, err = await cb_check_and_use(token, user_id, action="swap")
     if not ok:
         return await call.answer(err, show_alert=True)
     if (payload or "") != amount_s:
         return await call.answer("Essa interação não é mais válida. Por favor, tente novamente.", show_alert=True)
 
-    with db_conn() as c:
-        row = c.execute(
-            "SELECT COALESCE(saldo_cash_pagamentos,0), COALESCE(saldo_ton,0) FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-        saldo_pag, saldo_ton = (row[0], row[1]) if row else (0, 0)
+    saldo_pag = (await storage().users.balances(user_id) or SALDOS_VAZIOS)["pag"]
 
     preco_brl = get_ton_price_brl()
     cash_por_ton = max(1, int(round(preco_brl * CASH_POR_REAL)))
@@ -1320,16 +2261,10 @@ async def swap_cb(call: types.CallbackQuery):
         return await call.answer("Saldo de pagamentos insuficiente.", show_alert=True)
 
     ton_out = amount / cash_por_ton
-    with db_conn() as c:
-        c.execute(
-            "UPDATE usuarios SET saldo_cash_pagamentos=saldo_cash_pagamentos-?, saldo_ton=saldo_ton+? WHERE telegram_id=?",
-            (amount, ton_out, user_id)
-        )
-        row_new = c.execute(
-            "SELECT COALESCE(saldo_ton,0) AS s FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-        novo_saldo_ton = row_new["s"] if row_new else 0.0
+    novo_saldo_ton = await storage().users.swap_pag_to_ton(user_id, amount, ton_out)
+    invalidate_saldos(user_id)
+    if novo_saldo_ton is None:
+        return await call.answer("Saldo de pagamentos insuficiente.", show_alert=True)
 
     await call.message.answer(
         f"✅ Convertidos `{amount}` cash de pagamentos → `+{ton_out:.5f}` TON\n"
@@ -1337,7 +2272,7 @@ async def swap_cb(call: types.CallbackQuery):
         parse_mode="Markdown"
     )
 
-@dp.message(lambda m: m.text and m.text.lower().startswith("trocar "))
+@router.message(lambda m: m.text and m.text[:7].lower() == "trocar ")
 async def trocar_texto(msg: types.Message):
     try:
         parts = msg.text.strip().split()
@@ -1347,12 +2282,7 @@ async def trocar_texto(msg: types.Message):
         return
 
     user_id = msg.from_user.id
-    with db_conn() as c:
-        row = c.execute(
-            "SELECT COALESCE(saldo_cash_pagamentos,0), COALESCE(saldo_ton,0) FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-        saldo_pag, saldo_ton = (row[0], row[1]) if row else (0, 0)
+    saldo_pag = (await storage().users.balances(user_id) or SALDOS_VAZIOS)["pag"]
 
     if amount < 20:
         await msg.answer("Mínimo 20 cash.")
@@ -1365,16 +2295,11 @@ async def trocar_texto(msg: types.Message):
     cash_por_ton = max(1, int(round(preco_brl * CASH_POR_REAL)))
     ton_out = amount / cash_por_ton
 
-    with db_conn() as c:
-        c.execute(
-            "UPDATE usuarios SET saldo_cash_pagamentos=saldo_cash_pagamentos-?, saldo_ton=saldo_ton+? WHERE telegram_id=?",
-            (amount, ton_out, user_id)
-        )
-        row_new = c.execute(
-            "SELECT COALESCE(saldo_ton,0) AS s FROM usuarios WHERE telegram_id=?",
-            (user_id,)
-        ).fetchone()
-        novo_saldo_ton = row_new["s"] if row_new else 0.0
+    novo_saldo_ton = await storage().users.swap_pag_to_ton(user_id, amount, ton_out)
+    invalidate_saldos(user_id)
+    if novo_saldo_ton is None:
+        await msg.answer("Saldo de pagamentos insuficiente.")
+        return
 
     await msg.answer(
         f"✅ Convertidos `{amount}` cash de pagamentos → `+{ton_out:.5f}` TON\n"
@@ -1383,13 +2308,13 @@ async def trocar_texto(msg: types.Message):
     )
 
 # ===== Saque =====
-@dp.message(F.text == "🏦 Sacar")
+@menu_route("🏦 Sacar")
 async def sacar_menu(msg: types.Message):
     await msg.answer("Escolha uma opção de saque:", reply_markup=sacar_keyboard())
 
-@dp.message(F.text == "Wallet TON")
+@menu_route("Wallet TON")
 async def pedir_wallet(msg: types.Message, state: FSMContext):
-    wal = get_wallet(msg.from_user.id)
+    wal = await get_wallet(msg.from_user.id)
     if wal:
         await msg.answer(
             f"Carteira atual:\n`{wal}`\n\nSe quiser alterar, toque em **Alterar Wallet**.",
@@ -1407,25 +2332,25 @@ async def pedir_wallet(msg: types.Message, state: FSMContext):
         )
         await state.set_state(WalletStates.waiting_wallet)
 
-@dp.callback_query(F.data == "alterar_wallet")
+@router.callback_query(F.data == "alterar_wallet")
 async def alterar_wallet_cb(cb: types.CallbackQuery, state: FSMContext):
     await cb.message.edit_text("Envie o **novo endereço de carteira TON** para saque.", parse_mode="Markdown")
     await cb.message.answer("Você pode voltar quando quiser.", reply_markup=kb_voltar())
     await state.set_state(WalletStates.changing_wallet)
     await cb.answer()
 
-@dp.message(StateFilter(WalletStates.waiting_wallet), F.text == "⬅️ Voltar")
+@router.message(StateFilter(WalletStates.waiting_wallet), F.text == "⬅️ Voltar")
 async def cancelar_wallet(msg: types.Message, state: FSMContext):
     await state.clear()
     await msg.answer("Voltei ao menu.", reply_markup=menu())
 
-@dp.message(StateFilter(WalletStates.waiting_wallet), F.text == "Pagamento")
+@router.message(StateFilter(WalletStates.waiting_wallet), F.text == "Pagamento")
 async def atalho_pagamento(msg: types.Message, state: FSMContext):
     await state.clear()
     return await iniciar_pagamento(msg, state)
 
-@dp.message(StateFilter(WalletStates.waiting_wallet))
-@dp.message(StateFilter(WalletStates.changing_wallet))
+@router.message(StateFilter(WalletStates.waiting_wallet))
+@router.message(StateFilter(WalletStates.changing_wallet))
 async def salvar_wallet(msg: types.Message, state: FSMContext):
     txt = (msg.text or "").strip()
 
@@ -1448,16 +2373,17 @@ async def salvar_wallet(msg: types.Message, state: FSMContext):
             parse_mode="Markdown"
         )
 
-    set_wallet(msg.from_user.id, addr)
+    await set_wallet(msg.from_user.id, addr)
     await state.clear()
     await msg.answer(f"✅ Carteira salva:\n`{addr}`", parse_mode="Markdown", reply_markup=alterar_wallet_inline())
     await msg.answer("Pronto! Use o menu abaixo.", reply_markup=menu())
 
-@dp.message(F.text == "Pagamento")
+# em waiting_wallet/changing_wallet quem responde são os handlers de carteira
+@menu_route("Pagamento", states={None, WithdrawStates.waiting_amount_ton.state})
 async def iniciar_pagamento(msg: types.Message, state: FSMContext):
     await state.clear()
 
-    wal = get_wallet(msg.from_user.id)
+    wal = await get_wallet(msg.from_user.id)
     if not wal:
         return await msg.answer(
             "Você ainda não definiu sua **Wallet TON**. Toque em *Wallet TON* e cadastre antes de sacar.",
@@ -1465,7 +2391,7 @@ async def iniciar_pagamento(msg: types.Message, state: FSMContext):
             reply_markup=sacar_keyboard()
         )
 
-    _, _, saldo_ton = get_balances(msg.from_user.id)
+    _, _, saldo_ton = await get_balances(msg.from_user.id)
     await msg.answer(
         "Quanto você deseja sacar **em TON**?\n\n"
         f"• Saldo TON disponível: {saldo_ton:.6f} TON\n\n"
@@ -1474,7 +2400,7 @@ async def iniciar_pagamento(msg: types.Message, state: FSMContext):
     )
     await state.set_state(WithdrawStates.waiting_amount_ton)
 
-@dp.message(StateFilter(WithdrawStates.waiting_amount_ton))
+@router.message(StateFilter(WithdrawStates.waiting_amount_ton))
 async def processar_saque(msg: types.Message, state: FSMContext):
     # 0) Parse do valor
     try:
@@ -1488,7 +2414,7 @@ async def processar_saque(msg: types.Message, state: FSMContext):
         return await msg.answer("Valor mínimo para saque: 0.1 TON.")
 
     user_id = msg.from_user.id
-    wallet = get_wallet(user_id)
+    wallet = await get_wallet(user_id)
     if not wallet:
         await state.clear()
         return await msg.answer(
@@ -1497,84 +2423,50 @@ async def processar_saque(msg: types.Message, state: FSMContext):
             reply_markup=sacar_keyboard()
         )
 
-    # 1) Varrer travas antigas deste usuário (expiram em 15min)
-    try:
-        sweep_old_withdraw_locks(user_id, max_age_minutes=15)
-    except Exception as e:
-        logging.warning("[withdraw] sweep user lock falhou: %s", e)
+    # 1) A trava de saque em processamento expira sozinha em 15min (ver
+    #    reserve); o desfecho dos saques presos é da reconciliação do líder
 
     # 2) Primeiro, checar saldo do usuário (não cria lock se não tiver saldo)
-    with db_conn() as c:
-        row = c.execute("SELECT saldo_ton FROM usuarios WHERE telegram_id=?", (user_id,)).fetchone()
-        saldo_ton = row["saldo_ton"] if row else 0.0
-        if amount_ton > saldo_ton + 1e-9:
-            await state.set_state(WithdrawStates.waiting_amount_ton)
-            return await msg.answer(
-                "Você não possui TON suficiente para este saque. "
-                "Digite outro valor ou toque em ⬅️ Voltar.",
-                reply_markup=sacar_keyboard()
-            )
-
-    # 3) Checar cofre do App (sem revelar números)
-    try:
-        balances = get_app_balances()
-        ton_avail = 0.0
-        for b in balances:
-            if _balance_code(b) == "TON":
-                ton_avail = float(b.get("available") or 0)
-                break
-        if ton_avail + 1e-9 < amount_ton:
-            await state.set_state(WithdrawStates.waiting_amount_ton)
-            return await msg.answer(
-                "No momento não é possível processar esse saque. "
-                "Digite outro valor ou toque em ⬅️ Voltar.",
-                reply_markup=sacar_keyboard()
-            )
-    except Exception as e:
-        logging.warning(f"[payout] get_app_balances falhou: {e}")
-
-    # 4) Bloqueio: impedir múltiplos saques simultâneos RECENTES
-    #    — e APENAS se estiver realmente 'processing' (não considera 'pending')
-    with db_conn() as c:
-        r = c.execute(
-            """
-            SELECT COUNT(*) AS n
-              FROM withdrawals
-             WHERE user_id = ?
-               AND status = 'processing'
-               AND created_at > DATETIME('now', '-15 minutes')
-            """,
-            (user_id,)
-        ).fetchone()
-        n_locked = (r["n"] if isinstance(r, sqlite3.Row) else r[0]) if r else 0
-        if n_locked > 0:
-            await state.set_state(WithdrawStates.waiting_amount_ton)
-            return await msg.answer("Você já tem um saque em processamento. Aguarde finalizar.")
-
-    # 5) Reservar saldo do usuário ATOMICAMENTE (sem corrida)
-    with db_conn() as c:
-        cur2 = c.execute(
-            "UPDATE usuarios SET saldo_ton = saldo_ton - ? WHERE telegram_id=? AND saldo_ton >= ?",
-            (amount_ton, user_id, amount_ton)
+    saldo_ton = (await storage().users.balances(user_id) or SALDOS_VAZIOS)["ton"]
+    if amount_ton > saldo_ton + 1e-9:
+        await state.set_state(WithdrawStates.waiting_amount_ton)
+        return await msg.answer(
+            "Você não possui TON suficiente para este saque. "
+            "Digite outro valor ou toque em ⬅️ Voltar.",
+            reply_markup=sacar_keyboard()
         )
-        if cur2.rowcount != 1:
-            await state.set_state(WithdrawStates.waiting_amount_ton)
-            return await msg.answer(
-                "Você não possui TON suficiente para este saque. "
-                "Digite outro valor ou toque em ⬅️ Voltar.",
-                reply_markup=sacar_keyboard()
-            )
 
-    # 6) Registrar withdrawal e marcar como 'processing'
+    # 3) Cofre do App (cache local, sem revelar números), trava de saque em
+    #    processamento, débito do saldo e registro do withdrawal — tudo atômico
     idemp = new_idempotency_key(user_id)
-    wid = create_withdraw(user_id, requested_ton=amount_ton, wallet=wallet, idemp=idemp)
-    set_withdraw_status(wid, "processing")
+    wid, motivo = await reservar_saque(user_id, amount_ton, wallet, idemp)
+    if wid:
+        invalidate_saldos(user_id)
+    if motivo == "cofre":
+        await state.set_state(WithdrawStates.waiting_amount_ton)
+        return await msg.answer(
+            "No momento não é possível processar esse saque. "
+            "Digite outro valor ou toque em ⬅️ Voltar.",
+            reply_markup=sacar_keyboard()
+        )
+    if motivo == "lock":
+        await state.set_state(WithdrawStates.waiting_amount_ton)
+        return await msg.answer("Você já tem um saque em processamento. Aguarde finalizar.")
+    if motivo == "saldo":
+        await state.set_state(WithdrawStates.waiting_amount_ton)
+        return await msg.answer(
+            "Você não possui TON suficiente para este saque. "
+            "Digite outro valor ou toque em ⬅️ Voltar.",
+            reply_markup=sacar_keyboard()
+        )
+
     await msg.answer("⏳ Processando seu saque…")
 
     try:
-        # 7) Tentar payout direto on-chain
+        # 4) Tentar payout direto on-chain
         await cryptopay_transfer_ton_to_address(amount_ton, wallet, idemp)
-        set_withdraw_status(wid, "done")
+        if not await concluir_saque(wid):
+            logging.warning("[saque] #%s pago, mas a conferência já o tinha finalizado: confira o estorno", wid)
         await msg.answer(
             f"✅ Saque enviado!\nValor: {amount_ton:.6f} TON\nCarteira: `{wallet}`",
             parse_mode="Markdown"
@@ -1583,11 +2475,12 @@ async def processar_saque(msg: types.Message, state: FSMContext):
     except CryptoPayError as e:
         err = str(e)
 
-        # 8) Fallback para Check (quando createPayout estiver desabilitado)
+        # 5) Fallback para Check (quando createPayout estiver desabilitado)
         if "METHOD_NOT_FOUND" in err or "createPayout" in err or "METHOD_DISABLED" in err:
             try:
                 chk = criar_check_ton(amount_ton)
-                set_withdraw_status(wid, "done")
+                if not await concluir_saque(wid):
+                    logging.warning("[saque] #%s virou check, mas a conferência já o tinha finalizado: confira o estorno", wid)
 
                 link = (
                     chk.get("bot_check_url")
@@ -1598,12 +2491,8 @@ async def processar_saque(msg: types.Message, state: FSMContext):
 
                 if not link:
                     # estorna, pois não conseguimos entregar o link
-                    with db_conn() as c:
-                        c.execute(
-                            "UPDATE usuarios SET saldo_ton = saldo_ton + ? WHERE telegram_id=?",
-                            (amount_ton, user_id)
-                        )
-                    set_withdraw_status(wid, "failed")
+                    if not await estornar_saque(wid, user_id):
+                        return await msg.answer(SAQUE_JA_FINALIZADO)
                     return await msg.answer(
                         "❌ Não foi possível gerar o link de resgate agora. Tente novamente mais tarde."
                     )
@@ -1620,24 +2509,16 @@ async def processar_saque(msg: types.Message, state: FSMContext):
 
             except Exception as ee:
                 # falhou até o fallback → estorna
-                with db_conn() as c:
-                    c.execute(
-                        "UPDATE usuarios SET saldo_ton = saldo_ton + ? WHERE telegram_id=?",
-                        (amount_ton, user_id)
-                    )
-                set_withdraw_status(wid, "failed")
+                if not await estornar_saque(wid, user_id):
+                    return await msg.answer(SAQUE_JA_FINALIZADO)
                 await msg.answer(
                     "❌ Não foi possível completar o saque agora. O valor foi estornado para seu saldo TON.",
                 )
 
         else:
             # outro erro qualquer → estorna
-            with db_conn() as c:
-                c.execute(
-                    "UPDATE usuarios SET saldo_ton = saldo_ton + ? WHERE telegram_id=?",
-                    (amount_ton, user_id)
-                )
-            set_withdraw_status(wid, "failed")
+            if not await estornar_saque(wid, user_id):
+                return await msg.answer(SAQUE_JA_FINALIZADO)
             await msg.answer(
                 "❌ Não foi possível completar o saque agora. O valor foi estornado para seu saldo TON."
             )
@@ -1646,12 +2527,11 @@ async def processar_saque(msg: types.Message, state: FSMContext):
         await state.clear()
         
 
-@dp.message(F.text == "👫 Indique & Ganhe")
+# dentro de um FSM de carteira/saque o texto é consumido pelo handler do estado
+@menu_route("👫 Indique & Ganhe", states={None})
 async def indicacao(msg: types.Message):
     user_id = msg.from_user.id
-    with db_conn() as c:
-        row = c.execute("SELECT COUNT(*) AS n FROM indicacoes WHERE por=?", (user_id,)).fetchone()
-        total_refs = row["n"] if row else 0
+    total_refs = await storage().referrals.count(user_id)
     link = f"https://t.me/{BOT_USERNAME}?start={user_id}"
     texto = (
         "🎁 <b>Indique & Ganhe</b>\n\n"
@@ -1661,7 +2541,7 @@ async def indicacao(msg: types.Message):
     )
     await msg.answer(texto, parse_mode="HTML")
 
-@dp.message(F.text == "❓ Ajuda/Suporte")
+@menu_route("❓ Ajuda/Suporte", states={None})
 async def ajuda(msg: types.Message):
     await msg.answer(
         "Dúvidas? Fale com o suporte: @SuporteAnimalTon\n\n"
@@ -1673,56 +2553,50 @@ async def ajuda(msg: types.Message):
     )
 
 # ===== COMANDOS DE ADMIN =====
-@dp.message(Command("users"))
+@router.message(Command("users"))
 async def users_count(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
-    with db_conn() as c:
-        row = c.execute("SELECT COUNT(*) AS n FROM usuarios").fetchone()
-        total = row["n"] if row else 0
+    total = await storage().users.count()
     await msg.answer(f"👥 Total de usuários cadastrados: {total}")
 
-@dp.message(Command("users30"))
+@router.message(Command("users30"))
 async def users_last_30_days(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
     since = (datetime.now() - timedelta(days=30)).isoformat()
-    with db_conn() as c:
-        row = c.execute("SELECT COUNT(*) AS n FROM usuarios WHERE criado_em >= ?", (since,)).fetchone()
-        total = row["n"] if row else 0
+    total = await storage().users.count(since)
     await msg.answer(f"📈 Novos usuários nos últimos 30 dias: {total}")
 
-@dp.message(Command("payers"))
+@router.message(Command("payers"))
 async def payer_count(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
-    with db_conn() as c:
-        row = c.execute("SELECT COUNT(DISTINCT user_id) AS n FROM pagamentos").fetchone()
-        total = row["n"] if row else 0
+    total = await storage().payments.payers()
     await msg.answer(f"💳 Usuários que já depositaram pelo menos uma vez: {total}")
 
-@dp.message(Command("stats"))
+@router.message(Command("stats"))
 async def stats(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
     since = (datetime.now() - timedelta(days=30)).isoformat()
-    with db_conn() as c:
-        users = c.execute("SELECT COUNT(*) AS n FROM usuarios").fetchone()["n"]
-        users30 = c.execute("SELECT COUNT(*) AS n FROM usuarios WHERE criado_em >= ?", (since,)).fetchone()["n"]
-        payers = c.execute("SELECT COUNT(DISTINCT user_id) AS n FROM pagamentos").fetchone()["n"]
+    users = await storage().users.count()
+    users30 = await storage().users.count(since)
+    payers = await storage().payments.payers()
     await msg.answer(
         "📊 *Estatísticas*\n"
         f"• 👥 Usuários: *{users}*\n"
         f"• 📈 Novos (30d): *{users30}*\n"
-        f"• 💳 Já pagaram: *{payers}*",
+        f"• 💳 Já pagaram: *{payers}*\n"
+        f"• 🗃️ Cache de saldos: *{len(SALDOS._data)}/{SALDOS.size}*, hit rate *{SALDOS.hit_rate():.0%}*",
         parse_mode="Markdown"
     )
 
-@dp.message(Command("whoami"))
+@router.message(Command("whoami"))
 async def whoami(msg: types.Message):
     await msg.answer(f"Seu ID: {msg.from_user.id}")
 
-@dp.message(Command("id"))
+@router.message(Command("id"))
 async def get_replied_id(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1732,7 +2606,7 @@ async def get_replied_id(msg: types.Message):
     name = (msg.reply_to_message.from_user.full_name or "").strip()
     await msg.answer(f"ID do usuário: {uid}\nNome: {name}")
 
-@dp.message(Command("addcash"))
+@router.message(Command("addcash"))
 async def add_cash(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1744,11 +2618,11 @@ async def add_cash(msg: types.Message):
             return await msg.answer("Valor fora do limite.")
     except:
         return await msg.answer("Uso: /addcash <user_id> <valor>")
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET saldo_cash=COALESCE(saldo_cash,0)+? WHERE telegram_id=?", (valor, uid))
+    await storage().users.add_balance(uid, "cash", valor)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ Adicionado {valor} cash ao usuário {uid}")
 
-@dp.message(Command("addpag"))
+@router.message(Command("addpag"))
 async def add_pag(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1760,11 +2634,11 @@ async def add_pag(msg: types.Message):
             return await msg.answer("Valor fora do limite.")
     except:
         return await msg.answer("Uso: /addpag <user_id> <valor>")
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET saldo_cash_pagamentos=COALESCE(saldo_cash_pagamentos,0)+? WHERE telegram_id=?", (valor, uid))
+    await storage().users.add_balance(uid, "pag", valor)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ Adicionado {valor} cash_pagamentos ao usuário {uid}")
 
-@dp.message(Command("addton"))
+@router.message(Command("addton"))
 async def add_ton(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1776,11 +2650,11 @@ async def add_ton(msg: types.Message):
             return await msg.answer("Valor fora do limite.")
     except:
         return await msg.answer("Uso: /addton <user_id> <valor>")
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET saldo_ton=COALESCE(saldo_ton,0)+? WHERE telegram_id=?", (valor, uid))
+    await storage().users.add_balance(uid, "ton", valor)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ Adicionado {valor} TON ao usuário {uid}")
 
-@dp.message(Command("setcash"))
+@router.message(Command("setcash"))
 async def set_cash(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1791,11 +2665,11 @@ async def set_cash(msg: types.Message):
             return await msg.answer("Valor fora do limite.")
     except:
         return await msg.answer("Uso: /setcash <user_id> <valor>")
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET saldo_cash=? WHERE telegram_id=?", (valor, uid))
+    await storage().users.set_balance(uid, "cash", valor)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ saldo_cash definido para {valor:.0f} (uid {uid})")
 
-@dp.message(Command("setpag"))
+@router.message(Command("setpag"))
 async def set_pag(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1806,11 +2680,11 @@ async def set_pag(msg: types.Message):
             return await msg.answer("Valor fora do limite.")
     except:
         return await msg.answer("Uso: /setpag <user_id> <valor>")
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET saldo_cash_pagamentos=? WHERE telegram_id=?", (valor, uid))
+    await storage().users.set_balance(uid, "pag", valor)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ saldo_cash_pagamentos definido para {valor:.0f} (uid {uid})")
 
-@dp.message(Command("setton"))
+@router.message(Command("setton"))
 async def set_ton(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1821,11 +2695,11 @@ async def set_ton(msg: types.Message):
             return await msg.answer("Valor fora do limite.")
     except:
         return await msg.answer("Uso: /setton <user_id> <valor>")
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET saldo_ton=? WHERE telegram_id=?", (valor, uid))
+    await storage().users.set_balance(uid, "ton", valor)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ saldo_ton definido para {valor:.6f} (uid {uid})")
 
-@dp.message(Command("setmats"))
+@router.message(Command("setmats"))
 async def set_mats(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1836,11 +2710,11 @@ async def set_mats(msg: types.Message):
             return await msg.answer("Valor fora do limite.")
     except:
         return await msg.answer("Uso: /setmats <user_id> <valor>")
-    with db_conn() as c:
-        c.execute("UPDATE usuarios SET saldo_materiais=? WHERE telegram_id=?", (valor, uid))
+    await storage().users.set_balance(uid, "mats", valor)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ saldo_materiais definido para {valor:.0f} (uid {uid})")
 
-@dp.message(Command("resetsaldos"))
+@router.message(Command("resetsaldos"))
 async def reset_saldos(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1849,18 +2723,11 @@ async def reset_saldos(msg: types.Message):
         uid = int(uid)
     except:
         return await msg.answer("Uso: /resetsaldos <user_id>")
-    with db_conn() as c:
-        c.execute("""
-            UPDATE usuarios SET
-                saldo_cash=0,
-                saldo_cash_pagamentos=0,
-                saldo_ton=0,
-                saldo_materiais=0
-            WHERE telegram_id=?
-        """, (uid,))
+    await storage().users.reset_balances(uid)
+    invalidate_saldos(uid)
     await msg.answer(f"✅ Saldos zerados (uid {uid}).")
 
-@dp.message(Command("resetuser"))
+@router.message(Command("resetuser"))
 async def reset_user(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
@@ -1872,75 +2739,1302 @@ async def reset_user(msg: types.Message):
     if mode not in {"soft","hard"}:
         return await msg.answer("Modo inválido. Use: soft ou hard.")
 
-    with db_conn() as c:
-        c.execute("""
-            UPDATE usuarios SET
-                saldo_cash=0,
-                saldo_cash_pagamentos=0,
-                saldo_ton=0,
-                saldo_materiais=0
-            WHERE telegram_id=?
-        """, (uid,))
-        c.execute("DELETE FROM inventario WHERE telegram_id=?", (uid,))
-        if mode == "soft":
-            return await msg.answer(f"✅ Reset SOFT aplicado ao uid {uid} (saldos zerados e inventário limpo).")
-
-        c.execute("DELETE FROM saques WHERE telegram_id=?", (uid,))
-        c.execute("DELETE FROM withdrawals WHERE user_id=?", (uid,))
-        c.execute("DELETE FROM pagamentos WHERE user_id=?", (uid,))
-        c.execute("DELETE FROM indicacoes WHERE quem=? OR por=?", (uid, uid))
-        c.execute("DELETE FROM usuarios WHERE telegram_id=?", (uid,))
+    await storage().users.purge(uid, hard=(mode == "hard"))
+    invalidate_saldos(uid)
+    BONUS_DIARIO.esquecer(uid)
+    if mode == "soft":
+        return await msg.answer(f"✅ Reset SOFT aplicado ao uid {uid} (saldos zerados e inventário limpo).")
     await msg.answer(f"🗑️ Reset HARD aplicado ao uid {uid} (conta e dados removidos).")
 
-@dp.message(Command("appsaldo"))
+@router.message(Command("slow"))
+async def slow_updates(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    parts = (msg.text or "").split()
+    if len(parts) >= 2 and parts[1].lower() == "reset":
+        SLOW_UPDATES.clear()
+        return await msg.answer("✅ Buffer de updates lentos limpo.")
+    try:
+        n = int(parts[1]) if len(parts) >= 2 else 10
+    except ValueError:
+        return await msg.answer("Uso: /slow [n|reset]")
+
+    entries = SLOW_UPDATES.slowest(n)
+    if not entries:
+        return await msg.answer("Nenhum update registrado ainda.")
+    linhas = [f"🐢 Updates mais lentos (top {len(entries)}):"]
+    for e in entries:
+        outros = e["total_s"] - e["db_s"] - e["cryptopay_s"] - e["price_s"]
+        linhas.append(
+            f"\n• {e['total_s'] * 1000:.0f} ms — {e['handler']} ({e['event']}) uid {e['user_id']} [{e['what']}]\n"
+            f"  db: {e['db_calls']}x {e['db_s'] * 1000:.0f} ms | cryptopay: {e['cryptopay_calls']}x {e['cryptopay_s'] * 1000:.0f} ms"
+            f" | preço: {e['price_calls']}x {e['price_s'] * 1000:.0f} ms | outros: {outros * 1000:.0f} ms\n"
+            f"  {e['ts']}"
+        )
+        for stack, frac in e["stacks"] or []:
+            linhas.append(f"  {frac * 100:.0f}% {stack[-200:]}")
+    texto = "\n".join(linhas)
+    for i in range(0, len(texto), 4000):
+        await msg.answer(texto[i:i + 4000])
+
+@router.message(Command("appsaldo"))
 async def app_saldo(msg: types.Message):
     if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
         return
+    parts = (msg.text or "").split()
     try:
-        bals = get_app_balances()
+        if _APP_BALANCE_CACHE["balances"] is None or (len(parts) >= 2 and parts[1].lower() == "refresh"):
+            await asyncio.to_thread(refresh_app_balances)
+        bals = _APP_BALANCE_CACHE["balances"]
         linhas = []
         for b in bals:
             code = _balance_code(b) or "?"
             avail = b.get("available") or 0
-            locked = b.get("locked") or 0
+            locked = b.get("locked") or b.get("onhold") or 0
             linhas.append(f"{code}: disponível {avail} | bloqueado {locked}")
-        texto = "💼 Saldos do App:\n" + "\n".join(linhas)
+        reservado = await storage().withdrawals.reserved(_APP_BALANCE_CACHE["snapshot_at"])
+        idade = int(time.time() - _APP_BALANCE_CACHE["ts"])
+        texto = (
+            "💼 Saldos do App:\n" + "\n".join(linhas) +
+            f"\n\nTON reservado em saques: {reservado:.6f}"
+            f"\nAtualizado há {idade}s (/appsaldo refresh para forçar)"
+        )
         await msg.answer(texto)
     except Exception as e:
         await msg.answer(f"Erro ao obter saldos do app: {e}")
 
+# ===== Envio ritmado (broadcast, lembretes) =====
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))      # mensagens/s (limite global do Telegram ~30)
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))   # envios em voo ao mesmo tempo
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "200"))       # destinatários por página/checkpoint
+
+class PacedSender:
+    """
+    Envia mensagens respeitando um teto de mensagens/s (slots espaçados de
+    1/rate) com até `workers` requisições em paralelo para esconder a latência.
+    send() retorna "ok", "blocked" (usuário bloqueou o bot / chat inexistente) ou "failed".
+    """
+    def __init__(self, rate: float = BROADCAST_RATE, workers: int = BROADCAST_WORKERS):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._sem = asyncio.Semaphore(workers)
+
+    async def _slot(self):
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> str:
+        async with self._sem:
+            for _ in range(3):
+                await self._slot()
+                try:
+                    await get_bot().send_message(chat_id, text, **kwargs)
+                    return "ok"
+                except TelegramRetryAfter as e:
+                    # flood control: segura todo mundo, não só este envio
+                    self._next = max(self._next, time.monotonic() + e.retry_after)
+                except TelegramForbiddenError:
+                    return "blocked"
+                except TelegramBadRequest as e:
+                    return "blocked" if "chat not found" in str(e).lower() else "failed"
+                except Exception as e:
+                    logging.warning("[envio] falha para %s: %s", chat_id, e)
+                    return "failed"
+            return "failed"
+
+# um só balde para todos os envios em massa: broadcast e lembretes rodando
+# juntos dividem o teto de BROADCAST_RATE em vez de somar dois
+SENDER = PacedSender()
+
+def mark_blocked(c, user_ids):
+    if user_ids:
+        c.executemany(
+            "UPDATE usuarios SET bloqueado_em=? WHERE telegram_id=?",
+            [(_iso_now(), uid) for uid in user_ids]
+        )
+
+# ===== Broadcast (admin) =====
+# Destinatários vêm de usuarios em páginas por telegram_id (keyset, sem OFFSET);
+# ao fim de cada página o progresso vai para broadcasts, então um restart
+# retoma do último checkpoint (no máximo uma página é reenviada).
+_BROADCAST_TASKS = {}   # id -> asyncio.Task
+_BROADCAST_RUNS = {}    # id -> (monotonic do início desta execução, processados no início)
+
+def _broadcast_progress(row) -> tuple[int, float, float | None]:
+    processados = row["enviados"] + row["bloqueados"] + row["falhas"]
+    t0, base = _BROADCAST_RUNS.get(row["id"], (None, processados))
+    rate = (processados - base) / (time.monotonic() - t0) if t0 else 0.0
+    eta = (row["total"] - processados) / rate if rate > 0 else None
+    return processados, rate, eta
+
+async def run_broadcast(bid: int):
+    try:
+        await _run_broadcast(bid)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # erro de banco no meio do envio: a task não pode morrer calada com o
+        # broadcast 'running' para sempre
+        logging.exception("[broadcast] #%s falhou", bid)
+        try:
+            with db_conn() as c:
+                c.execute(
+                    "UPDATE broadcasts SET status='failed', atualizado_em=? WHERE id=? AND status='running'",
+                    (_iso_now(), bid)
+                )
+        except Exception:
+            logging.exception("[broadcast] #%s: não consegui marcar como failed", bid)
+    finally:
+        _BROADCAST_TASKS.pop(bid, None)
+        _BROADCAST_RUNS.pop(bid, None)
+
+async def _run_broadcast(bid: int):
+    with db_conn() as c:
+        row = c.execute("SELECT * FROM broadcasts WHERE id=?", (bid,)).fetchone()
+    if not row or row["status"] != "running":
+        return
+    texto, last_uid = row["texto"], row["last_uid"]
+    _BROADCAST_RUNS[bid] = (time.monotonic(), row["enviados"] + row["bloqueados"] + row["falhas"])
+    logging.info("[broadcast] #%s retomando após uid %s", bid, last_uid)
+
+    while True:
+        with db_conn() as c:
+            row = c.execute("SELECT status FROM broadcasts WHERE id=?", (bid,)).fetchone()
+        if not row or row["status"] != "running":
+            break
+        uids = await storage().users.recipients(last_uid, BROADCAST_PAGE)
+        if not uids:
+            with db_conn() as c:
+                c.execute(
+                    "UPDATE broadcasts SET status='done', atualizado_em=? WHERE id=?",
+                    (_iso_now(), bid)
+                )
+            break
+
+        results = await asyncio.gather(*(SENDER.send(uid, texto) for uid in uids))
+        blocked = [uid for uid, r in zip(uids, results) if r == "blocked"]
+        last_uid = uids[-1]
+        # usuarios mora no backend; broadcasts (como leases) fica sempre no DB_PATH
+        await storage().users.mark_blocked(blocked, _iso_now())
+        with db_conn() as c:
+            c.execute(
+                """
+                UPDATE broadcasts
+                   SET last_uid=?, enviados=enviados+?, bloqueados=bloqueados+?, falhas=falhas+?, atualizado_em=?
+                 WHERE id=?
+                """,
+                (last_uid, results.count("ok"), len(blocked), results.count("failed"), _iso_now(), bid)
+            )
+
+    with db_conn() as c:
+        row = c.execute("SELECT * FROM broadcasts WHERE id=?", (bid,)).fetchone()
+    if not row:
+        logging.warning("[broadcast] #%s sumiu da tabela durante o envio", bid)
+        return
+    processados, rate, _ = _broadcast_progress(row)
+    logging.info("[broadcast] #%s %s: %s processados", bid, row["status"], processados)
+    try:
+        await get_bot().send_message(
+            row["admin_id"],
+            f"📣 Broadcast #{bid} {'concluído' if row['status'] == 'done' else 'cancelado'}.\n"
+            f"Enviados: {row['enviados']} | Bloqueados: {row['bloqueados']} | Falhas: {row['falhas']}\n"
+            f"Ritmo: {rate:.1f} msg/s"
+        )
+    except Exception:
+        pass
+
+def start_broadcast_task(bid: int):
+    if bid not in _BROADCAST_TASKS:
+        _BROADCAST_TASKS[bid] = asyncio.create_task(run_broadcast(bid))
+
+async def resume_broadcasts():
+    with db_conn() as c:
+        ids = [r[0] for r in c.execute("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")]
+    for bid in ids:
+        start_broadcast_task(bid)
+
+@router.message(Command("broadcast"))
+async def broadcast_cmd(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    parts = (msg.text or "").split(maxsplit=1)
+    arg = parts[1].strip() if len(parts) > 1 else ""
+    if not arg:
+        return await msg.answer("Uso: /broadcast <texto> | /broadcast status | /broadcast cancel")
+
+    with db_conn() as c:
+        row = c.execute("SELECT * FROM broadcasts WHERE status='running' ORDER BY id DESC LIMIT 1").fetchone()
+
+        if arg.lower() in {"status", "cancel"}:
+            if not row:
+                return await msg.answer("Nenhum broadcast em andamento.")
+            if arg.lower() == "cancel":
+                c.execute("UPDATE broadcasts SET status='cancelled', atualizado_em=? WHERE id=?", (_iso_now(), row["id"]))
+                return await msg.answer(f"⏹️ Broadcast #{row['id']} será cancelado ao fim da página atual.")
+            processados, rate, eta = _broadcast_progress(row)
+            eta_txt = _fmt_tempo_restante(timedelta(seconds=eta)) if eta is not None else "?"
+            return await msg.answer(
+                f"📣 Broadcast #{row['id']}: {processados}/{row['total']}\n"
+                f"Enviados: {row['enviados']} | Bloqueados: {row['bloqueados']} | Falhas: {row['falhas']}\n"
+                f"Ritmo: {rate:.1f} msg/s | ETA: {eta_txt}"
+            )
+
+    if row:
+        return await msg.answer(f"Já existe o broadcast #{row['id']} em andamento. Use /broadcast status.")
+    total = await storage().users.count_recipients()
+    with db_conn() as c:
+        c.execute(
+            "INSERT INTO broadcasts (admin_id, texto, total, criado_em, atualizado_em) VALUES (?, ?, ?, ?, ?)",
+            (msg.from_user.id, arg, total, _iso_now(), _iso_now())
+        )
+        bid = c.execute("SELECT last_insert_rowid() id").fetchone()["id"]
+
+    start_broadcast_task(bid)
+    eta_txt = _fmt_tempo_restante(timedelta(seconds=total / BROADCAST_RATE))
+    await msg.answer(f"📣 Broadcast #{bid} iniciado para {total} usuários (~{BROADCAST_RATE:.0f} msg/s, ETA ~{eta_txt}).")
+
+# ===== Reconciliação de saques (Crypto Pay) =====
+# Saque que ficou 'pending'/'processing' por mais de WITHDRAW_STUCK_MINUTES
+# (processo caiu ou a chamada travou entre o débito e o set_status) é
+# conferido no Crypto Pay em lotes de WITHDRAW_RECONCILE_BATCH: uma listagem
+# de getTransfers e uma de getPayouts (o saque sai por createPayout) cobrindo
+# a janela do lote, casadas localmente pelo spend_id = idempotency_key, e,
+# para o que sobrar, uma de getChecks. Cada lote fecha numa transação: achou
+# a transferência/payout → 'done'; só quando as três listagens vieram
+# completas e nada bate → 'failed' com estorno do TON.
+# Fica como está (no log, para o admin decidir com /saque <id> ok|estorno):
+# - getPayouts indisponível ou truncado: o payout pode ter saído e estornar
+#   pagaria duas vezes;
+# - getTransfers/getChecks truncados em CRYPTOPAY_MAX_PAGES;
+# - check de mesmo valor criado na janela do saque (createCheck não aceita
+#   spend_id, então não dá para saber se é dele).
+# Essas linhas saem das rodadas seguintes deste processo (_SAQUES_PARA_ADMIN):
+# uma linha velha esperando o admin não alarga a janela de todas as listagens.
+# A consulta no banco usa idx_wd_status: o custo acompanha o número de
+# saques presos, não o tamanho da tabela.
+WITHDRAW_RECONCILE_INTERVAL = int(os.getenv("WITHDRAW_RECONCILE_INTERVAL", "300"))
+WITHDRAW_STUCK_MINUTES = int(os.getenv("WITHDRAW_STUCK_MINUTES", "15"))
+WITHDRAW_RECONCILE_BATCH = int(os.getenv("WITHDRAW_RECONCILE_BATCH", "100"))
+_SAQUES_PARA_ADMIN: set[int] = set()
+
+def _utc_withdrawal(s: str) -> datetime:
+    # withdrawals.created_at: CURRENT_TIMESTAMP (UTC, "AAAA-MM-DD HH:MM:SS")
+    return datetime.strptime(s[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+
+def _pagos(method: str, spend_ids: set[str], desde: datetime) -> tuple[set[str], bool]:
+    """spend_ids achados em getTransfers/getPayouts e se a listagem veio completa."""
+    if not spend_ids:
+        return set(), True
+    itens, truncado = cryptopay_listar(
+        method, {"asset": "TON"}, "completed_at", desde,
+        achou=lambda its: spend_ids <= {i.get("spend_id") for i in its},
+    )
+    return {i["spend_id"] for i in itens if i.get("spend_id") in spend_ids}, not truncado
+
+def _payouts(spend_ids: set[str], desde: datetime) -> tuple[set[str], bool]:
+    try:
+        return _pagos("getPayouts", spend_ids, desde)
+    except Exception as e:
+        logging.warning("[saques] getPayouts indisponível (%s): saques sem transferência ficam para o admin", e)
+        return set(), False
+
+def _check_na_janela(checks: list[dict], row: dict) -> bool:
+    ini = _utc_withdrawal(row["created_at"]) - timedelta(minutes=1)
+    fim = ini + timedelta(minutes=WITHDRAW_STUCK_MINUTES + 1)
+    for ch in checks:
+        criado = cryptopay_data(ch.get("created_at"))
+        try:
+            valor = float(ch.get("amount") or 0)
+        except (TypeError, ValueError):
+            continue
+        if criado and ini <= criado <= fim and abs(valor - float(row["requested_ton"])) < 1e-9:
+            return True
+    return False
+
+async def reconciliar_saques(user_id: int | None = None) -> dict:
+    cont = {"done": 0, "estornado": 0, "ambiguo": 0}
+    after = 0
+    while True:
+        lote = await storage().withdrawals.stuck(user_id, WITHDRAW_STUCK_MINUTES, WITHDRAW_RECONCILE_BATCH, after)
+        if not lote:
+            break
+        after = lote[-1]["id"]
+        rows = [r for r in lote if r["id"] not in _SAQUES_PARA_ADMIN]
+        if not rows:
+            if len(lote) < WITHDRAW_RECONCILE_BATCH:
+                break
+            continue
+        desde = min(_utc_withdrawal(r["created_at"]) for r in rows) - timedelta(minutes=1)
+
+        spend_ids = {r["idempotency_key"] for r in rows}
+        transf, transf_ok = await asyncio.to_thread(_pagos, "getTransfers", spend_ids, desde)
+        payouts, payouts_ok = await asyncio.to_thread(_payouts, spend_ids - transf, desde)
+        pagos = transf | payouts
+        done = [r["id"] for r in rows if r["idempotency_key"] in pagos]
+        resto = [r for r in rows if r["idempotency_key"] not in pagos]
+        checks, checks_truncado = await asyncio.to_thread(
+            cryptopay_listar, "getChecks", {"asset": "TON"}, "created_at", desde
+        ) if resto else ([], False)
+        failed = []
+        for r in resto:
+            if not payouts_ok:
+                motivo = "payouts não conferidos"
+            elif not transf_ok or checks_truncado:
+                motivo = f"listagem truncada em {CRYPTOPAY_MAX_PAGES} páginas"
+            elif _check_na_janela(checks, r):
+                motivo = "há check de mesmo valor na janela"
+            else:
+                failed.append(r["id"])
+                continue
+            _SAQUES_PARA_ADMIN.add(r["id"])
+            cont["ambiguo"] += 1
+            WITHDRAW_RECONCILED.inc("ambiguo")
+            logging.warning(
+                "[saques] #%s (uid %s, %.6f TON): sem transferência/payout, mas %s; "
+                "conferir e usar /saque %s ok|estorno", r["id"], r["user_id"], r["requested_ton"], motivo, r["id"]
+            )
+
+        res = await storage().withdrawals.settle(done, failed)
+        if res["estornos"]:
+            invalidate_saldos(*{uid for _, uid, _ in res["estornos"]})
+        cont["done"] += res["done"]
+        cont["estornado"] += len(res["estornos"])
+        WITHDRAW_RECONCILED.inc("done", amount=res["done"])
+        WITHDRAW_RECONCILED.inc("estornado", amount=len(res["estornos"]))
+        if len(lote) < WITHDRAW_RECONCILE_BATCH:
+            break
+    if any(cont.values()):
+        logging.info("[saques] reconciliação: %s", cont)
+    return cont
+
+async def _reconciliar_saques_loop():
+    while True:
+        try:
+            await reconciliar_saques()
+        except Exception as e:
+            logging.warning("[saques] reconciliação falhou: %s", e)
+        await asyncio.sleep(WITHDRAW_RECONCILE_INTERVAL)
+
+@router.message(Command("saque"))
+async def saque_admin_cmd(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    parts = (msg.text or "").split()
+    if len(parts) == 1:
+        # pedido do admin confere de novo inclusive o que já estava esperando por ele
+        _SAQUES_PARA_ADMIN.clear()
+        try:
+            res = await reconciliar_saques()
+        except Exception as e:
+            return await msg.answer(f"❌ Reconciliação falhou: {e}")
+        return await msg.answer(
+            f"🔎 Reconciliação: {res['done']} concluídos, {res['estornado']} estornados, "
+            f"{res['ambiguo']} para conferir (ver log)."
+        )
+    if len(parts) != 3 or not parts[1].isdigit() or parts[2] not in {"ok", "estorno"}:
+        return await msg.answer("Uso: /saque | /saque <id> ok|estorno")
+    wid = int(parts[1])
+    _SAQUES_PARA_ADMIN.discard(wid)
+    if parts[2] == "ok":
+        res = await storage().withdrawals.settle([wid], [])
+    else:
+        res = await storage().withdrawals.settle([], [wid])
+        if res["estornos"]:
+            invalidate_saldos(res["estornos"][0][1])
+    if not (res["done"] or res["estornos"]):
+        return await msg.answer(f"Saque #{wid} não está em andamento.")
+    await msg.answer(f"✅ Saque #{wid} {'concluído' if parts[2] == 'ok' else 'estornado'}.")
+
+# ===== Conferência de invoices (rede de segurança do webhook) =====
+# Se o /webhook/cryptopay estiver fora do ar ou recusar uma entrega, o
+# depósito nunca seria creditado. O líder confere a cada
+# INVOICE_POLL_INTERVAL s as invoices criadas pelo bot nas últimas
+# INVOICE_POLL_HOURS que ainda estão abertas e sem pagamento: getInvoices com
+# até INVOICE_POLL_BATCH ids por chamada. Pagas passam pelo mesmo crédito
+# idempotente do webhook (pagamentos.invoice_id), que também as fecha;
+# expiradas saem da lista. Linhas mais velhas que a janela (abertas ou não)
+# são apagadas a cada rodada: o registro do depósito é pagamentos, e o
+# webhook credita mesmo sem a linha. O custo acompanha as invoices da
+# janela, não o número de usuários.
+INVOICE_POLL_INTERVAL = int(os.getenv("INVOICE_POLL_INTERVAL", "60"))
+INVOICE_POLL_HOURS = float(os.getenv("INVOICE_POLL_HOURS", "24"))
+INVOICE_POLL_BATCH = int(os.getenv("INVOICE_POLL_BATCH", "100"))
+INVOICE_POLL_MAX = int(os.getenv("INVOICE_POLL_MAX", "5000"))
+
+async def conferir_invoices() -> dict:
+    desde = (datetime.now() - timedelta(hours=INVOICE_POLL_HOURS)).isoformat()
+    podadas = await storage().payments.prune_invoices(desde)
+    ids = await storage().payments.open_invoices(desde, INVOICE_POLL_MAX)
+    cont = {"abertas": len(ids), "creditadas": 0, "pagas": 0, "expiradas": 0, "podadas": podadas}
+    for i in range(0, len(ids), INVOICE_POLL_BATCH):
+        lote = ids[i:i + INVOICE_POLL_BATCH]
+        res = await asyncio.to_thread(
+            cryptopay_call, "getInvoices", {"invoice_ids": ",".join(lote), "count": len(lote)}
+        )
+        expiradas = []
+        for inv in (res.get("items", []) if isinstance(res, dict) else (res or [])):
+            status = inv.get("status")
+            if status == "paid":
+                if await creditar_invoice_paga(inv, "conferencia"):
+                    cont["creditadas"] += 1
+                cont["pagas"] += 1
+            elif status == "expired":
+                expiradas.append(str(inv.get("invoice_id")))
+        if expiradas:
+            await storage().payments.close_invoices(expiradas, "expired")
+        cont["expiradas"] += len(expiradas)
+    if cont["creditadas"] or cont["expiradas"] or cont["podadas"]:
+        logging.info("[cryptopay] conferência de invoices: %s", cont)
+    return cont
+
+async def _conferir_invoices_loop():
+    while True:
+        await asyncio.sleep(INVOICE_POLL_INTERVAL)
+        try:
+            await conferir_invoices()
+        except Exception as e:
+            logging.warning("[cryptopay] conferência de invoices falhou: %s", e)
+
+# ===== Coleta automática (opcional) =====
+# Credita a produção de todo mundo em lotes set-based de AUTO_COLLECT_CHUNK
+# usuários (faixas contíguas de telegram_id), um BEGIN IMMEDIATE curto por lote
+# para não segurar o lock de escrita. AUTO_COLLECT_INTERVAL=0 desliga.
+AUTO_COLLECT_INTERVAL = int(os.getenv("AUTO_COLLECT_INTERVAL", "0"))
+AUTO_COLLECT_CHUNK = int(os.getenv("AUTO_COLLECT_CHUNK", "2000"))
+
+def _proxima_faixa(ultimo: int, n: int) -> tuple[int, int] | None:
+    with db_conn() as c:
+        r = c.execute(
+            """
+            SELECT MIN(telegram_id) AS de, MAX(telegram_id) AS ate FROM (
+                SELECT DISTINCT telegram_id FROM inventario
+                 WHERE telegram_id > ? ORDER BY telegram_id LIMIT ?
+            )
+            """,
+            (ultimo, n)
+        ).fetchone()
+    return (r["de"], r["ate"]) if r and r["de"] is not None else None
+
+def _coletar_faixa(de: int, ate: int, agora: str) -> tuple[int, float]:
+    with db_conn() as c:
+        c.execute("BEGIN IMMEDIATE")
+        r = coletar_producao(c, de, ate, agora)
+    SALDOS.invalidate_range(de, ate)
+    return r
+
+async def coleta_automatica() -> dict:
+    t0 = time.perf_counter()
+    agora = _iso_now()
+    usuarios, total, lotes, ultimo = 0, 0.0, 0, -1
+    while True:
+        faixa = await asyncio.to_thread(_proxima_faixa, ultimo, AUTO_COLLECT_CHUNK)
+        if not faixa:
+            break
+        n, t = await asyncio.to_thread(_coletar_faixa, faixa[0], faixa[1], agora)
+        usuarios, total, lotes, ultimo = usuarios + n, total + t, lotes + 1, faixa[1]
+    dt = time.perf_counter() - t0
+    rate = usuarios / dt if dt > 0 else 0.0
+    AUTO_COLLECT_ROWS.inc(amount=usuarios)
+    AUTO_COLLECT_RATE.set(rate)
+    logging.info("[coleta] %s usuários em %s lotes, %.0f 🧱 em %.2fs (%.0f usuários/s)", usuarios, lotes, total, dt, rate)
+    return {"usuarios": usuarios, "lotes": lotes, "total": total, "segundos": dt, "por_segundo": rate}
+
+async def _coleta_automatica_loop():
+    while True:
+        await asyncio.sleep(AUTO_COLLECT_INTERVAL)
+        try:
+            await coleta_automatica()
+        except Exception as e:
+            logging.warning("[coleta] falhou: %s", e)
+
+@router.message(Command("autocoleta"))
+async def autocoleta_cmd(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    if _storage_fora_do_db_path():
+        return await msg.answer(f"Coleta automática indisponível com o backend {storage().backend}.")
+    r = await coleta_automatica()
+    await msg.answer(
+        f"📥 Coleta automática: {r['usuarios']} usuários em {r['lotes']} lotes\n"
+        f"Total: {r['total']:.0f} 🧱 | {r['segundos']:.2f}s ({r['por_segundo']:.0f} usuários/s)"
+    )
+
+# ===== Lembrete "fazenda cheia" =====
+# Elegível: algum animal sem coleta há LEMBRETE_HORAS, produção dessas linhas
+# >= LEMBRETE_MIN_MATERIAIS e nenhum lembrete desde a última coleta
+# (lembrete_em < MAX(ultima_coleta)). As páginas seguem idx_inventario_uid:
+# cada uma começa no telegram_id onde a anterior parou, agrupa na ordem do
+# índice (sem B-tree temporária) e para no LIMIT, com ultima_coleta como filtro.
+# Uma rodada inteira é uma passada só pelo inventário.
+# LEMBRETE_INTERVAL=0 desliga.
+LEMBRETE_INTERVAL = int(os.getenv("LEMBRETE_INTERVAL", "0"))
+LEMBRETE_HORAS = float(os.getenv("LEMBRETE_HORAS", "24"))
+LEMBRETE_MIN_MATERIAIS = float(os.getenv("LEMBRETE_MIN_MATERIAIS", "0"))
+LEMBRETE_TEXTO = (
+    "🐾 Sua fazenda está cheia! Seus animais produziram bastante 🧱.\n"
+    "Toque em 🐾 Meus Animais para coletar."
+)
+
+def usuarios_para_lembrete(agora: str, pagina: int = BROADCAST_PAGE):
+    corte = (datetime.fromisoformat(agora) - timedelta(hours=LEMBRETE_HORAS)).isoformat()
+    last_uid = 0
+    while True:
+        # keyset por telegram_id: cada página é uma leitura curta; o envio
+        # (minutos) não segura snapshot do WAL
+        with db_conn() as c:
+            uids = [r[0] for r in c.execute(
+                """
+                SELECT i.telegram_id
+                  FROM inventario i INDEXED BY idx_inventario_uid
+                  JOIN usuarios u ON u.telegram_id = i.telegram_id
+                  JOIN animais a ON a.nome = i.animal
+                 WHERE i.ultima_coleta <= ? AND i.telegram_id > ? AND i.quantidade > 0
+                   AND u.bloqueado_em IS NULL
+                 GROUP BY i.telegram_id
+                HAVING (u.lembrete_em IS NULL OR u.lembrete_em < MAX(i.ultima_coleta))
+                   AND SUM(a.rendimento * i.quantidade * (julianday(?) - julianday(i.ultima_coleta))) >= ?
+                 ORDER BY i.telegram_id
+                 LIMIT ?
+                """,
+                (corte, last_uid, agora, LEMBRETE_MIN_MATERIAIS, pagina)
+            )]
+        if not uids:
+            return
+        yield uids
+        if len(uids) < pagina:
+            return
+        last_uid = uids[-1]
+
+async def enviar_lembretes() -> collections.Counter:
+    t0 = time.perf_counter()
+    agora = _iso_now()
+    total = collections.Counter()  # resultado do envio → quantos
+    paginas = usuarios_para_lembrete(agora)
+    while uids := await asyncio.to_thread(next, paginas, None):
+        results = await asyncio.gather(*(SENDER.send(uid, LEMBRETE_TEXTO) for uid in uids))
+        ok = [uid for uid, r in zip(uids, results) if r == "ok"]
+        blocked = [uid for uid, r in zip(uids, results) if r == "blocked"]
+        with db_conn() as c:
+            c.execute("BEGIN IMMEDIATE")
+            c.executemany("UPDATE usuarios SET lembrete_em=? WHERE telegram_id=?", [(agora, uid) for uid in ok])
+            mark_blocked(c, blocked)
+        for r in results:
+            REMINDERS_SENT.inc(r)
+        total.update(results)
+    logging.info("[lembrete] %s em %.1fs", dict(total), time.perf_counter() - t0)
+    return total
+
+async def _lembretes_loop():
+    while True:
+        await asyncio.sleep(LEMBRETE_INTERVAL)
+        try:
+            await enviar_lembretes()
+        except Exception as e:
+            logging.warning("[lembrete] falhou: %s", e)
+
+@router.message(Command("lembretes"))
+async def lembretes_cmd(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    if _storage_fora_do_db_path():
+        return await msg.answer(f"Lembretes indisponíveis com o backend {storage().backend}.")
+    r = await enviar_lembretes()
+    await msg.answer(f"🔔 Lembretes: enviados {r['ok']} | bloqueados {r['blocked']} | falhas {r['failed']}")
+
+# ===== Manutenção do SQLite (checkpoint, estatísticas, vacuum) =====
+# Só o líder roda. A cada SQLITE_CHECKPOINT_INTERVAL s faz checkpoint PASSIVE
+# de cada arquivo (copia o que der sem esperar leitores nem escritores); se o
+# -wal passou de SQLITE_WAL_TRUNCATE_MB, tenta TRUNCATE com busy_timeout curto
+# para zerar o arquivo. A cada SQLITE_OPTIMIZE_INTERVAL s atualiza as
+# estatísticas do planejador (ANALYZE limitado por analysis_limit) e devolve
+# até SQLITE_VACUUM_PAGES páginas livres (incremental_vacuum). O vacuum só
+# funciona com auto_vacuum=INCREMENTAL: bancos novos já nascem assim, os
+# antigos precisam de um /manutencao vacuum (reescreve o arquivo inteiro e
+# segura o lock de escrita enquanto isso).
+SQLITE_WAL_TRUNCATE_MB = float(os.getenv("SQLITE_WAL_TRUNCATE_MB", "64"))
+SQLITE_TRUNCATE_BUSY_MS = int(os.getenv("SQLITE_TRUNCATE_BUSY_MS", "1000"))
+SQLITE_OPTIMIZE_INTERVAL = int(os.getenv("SQLITE_OPTIMIZE_INTERVAL", "21600"))  # 0 desliga
+SQLITE_ANALYSIS_LIMIT = int(os.getenv("SQLITE_ANALYSIS_LIMIT", "1000"))
+SQLITE_VACUUM_PAGES = int(os.getenv("SQLITE_VACUUM_PAGES", "2000"))
+_MANUTENCAO = {"otimizado_em": 0.0}
+
+def arquivos_sqlite() -> list[str]:
+    out = [DB_PATH]
+    if STORAGE_BACKEND == "sqlite" and SQLITE_SHARDS > 1:
+        out += shard_paths(DB_PATH, SQLITE_SHARDS)
+    if os.path.exists(ARCHIVE_PATH):
+        out.append(ARCHIVE_PATH)
+    return out
+
+def _wal_bytes(path: str) -> int:
+    try:
+        return os.path.getsize(path + "-wal")
+    except OSError:
+        return 0
+
+def checkpoint_wal(path: str) -> dict:
+    nome = os.path.basename(path)
+    modo = "TRUNCATE" if _wal_bytes(path) >= SQLITE_WAL_TRUNCATE_MB * 1024 * 1024 else "PASSIVE"
+    with db_conn(path) as c:
+        if modo == "TRUNCATE":
+            c.execute(f"PRAGMA busy_timeout={SQLITE_TRUNCATE_BUSY_MS}")
+        t0 = time.perf_counter()
+        busy, paginas, copiadas = c.execute(f"PRAGMA wal_checkpoint({modo})").fetchone()
+        dt = time.perf_counter() - t0
+    wal = _wal_bytes(path)
+    SQLITE_CHECKPOINT_SECONDS.observe(dt, modo.lower())
+    SQLITE_WAL_BYTES.set(wal, nome)
+    if busy or copiadas < paginas:
+        SQLITE_CHECKPOINT_BUSY.inc(modo.lower())
+    if modo == "TRUNCATE" or dt >= 0.5:
+        logging.info("[manutencao] %s: checkpoint %s %s/%s páginas em %.0f ms, wal %s KiB",
+                     nome, modo, copiadas, paginas, dt * 1000, wal // 1024)
+    return {"modo": modo, "paginas": paginas, "copiadas": copiadas, "checkpoint_s": dt, "wal_bytes": wal}
+
+def otimizar_sqlite(path: str) -> dict:
+    nome = os.path.basename(path)
+    with db_conn(path) as c:
+        t0 = time.perf_counter()
+        c.execute(f"PRAGMA analysis_limit={SQLITE_ANALYSIS_LIMIT}")
+        if sqlite3.sqlite_version_info >= (3, 46, 0):
+            c.execute("PRAGMA optimize=0x10002")  # olha todas as tabelas, só analisa as desatualizadas
+        else:
+            c.execute("ANALYZE")  # optimize antigo só olha o que esta conexão consultou
+        t_opt = time.perf_counter() - t0
+        SQLITE_MAINT_SECONDS.observe(t_opt, "optimize")
+
+        livres = c.execute("PRAGMA freelist_count").fetchone()[0]
+        incremental = c.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+        devolvidas, t_vac = 0, 0.0
+        if incremental and livres and SQLITE_VACUUM_PAGES > 0:
+            t0 = time.perf_counter()
+            # cada passo do statement libera uma página: precisa consumir tudo
+            c.execute(f"PRAGMA incremental_vacuum({SQLITE_VACUUM_PAGES})").fetchall()
+            t_vac = time.perf_counter() - t0
+            SQLITE_MAINT_SECONDS.observe(t_vac, "incremental_vacuum")
+            restantes = c.execute("PRAGMA freelist_count").fetchone()[0]
+            devolvidas, livres = livres - restantes, restantes
+            SQLITE_VACUUM_PAGES_TOTAL.inc(nome, amount=devolvidas)
+    SQLITE_FREELIST_PAGES.set(livres, nome)
+    logging.info("[manutencao] %s: estatísticas em %.0f ms, %s páginas devolvidas em %.0f ms, %s livres%s",
+                 nome, t_opt * 1000, devolvidas, t_vac * 1000, livres, "" if incremental else " (sem auto_vacuum)")
+    return {"optimize_s": t_opt, "vacuum_s": t_vac, "devolvidas": devolvidas, "livres": livres,
+            "incremental": incremental}
+
+def vacuum_completo(path: str) -> dict:
+    """Reescreve o arquivo já com auto_vacuum=INCREMENTAL. Bloqueia escritas até terminar."""
+    with db_conn(path) as c:
+        antes = os.path.getsize(path)
+        t0 = time.perf_counter()
+        c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        c.execute("VACUUM")
+        dt = time.perf_counter() - t0
+    SQLITE_MAINT_SECONDS.observe(dt, "vacuum")
+    checkpoint_wal(path)
+    depois = os.path.getsize(path)
+    logging.info("[manutencao] %s: VACUUM em %.1fs, %s → %s KiB", os.path.basename(path), dt, antes // 1024, depois // 1024)
+    return {"vacuum_s": dt, "antes": antes, "depois": depois}
+
+async def manutencao_sqlite(otimizar: bool = False) -> dict[str, dict]:
+    out = {}
+    for path in arquivos_sqlite():
+        r = {}
+        if otimizar:
+            r.update(await asyncio.to_thread(otimizar_sqlite, path))
+        r.update(await asyncio.to_thread(checkpoint_wal, path))
+        out[os.path.basename(path)] = r
+    if otimizar:
+        _MANUTENCAO["otimizado_em"] = time.time()
+    return out
+
+async def _manutencao_loop():
+    while True:
+        await asyncio.sleep(SQLITE_CHECKPOINT_INTERVAL)
+        otimizar = (SQLITE_OPTIMIZE_INTERVAL > 0
+                    and time.time() - _MANUTENCAO["otimizado_em"] >= SQLITE_OPTIMIZE_INTERVAL)
+        try:
+            t0 = time.perf_counter()
+            await manutencao_sqlite(otimizar)
+            SQLITE_MAINT_SECONDS.observe(time.perf_counter() - t0, "rodada")
+        except Exception as e:
+            logging.warning("[manutencao] falhou: %s", e)
+
+@router.message(Command("manutencao"))
+async def manutencao_cmd(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    parts = (msg.text or "").split()
+    if len(parts) >= 2 and parts[1].lower() == "vacuum":
+        linhas = ["🧹 VACUUM completo:"]
+        for path in arquivos_sqlite():
+            r = await asyncio.to_thread(vacuum_completo, path)
+            linhas.append(f"• {os.path.basename(path)}: {r['vacuum_s']:.1f}s, "
+                          f"{r['antes'] // 1024} → {r['depois'] // 1024} KiB")
+        return await msg.answer("\n".join(linhas))
+    res = await manutencao_sqlite(otimizar=True)
+    linhas = ["🧰 Manutenção do SQLite:"]
+    for nome, r in res.items():
+        linhas.append(
+            f"• {nome}: checkpoint {r['modo']} {r['copiadas']}/{r['paginas']} págs em {r['checkpoint_s'] * 1000:.0f} ms, "
+            f"wal {r['wal_bytes'] // 1024} KiB | estatísticas {r['optimize_s'] * 1000:.0f} ms | "
+            f"vacuum {r['devolvidas']} págs, {r['livres']} livres"
+            + ("" if r["incremental"] else " (sem auto_vacuum: /manutencao vacuum)")
+        )
+    await msg.answer("\n".join(linhas))
+
+# ===== Backup online =====
+# O líder copia cada arquivo SQLite para BACKUP_DIR a cada BACKUP_INTERVAL s
+# com a backup API, BACKUP_PAGES páginas por passo e BACKUP_PAUSE_MS entre
+# passos (ver backup.py). integrity_check e gzip rodam num subprocesso; ficam
+# os BACKUP_KEEP snapshots .gz mais novos de cada arquivo. Com shards, cada
+# arquivo é fotografado num instante diferente. O banco de arquivo só entra
+# quando mudou (mtime) depois do .gz mais novo dele, ou ainda não tem um. No WAL a leitura da cópia não
+# bloqueia escritores; os passos limitam quanto tempo o snapshot de leitura
+# segura o checkpoint, mas com escrita contínua a cópia recomeça e, passados
+# BACKUP_MAX_RESTARTS recomeços, termina num passo só (bench/backup.py).
+BACKUP_DIR = os.getenv("BACKUP_DIR") or os.path.join(os.path.dirname(DB_PATH) or ".", "backups")
+BACKUP_INTERVAL = int(os.getenv("BACKUP_INTERVAL", "21600"))  # 0 desliga
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "8"))
+BACKUP_PAGES = int(os.getenv("BACKUP_PAGES", "1024"))
+BACKUP_PAUSE_MS = float(os.getenv("BACKUP_PAUSE_MS", "10"))
+BACKUP_MAX_RESTARTS = int(os.getenv("BACKUP_MAX_RESTARTS", "3"))
+_BACKUP = {"rodando": False}
+
+def _copiar_arquivo(path: str, snapshot: str) -> dict:
+    with db_conn(path) as src:
+        return copiar_sqlite(src, snapshot, BACKUP_PAGES, BACKUP_PAUSE_MS / 1000.0, BACKUP_MAX_RESTARTS,
+                             observar=BACKUP_STEP_SECONDS.observe)
+
+async def _verificar_snapshot(snapshot: str, destino: str) -> dict:
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "fazenda_ton_bot.backup", "verificar", snapshot, destino,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(f"verificação saiu com {proc.returncode}: {err.decode(errors='replace')[-300:]}")
+    return json.loads(out)
+
+async def backup_arquivo(path: str, carimbo: str) -> dict:
+    base, ext = os.path.splitext(os.path.basename(path))
+    snapshot = os.path.join(BACKUP_DIR, f"{base}-{carimbo}{ext}.partial")
+    destino = os.path.join(BACKUP_DIR, f"{base}-{carimbo}{ext}.gz")
+    try:
+        copia = await asyncio.to_thread(_copiar_arquivo, path, snapshot)
+        BACKUP_SECONDS.observe(copia["segundos"], "copia")
+        BACKUP_RESTARTS.inc(amount=copia["reinicios"])
+        verif = await _verificar_snapshot(snapshot, destino)
+        BACKUP_SECONDS.observe(verif["check_s"] + verif.get("gzip_s", 0.0), "verificacao")
+    except Exception:
+        BACKUP_FAILURES.inc("erro")
+        if os.path.exists(snapshot):
+            os.remove(snapshot)
+        raise
+    r = {"db": os.path.basename(path), **copia, **verif}
+    if not verif["ok"]:
+        # o snapshot fica em BACKUP_DIR (.partial) para inspeção
+        BACKUP_FAILURES.inc("integridade")
+        logging.error("[backup] %s: integrity_check falhou: %s", r["db"], verif["integridade"])
+        return r
+    BACKUP_LAST_OK.set(time.time(), r["db"])
+    BACKUP_BYTES.set(verif["gz_bytes"], r["db"])
+    r["removidos"] = len(rotacionar_backups(BACKUP_DIR, base, BACKUP_KEEP))
+    logging.info(
+        "[backup] %s: %s páginas em %.1fs (%s passos, maior %.0f ms, %s recomeços%s), "
+        "verificação %.1fs, %s → %s KiB",
+        r["db"], r["paginas"], r["segundos"], r["passos"], r["max_passo_s"] * 1000, r["reinicios"],
+        ", terminou num passo só" if r["um_passo"] else "", r["check_s"] + r["gzip_s"],
+        r["bytes"] // 1024, r["gz_bytes"] // 1024,
+    )
+    return r
+
+async def fazer_backup() -> list[dict]:
+    if _BACKUP["rodando"]:
+        raise RuntimeError("já existe um backup em andamento")
+    _BACKUP["rodando"] = True
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        carimbo = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = []
+        for path in arquivos_sqlite():
+            try:
+                if path != ARCHIVE_PATH:
+                    out.append(await backup_arquivo(path, carimbo))
+                    continue
+                async with _ARQUIVO_LOCK:
+                    if _precisa_backup_arquivo():
+                        out.append(await backup_arquivo(path, carimbo))
+            except Exception as e:
+                # um shard com problema não pode deixar os outros (e o arquivo) sem backup
+                logging.error("[backup] %s falhou: %s", os.path.basename(path), e)
+                out.append({"db": os.path.basename(path), "ok": False, "erro": str(e)})
+        return out
+    finally:
+        _BACKUP["rodando"] = False
+
+async def _backup_loop():
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL)
+        try:
+            await fazer_backup()
+        except Exception as e:
+            logging.warning("[backup] falhou: %s", e)
+
+@router.message(Command("backup"))
+async def backup_cmd(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    try:
+        res = await fazer_backup()
+    except Exception as e:
+        return await msg.answer(f"❌ Backup falhou: {e}")
+    linhas = [f"💾 Backup em {BACKUP_DIR}:"]
+    for r in res:
+        if "erro" in r:
+            linhas.append(f"• {r['db']}: ❌ {r['erro']}")
+            continue
+        if not r["ok"]:
+            linhas.append(f"• {r['db']}: ❌ integrity_check: {'; '.join(r['integridade'])}")
+            continue
+        linhas.append(
+            f"• {r['db']}: {r['segundos']:.1f}s, {r['passos']} passos (maior {r['max_passo_s'] * 1000:.0f} ms), "
+            f"{r['reinicios']} recomeços | {r['bytes'] // 1024} → {r['gz_bytes'] // 1024} KiB"
+        )
+    await msg.answer("\n".join(linhas))
+
+# ===== Arquivamento (hot/cold) =====
+# pagamentos, saques, withdrawals e cb_tokens só crescem, mas o dia a dia só
+# lê linhas recentes. Com ARCHIVE_DAYS > 0, o líder move a cada
+# ARCHIVE_INTERVAL s as linhas mais velhas que o horizonte (e já em estado
+# final) para ARCHIVE_PATH, em lotes de ARCHIVE_BATCH: copia o lote para o
+# arquivo e confirma, só então apaga do banco quente. Uma queda no meio deixa
+# a linha nos dois (o próximo lote refaz com INSERT OR IGNORE), nunca em
+# nenhum. Tokens vencidos há ARCHIVE_TOKEN_HOURS também vão.
+# Quem lê histórico olha os dois: crédito de invoice (idempotência por
+# invoice_id), /payers, /stats, reset hard (storage.py) e /export.
+# As páginas liberadas voltam ao disco no incremental_vacuum da manutenção.
+ARCHIVE_DAYS = int(os.getenv("ARCHIVE_DAYS", "0"))  # 0 desliga o job
+ARCHIVE_TOKEN_HOURS = float(os.getenv("ARCHIVE_TOKEN_HOURS", "24"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "500"))
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_PATH = os.getenv("ARCHIVE_PATH") or "{0}.archive{1}".format(*os.path.splitext(DB_PATH))
+_ARQUIVO = {"pronto": False}
+_ARQUIVO_LOCK = asyncio.Lock()   # arquivar() x backup do arquivo (ver _precisa_backup_arquivo)
+
+ARQUIVO_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS pagamentos (
+        invoice_id TEXT PRIMARY KEY,
+        user_id INTEGER,
+        valor_reais REAL,
+        cash INTEGER,
+        criado_em TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS saques (
+        id INTEGER PRIMARY KEY,
+        telegram_id INTEGER,
+        valor_ton REAL,
+        carteira TEXT,
+        status TEXT,
+        criado_em TEXT,
+        pago_em TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        requested_ton REAL NOT NULL,
+        wallet TEXT NOT NULL,
+        status TEXT NOT NULL,
+        idempotency_key TEXT NOT NULL,
+        created_at TIMESTAMP,
+        updated_at TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cb_tokens (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        payload TEXT,
+        expires_at INTEGER NOT NULL,
+        used INTEGER NOT NULL,
+        created_at TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pag_user ON pagamentos(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_saq_user ON saques(telegram_id)",
+    "CREATE INDEX IF NOT EXISTS idx_wd_user ON withdrawals(user_id)",
+]
+
+def _corte_dias():
+    # só a data: compara certo com "2025-01-31T10:00:00" (isoformat) e "2025-01-31 10:00:00" (CURRENT_TIMESTAMP)
+    return (datetime.now() - timedelta(days=ARCHIVE_DAYS)).date().isoformat()
+
+def _corte_tokens():
+    return int(time.time() - ARCHIVE_TOKEN_HOURS * 3600)
+
+# tabela -> (chave, condição para arquivar com um "?" de corte, corte)
+ARQUIVAVEIS = {
+    "pagamentos":  ("invoice_id", "criado_em < ?", _corte_dias),
+    "saques":      ("id", "criado_em < ? AND status <> 'pendente'", _corte_dias),
+    "withdrawals": ("id", "updated_at < ? AND status IN ('done','failed')", _corte_dias),
+    "cb_tokens":   ("id", "expires_at < ?", _corte_tokens),
+}
+
+def arquivo_ativo() -> bool:
+    return ARCHIVE_DAYS > 0 or os.path.exists(ARCHIVE_PATH)
+
+def preparar_arquivo():
+    if _ARQUIVO["pronto"]:
+        return
+    with db_conn(ARCHIVE_PATH) as a:
+        auto_vacuum_incremental(a)
+        a.execute("BEGIN IMMEDIATE")
+        for ddl in ARQUIVO_SCHEMA:
+            a.execute(ddl)
+    _ARQUIVO["pronto"] = True
+
+def arquivo_conn():
+    """db_conn() com o banco de arquivo anexado como `arq`."""
+    preparar_arquivo()
+    c = db_conn()
+    c.execute("ATTACH DATABASE ? AS arq", (ARCHIVE_PATH,))
+    return c
+
+@functools.lru_cache(maxsize=None)
+def _colunas_arquivo(tabela: str) -> tuple[str, ...]:
+    with db_conn(ARCHIVE_PATH) as a:
+        return tuple(r["name"] for r in a.execute(f"PRAGMA table_info({tabela})"))
+
+def _arquivar_lote(tabela: str, ultimo, corte) -> tuple[int, object]:
+    chave, cond, _ = ARQUIVAVEIS[tabela]
+    cols = _colunas_arquivo(tabela)
+    lista = ", ".join(cols)
+    depois = f"{chave} > ? AND " if ultimo is not None else ""
+    params = ((ultimo,) if ultimo is not None else ()) + (corte, ARCHIVE_BATCH)
+    with db_conn() as c:
+        rows = c.execute(
+            f"SELECT {lista} FROM {tabela} WHERE {depois}{cond} ORDER BY {chave} LIMIT ?", params
+        ).fetchall()
+    if not rows:
+        return 0, None
+
+    with db_conn(ARCHIVE_PATH) as a:
+        a.execute("BEGIN IMMEDIATE")
+        a.executemany(
+            f"INSERT OR IGNORE INTO {tabela} ({lista}) VALUES ({', '.join('?' * len(cols))})",
+            [tuple(r) for r in rows]
+        )
+    chaves = [r[chave] for r in rows]
+    with db_conn() as c:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute(
+            f"DELETE FROM {tabela} WHERE {chave} IN ({', '.join('?' * len(chaves))}) AND {cond}",
+            (*chaves, corte)
+        )
+    return len(rows), chaves[-1]
+
+async def arquivar() -> dict:
+    async with _ARQUIVO_LOCK:
+        return await _arquivar()
+
+async def _arquivar() -> dict:
+    await asyncio.to_thread(preparar_arquivo)
+    t0 = time.perf_counter()
+    movidas = {}
+    for tabela, (_, _, corte) in ARQUIVAVEIS.items():
+        limite, ultimo, n = corte(), None, 0
+        while True:
+            k, ultimo = await asyncio.to_thread(_arquivar_lote, tabela, ultimo, limite)
+            n += k
+            if k < ARCHIVE_BATCH:
+                break
+        movidas[tabela] = n
+        ARCHIVED_ROWS.inc(tabela, amount=n)
+    dt = time.perf_counter() - t0
+    ARCHIVE_SECONDS.observe(dt)
+    logging.info("[arquivo] %s em %.2fs", ", ".join(f"{t} {n}" for t, n in movidas.items()), dt)
+    return {"movidas": movidas, "segundos": dt}
+
+def _precisa_backup_arquivo() -> bool:
+    # decide pelo disco (sobrevive a restart e troca de líder): o arquivo, ou
+    # o -wal com conteúdo, mudou depois que o .gz mais novo foi escrito? Chamar
+    # com _ARQUIVO_LOCK: sem arquivar() no meio, o que o mtime do .gz cobre é
+    # só o checkpoint que a própria cópia faz ao fechar a conexão.
+    base = os.path.splitext(os.path.basename(ARCHIVE_PATH))[0]
+    snaps = sorted(glob.glob(os.path.join(BACKUP_DIR, f"{glob.escape(base)}-*.gz")))
+    if not snaps:
+        return True
+    mudou = [os.path.getmtime(p) for p in (ARCHIVE_PATH, ARCHIVE_PATH + "-wal")
+             if os.path.exists(p) and os.path.getsize(p) > 0]
+    return not mudou or max(mudou) >= os.path.getmtime(snaps[-1])
+
+async def _arquivar_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        try:
+            await arquivar()
+        except Exception as e:
+            logging.warning("[arquivo] falhou: %s", e)
+
+@router.message(Command("arquivar"))
+async def arquivar_cmd(msg: types.Message):
+    if not (is_admin(msg.from_user.id) and is_private_chat(msg)):
+        return
+    if ARCHIVE_DAYS <= 0:
+        return await msg.answer("Arquivamento desligado (ARCHIVE_DAYS=0).")
+    r = await arquivar()
+    kib = lambda p: os.path.getsize(p) // 1024 if os.path.exists(p) else 0
+    await msg.answer(
+        f"🗄️ Arquivadas (> {ARCHIVE_DAYS} dias) em {r['segundos']:.2f}s:\n"
+        + "\n".join(f"• {t}: {n}" for t, n in r["movidas"].items())
+        + f"\n\nBanco quente: {kib(DB_PATH)} KiB | arquivo: {kib(ARCHIVE_PATH)} KiB"
+    )
+
+# ===== Eleição de líder (lease no SQLite) =====
+# Com vários workers (gunicorn) só um pode fazer polling, delete_webhook,
+# reconciliação e loops de refresh. Quem detém o lease "singletons" (linha em
+# leases com expira_em no futuro) roda essas tarefas e o renova a cada
+# LEASE_TTL/3; se o processo morre, o lease expira e outro worker assume em
+# até LEASE_TTL. Os demais só servem HTTP (webhook, export, métricas).
+LEASE_TTL = float(os.getenv("LEASE_TTL", "30"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+class Lease:
+    def __init__(self, nome: str, ttl: float = LEASE_TTL, dono: str = WORKER_ID):
+        self.nome = nome
+        self.ttl = ttl
+        self.dono = dono
+        self.valido_ate = 0.0   # até quando, pelo relógio local, ainda somos donos
+
+    def try_acquire(self) -> bool:
+        """Adquire ou renova o lease. Só toma de outro dono se o dele já expirou."""
+        agora = time.time()
+        with db_conn() as c:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(
+                """
+                INSERT INTO leases (nome, dono, expira_em, adquirido_em) VALUES (?, ?, ?, ?)
+                ON CONFLICT(nome) DO UPDATE SET
+                    dono = excluded.dono,
+                    expira_em = excluded.expira_em,
+                    adquirido_em = CASE WHEN leases.dono = excluded.dono
+                                        THEN leases.adquirido_em ELSE excluded.adquirido_em END
+                 WHERE leases.dono = excluded.dono OR leases.expira_em < ?
+                """,
+                (self.nome, self.dono, agora + self.ttl, agora, agora)
+            )
+            r = c.execute("SELECT dono FROM leases WHERE nome=?", (self.nome,)).fetchone()
+        if r and r["dono"] == self.dono:
+            self.valido_ate = agora + self.ttl
+            return True
+        return False
+
+    def release(self):
+        with db_conn() as c:
+            c.execute("UPDATE leases SET expira_em=0 WHERE nome=? AND dono=?", (self.nome, self.dono))
+        self.valido_ate = 0.0
+
+    def holder(self):
+        with db_conn() as c:
+            return c.execute("SELECT dono, expira_em, adquirido_em FROM leases WHERE nome=?", (self.nome,)).fetchone()
+
+LEADER_LEASE = Lease("singletons")
+_LEADER = {"ativo": False, "tasks": []}
+
+async def _start_singletons():
+    # warm_up (delete_webhook, preço, saldo) depende da rede e pode passar do
+    # LEASE_TTL; roda dentro de uma task para o _leader_loop seguir renovando
+    _LEADER["tasks"] = [asyncio.create_task(_run_singletons())]
+
+async def _run_singletons():
+    await warm_up()
+
+    tasks = [
+        asyncio.create_task(_run_polling_forever()),
+        asyncio.create_task(_refresh_price_loop()),
+        asyncio.create_task(resume_broadcasts()),
+    ]
+    if CRYPTOPAY_TOKEN:
+        tasks.append(asyncio.create_task(_refresh_app_balance_loop()))
+        if WITHDRAW_RECONCILE_INTERVAL > 0:
+            tasks.append(asyncio.create_task(_reconciliar_saques_loop()))
+        if INVOICE_POLL_INTERVAL > 0:
+            tasks.append(asyncio.create_task(_conferir_invoices_loop()))
+    if AUTO_COLLECT_INTERVAL > 0:
+        tasks.append(asyncio.create_task(_coleta_automatica_loop()))
+    if LEMBRETE_INTERVAL > 0:
+        tasks.append(asyncio.create_task(_lembretes_loop()))
+    if SQLITE_CHECKPOINT_INTERVAL > 0:
+        tasks.append(asyncio.create_task(_manutencao_loop()))
+    if BACKUP_INTERVAL > 0:
+        tasks.append(asyncio.create_task(_backup_loop()))
+    if ARCHIVE_DAYS > 0:
+        tasks.append(asyncio.create_task(_arquivar_loop()))
+    _LEADER["tasks"] += tasks
+
+async def _stop_singletons():
+    tasks = _LEADER["tasks"] + list(_BROADCAST_TASKS.values())
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _LEADER["tasks"] = []
+    _BROADCAST_TASKS.clear()
+    _BROADCAST_RUNS.clear()
+
+async def _leader_tick():
+    try:
+        ok = await asyncio.to_thread(LEADER_LEASE.try_acquire)
+    except Exception as e:
+        # banco indisponível: seguimos líderes só enquanto o último lease valer
+        logging.warning("[lider] falha ao renovar lease: %s", e)
+        ok = _LEADER["ativo"] and time.time() < LEADER_LEASE.valido_ate
+    if ok and not _LEADER["ativo"]:
+        logging.info("[lider] %s assumiu os singletons", WORKER_ID)
+        _LEADER["ativo"] = True
+        IS_LEADER.set(1)
+        LEADER_CHANGES.inc("acquired")
+        await _start_singletons()
+    elif not ok and _LEADER["ativo"]:
+        logging.warning("[lider] %s perdeu o lease; parando singletons", WORKER_ID)
+        _LEADER["ativo"] = False
+        IS_LEADER.set(0)
+        LEADER_CHANGES.inc("lost")
+        await _stop_singletons()
+
+async def _leader_loop():
+    while True:
+        await asyncio.sleep(LEASE_TTL / 3)
+        await _leader_tick()
+
 # ========= INICIAR BOT =========
+_BOT = None
+_DP = None
+_APP = None
+
+def get_bot() -> Bot:
+    global _BOT
+    if _BOT is None:
+        _BOT = Bot(token=TOKEN)
+    return _BOT
+
+def get_dispatcher() -> Dispatcher:
+    global _DP
+    if _DP is None:
+        _DP = Dispatcher()
+        _DP.update.outer_middleware(LogContextMiddleware())
+        _DP.include_router(router)
+    return _DP
+
+def create_app() -> FastAPI:
+    app = FastAPI()
+    app.middleware("http")(http_metrics_middleware)
+    app.include_router(api)
+    app.add_event_handler("startup", on_startup)
+    app.add_event_handler("shutdown", on_shutdown)
+    return app
+
+def get_app() -> FastAPI:
+    global _APP
+    if _APP is None:
+        _APP = create_app()
+    return _APP
+
+def __getattr__(name):
+    # compatibilidade: "bot_main:app" (uvicorn/gunicorn), bot_main.bot e bot_main.dp
+    if name == "app":
+        return get_app()
+    if name == "bot":
+        return get_bot()
+    if name == "dp":
+        return get_dispatcher()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 async def _run_polling_forever():
     backoff = 1
     while True:
         try:
             logging.info("[polling] iniciando polling…")
-            await dp.start_polling(bot)
+            await get_dispatcher().start_polling(get_bot())
         except Exception as e:
             logging.error("[polling] caiu: %s", e)
             await asyncio.sleep(backoff)
             backoff = min(backoff * 2, 30)
 
-@app.on_event("startup")
-async def on_startup():
+async def _timed(phase: str, fn):
+    # funções síncronas (DB, requests) vão para uma thread para não travar o loop
+    t0 = time.perf_counter()
     try:
-        await bot.delete_webhook(drop_pending_updates=True)
-        logging.info("[startup] webhook deletado")
-    except Exception as e:
-        logging.warning("[startup] delete_webhook falhou, mas vou ignorar: %s", e)
+        if asyncio.iscoroutinefunction(fn):
+            return await fn()
+        return await asyncio.to_thread(fn)
+    finally:
+        STARTUP_SECONDS.set(time.perf_counter() - t0, phase)
 
-        # limpeza preventiva de travas antigas (15 minutos)
-    try:
-        n = sweep_old_withdraw_locks(None, max_age_minutes=15)
-        if n:
-            logging.info("[startup] sweep de withdrawals antigos: %s corrigidos", n)
-    except Exception as e:
-        logging.warning("[startup] sweep_old_withdraw_locks erro: %s", e)
+async def _delete_webhook():
+    await get_bot().delete_webhook(drop_pending_updates=True)
+    logging.info("[startup] webhook deletado")
 
+async def warm_up() -> dict:
+    """
+    Aquece, em paralelo, o que o primeiro usuário precisaria: preço do TON,
+    catálogo de animais e saldo do app — além do delete_webhook.
+    Retorna a duração de cada etapa (s); falhas são só logadas.
+    """
+    tasks = {
+        "delete_webhook": _delete_webhook,
+        "price": get_ton_price_brl,
+        "animais": get_animais,
+    }
+    if CRYPTOPAY_TOKEN:
+        tasks["app_balance"] = refresh_app_balances
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*(_timed(k, fn) for k, fn in tasks.items()), return_exceptions=True)
+    for name, res in zip(tasks, results):
+        if isinstance(res, Exception):
+            logging.warning("[startup] warm-up %s falhou, mas vou ignorar: %s", name, res)
+    STARTUP_SECONDS.set(time.perf_counter() - t0, "warm_up")
+    return {k: STARTUP_SECONDS.value(k) for k in tasks}
 
-    asyncio.create_task(_run_polling_forever())
-    asyncio.create_task(_refresh_price_loop())
+async def on_startup():
+    t0 = time.perf_counter()
+    await _timed("migrate", migrate)
+    await _timed("storage", init_storage)
+
+    # o renew loop sobe antes de tudo; o líder faz warm_up e sobe
+    # polling/loops em background, os demais só aquecem o catálogo
+    await _leader_tick()
+    asyncio.create_task(_leader_loop())
+    if not _LEADER["ativo"]:
+        holder = await asyncio.to_thread(LEADER_LEASE.holder)
+        logging.info("[startup] %s seguidor (líder: %s)", WORKER_ID, holder["dono"] if holder else "?")
+        await _timed("animais", get_animais)
+
+    asyncio.create_task(_loop_lag_monitor())
+    if LOOP_BLOCK_THRESHOLD > 0:
+        LOOP_WATCHDOG.start()
+    STARTUP_SECONDS.set(time.perf_counter() - t0, "total")
+    logging.info("[startup] pronto em %.0f ms", (time.perf_counter() - t0) * 1000)
+
+async def on_shutdown():
+    if _LEADER["ativo"]:
+        await _stop_singletons()
+        # libera já, para outro worker assumir sem esperar o TTL
+        await asyncio.to_thread(LEADER_LEASE.release)
+        _LEADER["ativo"] = False
+        IS_LEADER.set(0)
+    await close_storage()
+    LOOP_WATCHDOG.stop()
 
 # ========== FASTAPI MAIN ==========
+# log_config=None: o uvicorn não instala handlers próprios e os logs dele
+# passam pela fila (ver logs.py; no gunicorn, configurar() já os devolve ao root)
 if __name__ == '__main__':
-    uvicorn.run("fazenda_ton_bot.bot_main:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run("fazenda_ton_bot.bot_main:app", host="0.0.0.0", port=8000, reload=True, log_config=None)
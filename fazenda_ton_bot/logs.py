@@ -0,0 +1,177 @@
+"""
+Logging estruturado e sem bloqueio da Fazenda TON.
+
+- configurar(): o root logger ganha só um QueueHandler; quem escreve no
+  stderr é um QueueListener numa thread própria. No event loop, emitir um
+  log é montar a mensagem e um put_nowait numa fila limitada (cheia → o
+  registro é descartado e contado, nunca espera o disco).
+- Cada registro leva o contexto do update em andamento (update_id, user_id,
+  handler e duration_ms desde o início do update), lido do ContextVar
+  LOG_CONTEXT na thread de quem loga — inclusive em asyncio.to_thread, que
+  copia o contexto. Exceção: o "Update id=… is handled" do aiogram.event
+  sai depois que o middleware já devolveu o contexto; esse registro leva só
+  o update_id (tirado dos args) e a duração que já vem na mensagem.
+- Amostragem: INFO (e abaixo) dos loggers barulhentos (`amostrar`, ex.:
+  aiogram.event, que loga cada update) passa só numa fração; WARNING e
+  acima passam sempre.
+- Saída em JSON, uma linha por registro (LOG_FORMAT=text no bot_main volta
+  ao formato legível).
+- uvicorn e gunicorn instalam handlers próprios (uvicorn.error/access com
+  propagate=False no UvicornWorker); configurar() tira esses handlers e os
+  devolve ao root, para que passem pela mesma fila. No uvicorn.run, use
+  log_config=None para ele não reconfigurar depois.
+"""
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+import traceback
+from datetime import datetime, timezone
+
+# {"update_id", "user_id", "handler", "t0" (perf_counter do início do update)}
+LOG_CONTEXT = contextvars.ContextVar("log_context", default=None)
+
+CAMPOS_CONTEXTO = ("update_id", "user_id", "handler")
+
+# loggers que o servidor configura por conta própria; configurar() os devolve ao root
+LOGGERS_SERVIDOR = ("uvicorn", "uvicorn.error", "uvicorn.access", "gunicorn.error", "gunicorn.access")
+
+
+def contexto_log(**campos):
+    """Acrescenta campos ao contexto de log atual; devolve o token para LOG_CONTEXT.reset()."""
+    return LOG_CONTEXT.set({**(LOG_CONTEXT.get() or {}), **campos})
+
+
+def parse_amostragem(txt: str) -> dict[str, float]:
+    """"aiogram.event=0.05,httpx=0.1" → {"aiogram.event": 0.05, "httpx": 0.1}"""
+    out = {}
+    for parte in (txt or "").split(","):
+        nome, _, taxa = parte.strip().partition("=")
+        if nome and taxa:
+            out[nome] = float(taxa)
+    return out
+
+
+class _Contexto(logging.Filter):
+    """Amostra os INFO barulhentos e grava o contexto do update no registro."""
+
+    def __init__(self, amostrar: dict[str, float], ao_descartar=None):
+        super().__init__()
+        self.amostrar = amostrar
+        self.ao_descartar = ao_descartar
+
+    def _taxa(self, nome: str):
+        # "aiogram" vale para "aiogram.event" e filhos
+        while nome:
+            if nome in self.amostrar:
+                return self.amostrar[nome]
+            nome = nome.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        if record.levelno <= logging.INFO and self.amostrar:
+            taxa = self._taxa(record.name)
+            if taxa is not None and random.random() >= taxa:
+                if self.ao_descartar:
+                    self.ao_descartar("amostragem", record.name)
+                return False
+        ctx = LOG_CONTEXT.get()
+        if record.name == "aiogram.event" and not (ctx and "update_id" in ctx) \
+                and record.args and isinstance(record.args[0], int):
+            # "Update id=%s is handled ..." / "... process update id=%d ...": fora do middleware
+            record.update_id = record.args[0]
+        if ctx:
+            for k in CAMPOS_CONTEXTO:
+                if ctx.get(k) is not None:
+                    setattr(record, k, ctx[k])
+            if "t0" in ctx:
+                record.duration_ms = round((time.perf_counter() - ctx["t0"]) * 1000, 1)
+        return True
+
+
+class _FilaHandler(logging.handlers.QueueHandler):
+    def __init__(self, fila, ao_descartar=None):
+        super().__init__(fila)
+        self.ao_descartar = ao_descartar
+
+    def prepare(self, record):
+        # a mensagem é montada aqui (os args podem mudar depois); o traceback
+        # vira texto só quando existe, e a formatação final fica no listener
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        if record.exc_info:
+            record.exc = "".join(traceback.format_exception(*record.exc_info)).rstrip()
+        record.msg, record.args, record.exc_info, record.exc_text = record.message, None, None, None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.ao_descartar:
+                self.ao_descartar("fila_cheia", record.name)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        out = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for k in CAMPOS_CONTEXTO + ("duration_ms",):
+            v = getattr(record, k, None)
+            if v is not None:
+                out[k] = v
+        if record.threadName != "MainThread":
+            out["thread"] = record.threadName
+        exc = getattr(record, "exc", None)
+        if exc:
+            out["exc"] = exc
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class TextoFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(levelname)s:%(name)s:%(message)s")
+
+    def format(self, record):
+        linha = super().format(record)
+        ctx = " ".join(f"{k}={getattr(record, k)}" for k in CAMPOS_CONTEXTO + ("duration_ms",)
+                       if getattr(record, k, None) is not None)
+        exc = getattr(record, "exc", None)
+        return linha + (f" [{ctx}]" if ctx else "") + (f"\n{exc}" if exc else "")
+
+
+def configurar(level: str = "INFO", formato: str = "json", amostrar: dict[str, float] | None = None,
+               tamanho_fila: int = 10000, ao_descartar=None, stream=None) -> logging.handlers.QueueListener:
+    """
+    Troca os handlers do root logger por um QueueHandler e inicia o listener.
+    `ao_descartar(motivo, logger)` é chamado para cada registro descartado
+    (amostragem ou fila cheia). Retorna o listener (pare com .stop()).
+    """
+    fila = queue.Queue(maxsize=tamanho_fila)
+    saida = logging.StreamHandler(stream or sys.stderr)
+    saida.setFormatter(JsonFormatter() if formato == "json" else TextoFormatter())
+    listener = logging.handlers.QueueListener(fila, saida, respect_handler_level=False)
+
+    entrada = _FilaHandler(fila, ao_descartar)
+    entrada.addFilter(_Contexto(amostrar or {}, ao_descartar))
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(entrada)
+    root.setLevel(level)
+    for nome in LOGGERS_SERVIDOR:
+        lg = logging.getLogger(nome)
+        for h in list(lg.handlers):
+            lg.removeHandler(h)
+        lg.propagate = True
+    listener.start()
+    return listener
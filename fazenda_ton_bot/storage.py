@@ -0,0 +1,1811 @@
+"""
+Camada de persistência da Fazenda TON.
+
+Os handlers do bot_main não falam SQL com as tabelas de jogo: usam os
+repositórios de um Storage, um por domínio:
+
+- users        (usuarios: saldos, carteira, bônus, destinatários do broadcast)
+- inventory    (inventario + catálogo de animais: compra, produção, coleta)
+- payments     (pagamentos: crédito idempotente de invoices + indicação;
+                invoices: as criadas pelo bot, para a conferência sem webhook)
+- withdrawals  (withdrawals: reserva, status, estorno, reconciliação)
+- tokens       (cb_tokens: botões inline de uso único)
+- referrals    (indicacoes)
+
+Os contratos são ABCs: um backend que esquece um método falha ao montar o
+Storage, não na primeira chamada.
+
+Backends:
+
+- SqliteStorage: o arquivo de sempre. Recebe a fábrica de conexões do
+  bot_main (db_conn, com métricas) e o schema continua vindo de migrate().
+  Os métodos são `async` só pela interface: rodam inline no loop, como o
+  código rodava antes.
+- ShardedSqliteStorage: tabelas por usuário (usuarios, inventario,
+  withdrawals, cb_tokens) espalhadas em N arquivos SQLite pelo hash do
+  telegram_id, cada um com seu próprio lock de escrita; pagamentos e
+  indicacoes ficam no banco principal.
+- PostgresStorage: asyncpg com pool de conexões; create_schema() cria as
+  tabelas (idempotente) e sincroniza o catálogo de animais.
+
+Nos dois SQLite, `arquivo` (opcional) é uma fábrica de conexões com o banco
+de arquivo anexado como `arq` (linhas antigas de pagamentos, saques,
+withdrawals e cb_tokens; ver "Arquivamento" no bot_main): o crédito de
+invoice, a contagem de pagantes e o reset hard olham os dois.
+
+Datas continuam como texto ISO (datetime.isoformat()) nos dois backends, para
+que as regras de tempo (bônus de 24h, produção desde ultima_coleta) se
+comportem igual; só withdrawals usa TIMESTAMP (UTC) no Postgres.
+"""
+import functools
+import heapq
+import os
+import sqlite3
+import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from datetime import datetime
+
+# colunas de saldo aceitas pelos comandos de admin
+CAMPOS_SALDO = {
+    "cash": "saldo_cash",
+    "pag":  "saldo_cash_pagamentos",
+    "ton":  "saldo_ton",
+    "mats": "saldo_materiais",
+}
+
+# colunas de "último resgate" das recompensas com intervalo (bônus diário...)
+CAMPOS_COOLDOWN = {
+    "bonus": "ultimo_bonus",
+}
+
+SALDOS_VAZIOS = {"cash": 0, "pag": 0, "ton": 0, "mats": 0}
+
+
+def _iso_now() -> str:
+    return datetime.now().isoformat()
+
+
+# ===== Contratos (um por domínio) =====
+class UsersRepo(ABC):
+    @abstractmethod
+    async def ensure(self, uid: int) -> bool:
+        """Cria o usuário se não existir; True se criou."""
+
+    @abstractmethod
+    async def touch(self, uid: int) -> bool:
+        """ensure() do /start: também limpa bloqueado_em (voltou a falar com o bot)."""
+
+    @abstractmethod
+    async def balances(self, uid: int) -> dict | None:
+        """{"cash", "pag", "ton", "mats"} ou None se o usuário não existe."""
+
+    @abstractmethod
+    async def materials(self, uid: int) -> float:
+        ...
+
+    @abstractmethod
+    async def wallet(self, uid: int) -> str | None:
+        ...
+
+    @abstractmethod
+    async def set_wallet(self, uid: int, wallet: str):
+        ...
+
+    @abstractmethod
+    async def last_claim(self, uid: int, campo: str) -> str | None:
+        """ISO do último resgate da recompensa `campo` (CAMPOS_COOLDOWN) ou None."""
+
+    @abstractmethod
+    async def claim_reward(self, uid: int, campo: str, saldo: str, valor: float,
+                           agora: str, desde: str) -> tuple[float | None, str | None]:
+        """
+        Resgate condicional num UPDATE só: credita `valor` em `saldo` (CAMPOS_SALDO)
+        e grava `agora` em `campo` somente se o último resgate for <= `desde`.
+        Retorna (novo saldo, None) ou (None, ISO do último resgate) se recusado.
+        """
+
+    @abstractmethod
+    async def sell_materials(self, uid: int, usado: int, to_pag: int, to_cash: int) -> float | None:
+        """Debita `usado` materiais e credita os dois cash. Retorna a sobra ou None se não havia materiais."""
+
+    @abstractmethod
+    async def swap_pag_to_ton(self, uid: int, amount: float, ton_out: float) -> float | None:
+        """Cash de pagamentos → TON. Retorna o novo saldo TON ou None se faltou saldo."""
+
+    @abstractmethod
+    async def credit_ton(self, uid: int, amount: float):
+        ...
+
+    @abstractmethod
+    async def add_balance(self, uid: int, campo: str, valor: float):
+        ...
+
+    @abstractmethod
+    async def set_balance(self, uid: int, campo: str, valor: float):
+        ...
+
+    @abstractmethod
+    async def reset_balances(self, uid: int):
+        ...
+
+    @abstractmethod
+    async def purge(self, uid: int, hard: bool):
+        """soft: zera saldos e inventário; hard: apaga a conta e tudo ligado a ela."""
+
+    @abstractmethod
+    async def count(self, since: str | None = None) -> int:
+        ...
+
+    @abstractmethod
+    async def recipients(self, after_uid: int, limit: int) -> list[int]:
+        """Até `limit` ids não bloqueados acima de `after_uid`, em ordem (keyset do broadcast)."""
+
+    @abstractmethod
+    async def count_recipients(self) -> int:
+        ...
+
+    @abstractmethod
+    async def mark_blocked(self, uids: list[int], agora: str):
+        """Grava bloqueado_em (bloqueou o bot / chat inexistente); touch() limpa."""
+
+
+class InventoryRepo(ABC):
+    @abstractmethod
+    async def daily_yield(self, uid: int) -> float:
+        ...
+
+    @abstractmethod
+    async def production(self, uid: int) -> list[dict]:
+        """Itens do inventário com rendimento/emoji, do animal mais barato ao mais caro."""
+
+    @abstractmethod
+    async def fill_missing_collect(self, uid: int, agora: str):
+        ...
+
+    @abstractmethod
+    async def buy(self, uid: int, animal: str, preco: int, agora: str) -> bool:
+        """Debita o preço e soma 1 animal; False se o cash não cobre."""
+
+    @abstractmethod
+    async def collect(self, uid: int, agora: str) -> tuple[int, float, float]:
+        """Credita a produção acumulada. Retorna (1 ou 0, total coletado, saldo_materiais)."""
+
+
+class PaymentsRepo(ABC):
+    @abstractmethod
+    async def credit_invoice(self, invoice_id: str, uid: int, reais: float, cash: int,
+                             ref_pct: float) -> dict | None:
+        """
+        Registra a invoice paga e credita o usuário (e quem o indicou) numa
+        transação. None se a invoice já tinha sido creditada; senão
+        {"ref_id": int | None, "bonus": int}.
+        """
+
+    @abstractmethod
+    async def payers(self) -> int:
+        ...
+
+    @abstractmethod
+    async def credited(self, invoice_id: str) -> bool:
+        """True se a invoice já foi creditada (está em pagamentos)."""
+
+    @abstractmethod
+    async def record_invoice(self, invoice_id: str, uid: int, reais: float, url: str):
+        """Guarda uma invoice recém-criada (status 'active')."""
+
+    @abstractmethod
+    async def open_invoices(self, since: str, limit: int) -> list[str]:
+        """ids das invoices 'active' criadas desde `since` (ISO) e ainda sem pagamento creditado."""
+
+    @abstractmethod
+    async def close_invoices(self, invoice_ids: list[str], status: str):
+        """Marca as invoices como 'paid' ou 'expired' (saem da conferência)."""
+
+    @abstractmethod
+    async def prune_invoices(self, before: str) -> int:
+        """Apaga as invoices criadas antes de `before` (ISO), abertas ou não; retorna quantas."""
+
+
+class WithdrawalsRepo(ABC):
+    @abstractmethod
+    async def stuck(self, uid: int | None, max_age_minutes: int, limit: int, after_id: int = 0) -> list[dict]:
+        """
+        Saques 'pending'/'processing' criados há mais de max_age_minutes, com
+        id > after_id, em ordem de id: {"id", "user_id", "requested_ton",
+        "idempotency_key", "created_at" (UTC, "AAAA-MM-DD HH:MM:SS")}.
+        """
+
+    @abstractmethod
+    async def settle(self, done: list[int], failed: list[int]) -> dict:
+        """
+        Numa transação: marca `done` como 'done' e `failed` como 'failed' com
+        estorno do TON, só os que ainda estão em andamento.
+        Retorna {"done": n, "estornos": [(id, user_id, ton)]}.
+        """
+
+    @abstractmethod
+    async def reserved(self, snapshot_at: str) -> float:
+        """TON em saques em andamento ou concluídos depois do snapshot do cofre."""
+
+    @abstractmethod
+    async def reserve(self, uid: int, amount_ton: float, wallet: str, idemp: str,
+                      avail: float | None, snapshot_at: str) -> tuple[int | None, str]:
+        """(id, "ok") ou (None, motivo) com motivo em {"cofre", "lock", "saldo"}."""
+
+    @abstractmethod
+    async def set_status(self, wid: int, status: str) -> bool:
+        """Muda o status só se o saque ainda está em andamento; False se já tinha sido finalizado."""
+
+    @abstractmethod
+    async def refund(self, wid: int, uid: int, amount_ton: float) -> bool:
+        """
+        Marca o withdrawal como 'failed' e devolve o TON ao usuário, só se ainda
+        estava em andamento (False: já finalizado, nada foi creditado).
+        """
+
+
+class TokensRepo(ABC):
+    @abstractmethod
+    async def new(self, uid: int, action: str, payload: str = "", ttl: int = 600) -> str:
+        ...
+
+    @abstractmethod
+    async def use(self, token: str, uid: int, action: str) -> tuple[bool, str | None, str]:
+        """(True, payload, "") ou (False, None, motivo) com motivo em {"expirado", "invalido", "usado"}."""
+
+
+class ReferralsRepo(ABC):
+    @abstractmethod
+    async def register(self, quem: int, por: int) -> bool:
+        ...
+
+    @abstractmethod
+    async def count(self, por: int) -> int:
+        ...
+
+
+class Storage:
+    backend = "?"
+    users: UsersRepo
+    inventory: InventoryRepo
+    payments: PaymentsRepo
+    withdrawals: WithdrawalsRepo
+    tokens: TokensRepo
+    referrals: ReferralsRepo
+
+    async def close(self):
+        pass
+
+
+# ===== SQLite =====
+def auto_vacuum_incremental(c) -> bool:
+    """
+    Num arquivo ainda sem tabelas, liga auto_vacuum=INCREMENTAL (para a
+    manutenção poder devolver páginas livres aos poucos). Com o WAL já ativo o
+    modo só vale depois de um VACUUM, instantâneo com o arquivo vazio.
+    Arquivos com tabelas ficam como estão. Fora de transação.
+    """
+    if c.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()[0]:
+        return False
+    c.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    c.execute("VACUUM")
+    return True
+
+def coletar_producao(c, uid_de: int, uid_ate: int, agora: str) -> tuple[int, float]:
+    """
+    Credita em saldo_materiais a produção acumulada de todos os usuários com
+    telegram_id em [uid_de, uid_ate] e zera o relógio (ultima_coleta=agora).
+    Mesma conta de _produzido_desde, feita em SQL (rendimento é por dia, então
+    basta a diferença em julianday). Como na coleta manual, só entra quem tem
+    mais de 0.01 para coletar. Chamar dentro de BEGIN IMMEDIATE.
+    Retorna (usuários creditados, total creditado).
+    """
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS _coleta (uid INTEGER PRIMARY KEY, prod REAL)")
+    c.execute("DELETE FROM _coleta")
+    c.execute(
+        """
+        INSERT INTO _coleta (uid, prod)
+        SELECT i.telegram_id,
+               ROUND(SUM(a.rendimento * i.quantidade * MAX(0, julianday(?) - julianday(i.ultima_coleta))), 6) AS prod
+          FROM inventario i
+          JOIN animais a ON a.nome = i.animal
+         WHERE i.telegram_id BETWEEN ? AND ?
+         GROUP BY i.telegram_id
+        HAVING prod > 0.01
+        """,
+        (agora, uid_de, uid_ate)
+    )
+    c.execute(
+        """
+        UPDATE usuarios
+           SET saldo_materiais = COALESCE(saldo_materiais, 0) + (SELECT prod FROM _coleta WHERE uid = usuarios.telegram_id)
+         WHERE telegram_id IN (SELECT uid FROM _coleta)
+        """
+    )
+    c.execute(
+        "UPDATE inventario SET ultima_coleta = ? WHERE telegram_id IN (SELECT uid FROM _coleta)",
+        (agora,)
+    )
+    r = c.execute("SELECT COUNT(*) AS n, COALESCE(SUM(prod), 0) AS total FROM _coleta").fetchone()
+    return r["n"], r["total"]
+
+
+class _SqliteRepo:
+    def __init__(self, connect, arquivo=None):
+        self.connect = connect
+        self.arquivo = arquivo
+
+
+class SqliteUsers(_SqliteRepo, UsersRepo):
+    async def ensure(self, uid):
+        with self.connect() as c:
+            return c.execute(
+                "INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)",
+                (uid, _iso_now())
+            ).rowcount == 1
+
+    async def touch(self, uid):
+        with self.connect() as c:
+            novo = c.execute(
+                "INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)",
+                (uid, _iso_now())
+            ).rowcount == 1
+            c.execute(
+                "UPDATE usuarios SET bloqueado_em=NULL WHERE telegram_id=? AND bloqueado_em IS NOT NULL",
+                (uid,)
+            )
+        return novo
+
+    async def balances(self, uid):
+        with self.connect() as c:
+            r = c.execute("""
+                SELECT COALESCE(saldo_cash,0)            AS cash,
+                       COALESCE(saldo_cash_pagamentos,0) AS pag,
+                       COALESCE(saldo_ton,0)             AS ton,
+                       COALESCE(saldo_materiais,0)       AS mats
+                  FROM usuarios WHERE telegram_id=?
+            """, (uid,)).fetchone()
+        return dict(r) if r else None
+
+    async def materials(self, uid):
+        with self.connect() as c:
+            r = c.execute(
+                "SELECT COALESCE(saldo_materiais,0) AS m FROM usuarios WHERE telegram_id=?",
+                (uid,)
+            ).fetchone()
+        return float(r["m"]) if r else 0.0
+
+    async def wallet(self, uid):
+        with self.connect() as c:
+            r = c.execute("SELECT carteira_ton FROM usuarios WHERE telegram_id=?", (uid,)).fetchone()
+        return r["carteira_ton"] if r and r["carteira_ton"] else None
+
+    async def set_wallet(self, uid, wallet):
+        with self.connect() as c:
+            c.execute(
+                "INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)",
+                (uid, _iso_now())
+            )
+            c.execute("UPDATE usuarios SET carteira_ton=? WHERE telegram_id=?", (wallet, uid))
+
+    async def last_claim(self, uid, campo):
+        col = CAMPOS_COOLDOWN[campo]
+        with self.connect() as c:
+            r = c.execute(f"SELECT {col} AS u FROM usuarios WHERE telegram_id=?", (uid,)).fetchone()
+        return r["u"] if r else None
+
+    async def claim_reward(self, uid, campo, saldo, valor, agora, desde):
+        col, scol = CAMPOS_COOLDOWN[campo], CAMPOS_SALDO[saldo]
+        with self.connect() as c:
+            # fetchall: o UPDATE ... RETURNING só termina (e solta o lock) depois de esgotado
+            rows = c.execute(
+                f"UPDATE usuarios SET {scol} = COALESCE({scol},0) + ?, {col} = ? "
+                f"WHERE telegram_id=? AND ({col} IS NULL OR {col} <= ?) RETURNING {scol} AS s",
+                (valor, agora, uid, desde)
+            ).fetchall()
+            if rows:
+                return float(rows[0]["s"]), None
+            r = c.execute(f"SELECT {col} AS u FROM usuarios WHERE telegram_id=?", (uid,)).fetchone()
+        return None, (r["u"] if r else None)
+
+    async def sell_materials(self, uid, usado, to_pag, to_cash):
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            cur = c.execute("""
+                UPDATE usuarios
+                   SET saldo_materiais = saldo_materiais - ?,
+                       saldo_cash_pagamentos = COALESCE(saldo_cash_pagamentos,0) + ?,
+                       saldo_cash = COALESCE(saldo_cash,0) + ?
+                 WHERE telegram_id = ? AND saldo_materiais >= ?
+            """, (usado, to_pag, to_cash, uid, usado))
+            if cur.rowcount != 1:
+                return None
+            r = c.execute("SELECT saldo_materiais AS m FROM usuarios WHERE telegram_id=?", (uid,)).fetchone()
+        return float(r["m"])
+
+    async def swap_pag_to_ton(self, uid, amount, ton_out):
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            cur = c.execute(
+                "UPDATE usuarios SET saldo_cash_pagamentos=saldo_cash_pagamentos-?, saldo_ton=COALESCE(saldo_ton,0)+? "
+                "WHERE telegram_id=? AND saldo_cash_pagamentos >= ?",
+                (amount, ton_out, uid, amount)
+            )
+            if cur.rowcount != 1:
+                return None
+            r = c.execute("SELECT saldo_ton AS s FROM usuarios WHERE telegram_id=?", (uid,)).fetchone()
+        return float(r["s"])
+
+    async def credit_ton(self, uid, amount):
+        with self.connect() as c:
+            c.execute("UPDATE usuarios SET saldo_ton = COALESCE(saldo_ton,0) + ? WHERE telegram_id=?", (amount, uid))
+
+    async def add_balance(self, uid, campo, valor):
+        col = CAMPOS_SALDO[campo]
+        with self.connect() as c:
+            c.execute(f"UPDATE usuarios SET {col}=COALESCE({col},0)+? WHERE telegram_id=?", (valor, uid))
+
+    async def set_balance(self, uid, campo, valor):
+        col = CAMPOS_SALDO[campo]
+        with self.connect() as c:
+            c.execute(f"UPDATE usuarios SET {col}=? WHERE telegram_id=?", (valor, uid))
+
+    async def reset_balances(self, uid):
+        with self.connect() as c:
+            c.execute("""
+                UPDATE usuarios SET
+                    saldo_cash=0,
+                    saldo_cash_pagamentos=0,
+                    saldo_ton=0,
+                    saldo_materiais=0
+                WHERE telegram_id=?
+            """, (uid,))
+
+    async def purge(self, uid, hard):
+        with (self.arquivo if hard and self.arquivo else self.connect)() as c:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute("""
+                UPDATE usuarios SET
+                    saldo_cash=0,
+                    saldo_cash_pagamentos=0,
+                    saldo_ton=0,
+                    saldo_materiais=0
+                WHERE telegram_id=?
+            """, (uid,))
+            c.execute("DELETE FROM inventario WHERE telegram_id=?", (uid,))
+            if hard:
+                c.execute("DELETE FROM saques WHERE telegram_id=?", (uid,))
+                c.execute("DELETE FROM withdrawals WHERE user_id=?", (uid,))
+                c.execute("DELETE FROM pagamentos WHERE user_id=?", (uid,))
+                c.execute("DELETE FROM invoices WHERE user_id=?", (uid,))
+                c.execute("DELETE FROM indicacoes WHERE quem=? OR por=?", (uid, uid))
+                c.execute("DELETE FROM usuarios WHERE telegram_id=?", (uid,))
+                if self.arquivo:
+                    _apagar_arquivados(c, uid)
+
+    async def count(self, since=None):
+        with self.connect() as c:
+            if since is None:
+                return c.execute("SELECT COUNT(*) AS n FROM usuarios").fetchone()["n"]
+            return c.execute("SELECT COUNT(*) AS n FROM usuarios WHERE criado_em >= ?", (since,)).fetchone()["n"]
+
+    async def recipients(self, after_uid, limit):
+        with self.connect() as c:
+            return [r[0] for r in c.execute(
+                "SELECT telegram_id FROM usuarios WHERE telegram_id > ? AND bloqueado_em IS NULL "
+                "ORDER BY telegram_id LIMIT ?",
+                (after_uid, limit)
+            )]
+
+    async def count_recipients(self):
+        with self.connect() as c:
+            return c.execute("SELECT COUNT(*) AS n FROM usuarios WHERE bloqueado_em IS NULL").fetchone()["n"]
+
+    async def mark_blocked(self, uids, agora):
+        if uids:
+            with self.connect() as c:
+                c.executemany("UPDATE usuarios SET bloqueado_em=? WHERE telegram_id=?", [(agora, u) for u in uids])
+
+
+class SqliteInventory(_SqliteRepo, InventoryRepo):
+    async def daily_yield(self, uid):
+        with self.connect() as c:
+            return c.execute("""
+                SELECT SUM(quantidade * rendimento)
+                FROM inventario JOIN animais ON inventario.animal = animais.nome
+                WHERE inventario.telegram_id=?
+            """, (uid,)).fetchone()[0] or 0
+
+    async def production(self, uid):
+        with self.connect() as c:
+            rows = c.execute("""
+                SELECT i.animal, i.quantidade, i.ultima_coleta, a.rendimento, a.emoji
+                FROM inventario i
+                JOIN animais a ON a.nome = i.animal
+                WHERE i.telegram_id = ?
+                ORDER BY a.preco ASC
+            """, (uid,)).fetchall()
+        return [dict(r) for r in rows]
+
+    async def fill_missing_collect(self, uid, agora):
+        with self.connect() as c:
+            c.execute("""
+                UPDATE inventario
+                   SET ultima_coleta = COALESCE(ultima_coleta, ?)
+                 WHERE telegram_id = ? AND (ultima_coleta IS NULL OR TRIM(ultima_coleta) = '')
+            """, (agora, uid))
+
+    async def buy(self, uid, animal, preco, agora):
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            cur = c.execute(
+                "UPDATE usuarios SET saldo_cash=saldo_cash-? WHERE telegram_id=? AND saldo_cash >= ?",
+                (preco, uid, preco)
+            )
+            if cur.rowcount != 1:
+                return False
+            c.execute(
+                "INSERT OR IGNORE INTO inventario (telegram_id, animal, quantidade, ultima_coleta) VALUES (?, ?, 0, ?)",
+                (uid, animal, agora)
+            )
+            c.execute(
+                "UPDATE inventario SET quantidade=quantidade+1, ultima_coleta=? WHERE telegram_id=? AND animal=?",
+                (agora, uid, animal)
+            )
+        return True
+
+    async def collect(self, uid, agora):
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            n, total = coletar_producao(c, uid, uid, agora)
+            r = c.execute("SELECT COALESCE(saldo_materiais,0) AS s FROM usuarios WHERE telegram_id=?",
+                          (uid,)).fetchone()
+        return n, total, (r["s"] if r else 0.0)
+
+
+class SqlitePayments(_SqliteRepo, PaymentsRepo):
+    async def credit_invoice(self, invoice_id, uid, reais, cash, ref_pct):
+        agora = _iso_now()
+        with (self.arquivo or self.connect)() as c:
+            # com o lock de escrita do principal, uma invoice que não está nele
+            # ou nunca existiu ou já foi copiada para o arquivo (copia antes de apagar)
+            c.execute("BEGIN IMMEDIATE")
+            if self.arquivo and _invoice_arquivada(c, invoice_id):
+                return None
+            try:
+                c.execute(
+                    "INSERT INTO pagamentos (invoice_id, user_id, valor_reais, cash, criado_em) VALUES (?,?,?,?,?)",
+                    (invoice_id, uid, reais, cash, agora)
+                )
+            except sqlite3.IntegrityError:
+                return None
+
+            c.execute("INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)", (uid, agora))
+            if cash > 0:
+                c.execute(
+                    "UPDATE usuarios SET saldo_cash = COALESCE(saldo_cash,0) + ? WHERE telegram_id=?",
+                    (cash, uid)
+                )
+
+            ref_id, bonus = None, 0
+            row = c.execute("SELECT por FROM indicacoes WHERE quem=?", (uid,)).fetchone()
+            if row:
+                ref_id = int(row["por"])
+                bonus = int(round(cash * ref_pct / 100.0))
+                if bonus > 0:
+                    c.execute("INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)", (ref_id, agora))
+                    c.execute(
+                        "UPDATE usuarios SET saldo_cash = COALESCE(saldo_cash,0) + ? WHERE telegram_id=?",
+                        (bonus, ref_id)
+                    )
+        return {"ref_id": ref_id, "bonus": bonus}
+
+    async def payers(self):
+        with (self.arquivo or self.connect)() as c:
+            return c.execute(_sql_pagantes(self.arquivo)).fetchone()["n"]
+
+    async def credited(self, invoice_id):
+        with self.connect() as c:
+            return _invoice_creditada(c, invoice_id)
+
+    async def record_invoice(self, invoice_id, uid, reais, url):
+        with self.connect() as c:
+            _registrar_invoice(c, invoice_id, uid, reais, url)
+
+    async def open_invoices(self, since, limit):
+        with self.connect() as c:
+            return _invoices_abertas(c, since, limit)
+
+    async def close_invoices(self, invoice_ids, status):
+        with self.connect() as c:
+            _fechar_invoices(c, invoice_ids, status)
+
+    async def prune_invoices(self, before):
+        with self.connect() as c:
+            return _podar_invoices(c, before)
+
+
+class SqliteWithdrawals(_SqliteRepo, WithdrawalsRepo):
+    async def stuck(self, uid, max_age_minutes, limit, after_id=0):
+        # idx_wd_status: só percorre as linhas em andamento, não a tabela
+        sql = """
+            SELECT id, user_id, requested_ton, idempotency_key, created_at
+              FROM withdrawals
+             WHERE status IN ('pending','processing')
+               AND created_at <= DATETIME('now', ?)
+               AND id > ?
+        """
+        params = (f'-{max_age_minutes} minutes', after_id)
+        if uid is not None:
+            sql += " AND user_id = ?"
+            params += (uid,)
+        sql += " ORDER BY id LIMIT ?"
+        with self.connect() as c:
+            return [dict(r) for r in c.execute(sql, params + (limit,))]
+
+    async def settle(self, done, failed):
+        estornos, n = [], 0
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            for wid in done:
+                n += c.execute(
+                    "UPDATE withdrawals SET status='done', updated_at=CURRENT_TIMESTAMP "
+                    "WHERE id=? AND status IN ('pending','processing')", (wid,)
+                ).rowcount
+            for wid in failed:
+                r = c.execute(
+                    "UPDATE withdrawals SET status='failed', updated_at=CURRENT_TIMESTAMP "
+                    "WHERE id=? AND status IN ('pending','processing') RETURNING user_id, requested_ton", (wid,)
+                ).fetchall()
+                if r:
+                    uid, ton = r[0]["user_id"], float(r[0]["requested_ton"])
+                    c.execute("UPDATE usuarios SET saldo_ton = COALESCE(saldo_ton,0) + ? WHERE telegram_id=?", (ton, uid))
+                    estornos.append((wid, uid, ton))
+        return {"done": n, "estornos": estornos}
+
+    @staticmethod
+    def _reserved(c, snapshot_at):
+        row = c.execute(
+            """
+            SELECT COALESCE(SUM(requested_ton), 0) AS s
+              FROM withdrawals
+             WHERE status IN ('pending','processing')
+                OR (status = 'done' AND updated_at >= ?)
+            """,
+            (snapshot_at,)
+        ).fetchone()
+        return float(row["s"] or 0.0)
+
+    async def reserved(self, snapshot_at):
+        with self.connect() as c:
+            return self._reserved(c, snapshot_at)
+
+    async def reserve(self, uid, amount_ton, wallet, idemp, avail, snapshot_at):
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            if avail is not None and avail - self._reserved(c, snapshot_at) + 1e-9 < amount_ton:
+                return None, "cofre"
+
+            r = c.execute(
+                """
+                SELECT COUNT(*) AS n
+                  FROM withdrawals
+                 WHERE user_id = ?
+                   AND status = 'processing'
+                   AND created_at > DATETIME('now', '-15 minutes')
+                """,
+                (uid,)
+            ).fetchone()
+            if r["n"] > 0:
+                return None, "lock"
+
+            cur = c.execute(
+                "UPDATE usuarios SET saldo_ton = saldo_ton - ? WHERE telegram_id=? AND saldo_ton >= ?",
+                (amount_ton, uid, amount_ton)
+            )
+            if cur.rowcount != 1:
+                return None, "saldo"
+
+            c.execute("""INSERT INTO withdrawals (user_id, requested_ton, wallet, status, idempotency_key)
+                         VALUES (?,?,?,?,?)""", (uid, amount_ton, wallet, 'processing', idemp))
+            return c.execute("SELECT last_insert_rowid() id").fetchone()["id"], "ok"
+
+    async def set_status(self, wid, status):
+        with self.connect() as c:
+            return c.execute(
+                "UPDATE withdrawals SET status=?, updated_at=CURRENT_TIMESTAMP "
+                "WHERE id=? AND status IN ('pending','processing')", (status, wid)
+            ).rowcount == 1
+
+    async def refund(self, wid, uid, amount_ton):
+        with self.connect() as c:
+            c.execute("BEGIN IMMEDIATE")
+            if c.execute(
+                "UPDATE withdrawals SET status='failed', updated_at=CURRENT_TIMESTAMP "
+                "WHERE id=? AND status IN ('pending','processing')", (wid,)
+            ).rowcount != 1:
+                return False
+            c.execute("UPDATE usuarios SET saldo_ton = saldo_ton + ? WHERE telegram_id=?", (amount_ton, uid))
+        return True
+
+
+class SqliteTokens(_SqliteRepo, TokensRepo):
+    async def new(self, uid, action, payload="", ttl=600):
+        token = uuid.uuid4().hex[:8]
+        with self.connect() as c:
+            c.execute(
+                "INSERT OR REPLACE INTO cb_tokens (id, user_id, action, payload, expires_at, used, created_at) "
+                "VALUES (?, ?, ?, ?, ?, 0, ?)",
+                (token, uid, action, payload, int(time.time()) + ttl, _iso_now())
+            )
+        return token
+
+    async def use(self, token, uid, action):
+        # um único UPDATE condicional: dois cliques (ou dois workers) não consomem o mesmo token
+        with self.connect() as c:
+            r = c.execute(
+                """
+                UPDATE cb_tokens SET used=1
+                 WHERE id=? AND user_id=? AND action=? AND used=0 AND expires_at >= ?
+             RETURNING payload
+                """,
+                (token, uid, action, int(time.time()))
+            ).fetchall()  # fetchall: o statement termina (e solta o lock de escrita) aqui
+            if r:
+                return True, (r[0]["payload"] if r[0]["payload"] is not None else ""), ""
+            row = c.execute(
+                "SELECT user_id, action, payload, expires_at, used FROM cb_tokens WHERE id=?",
+                (token,)
+            ).fetchone()
+        return False, None, _token_motivo(row, uid, action) or "usado"
+
+
+class SqliteReferrals(_SqliteRepo, ReferralsRepo):
+    async def register(self, quem, por):
+        with self.connect() as c:
+            return c.execute(
+                "INSERT OR IGNORE INTO indicacoes (quem, por, criado_em) VALUES (?, ?, ?)",
+                (quem, por, _iso_now())
+            ).rowcount == 1
+
+    async def count(self, por):
+        with self.connect() as c:
+            return c.execute("SELECT COUNT(*) AS n FROM indicacoes WHERE por=?", (por,)).fetchone()["n"]
+
+
+class SqliteStorage(Storage):
+    backend = "sqlite"
+
+    def __init__(self, connect, arquivo=None):
+        self.users = SqliteUsers(connect, arquivo)
+        self.inventory = SqliteInventory(connect)
+        self.payments = SqlitePayments(connect, arquivo)
+        self.withdrawals = SqliteWithdrawals(connect)
+        self.tokens = SqliteTokens(connect)
+        self.referrals = SqliteReferrals(connect)
+
+
+def _invoice_arquivada(c, invoice_id: str) -> bool:
+    return c.execute("SELECT 1 FROM arq.pagamentos WHERE invoice_id=?", (invoice_id,)).fetchone() is not None
+
+def _sql_pagantes(arquivo) -> str:
+    if not arquivo:
+        return "SELECT COUNT(DISTINCT user_id) AS n FROM pagamentos"
+    return ("SELECT COUNT(*) AS n FROM "
+            "(SELECT user_id FROM main.pagamentos UNION SELECT user_id FROM arq.pagamentos)")
+
+def _apagar_arquivados(c, uid: int):
+    c.execute("DELETE FROM arq.saques WHERE telegram_id=?", (uid,))
+    c.execute("DELETE FROM arq.withdrawals WHERE user_id=?", (uid,))
+    c.execute("DELETE FROM arq.pagamentos WHERE user_id=?", (uid,))
+
+
+# invoices ficam no mesmo banco que pagamentos (o principal, com ou sem shards)
+def _registrar_invoice(c, invoice_id: str, uid: int, reais: float, url: str):
+    c.execute(
+        "INSERT OR IGNORE INTO invoices (invoice_id, user_id, valor_reais, url, status, criado_em) "
+        "VALUES (?,?,?,?,'active',?)",
+        (invoice_id, uid, reais, url, _iso_now())
+    )
+
+def _invoice_creditada(c, invoice_id: str) -> bool:
+    return c.execute("SELECT 1 FROM pagamentos WHERE invoice_id=?", (invoice_id,)).fetchone() is not None
+
+def _invoices_abertas(c, since: str, limit: int) -> list[str]:
+    # idx_invoices_abertas: percorre só as abertas da janela, não os usuários
+    return [r["invoice_id"] for r in c.execute(
+        """
+        SELECT i.invoice_id
+          FROM invoices i
+         WHERE i.status = 'active' AND i.criado_em >= ?
+           AND NOT EXISTS (SELECT 1 FROM pagamentos p WHERE p.invoice_id = i.invoice_id)
+         ORDER BY i.criado_em
+         LIMIT ?
+        """,
+        (since, limit)
+    )]
+
+def _fechar_invoices(c, invoice_ids: list[str], status: str):
+    c.executemany(
+        "UPDATE invoices SET status=? WHERE invoice_id=? AND status='active'",
+        [(status, i) for i in invoice_ids]
+    )
+
+def _podar_invoices(c, before: str) -> int:
+    # o registro do depósito é pagamentos; fora da janela a linha não serve mais.
+    # IN no status deixa o idx_invoices_abertas (status, criado_em) achar a faixa
+    return c.execute(
+        "DELETE FROM invoices WHERE status IN ('active','paid','expired') AND criado_em < ?",
+        (before,)
+    ).rowcount
+
+
+def _token_motivo(row, uid: int, action: str) -> str:
+    if not row:
+        return "expirado"
+    if int(row["user_id"]) != int(uid) or row["action"] != action:
+        return "invalido"
+    if int(row["used"]) == 1:
+        return "usado"
+    if int(row["expires_at"]) < int(time.time()):
+        return "expirado"
+    return ""
+
+
+# ===== SQLite em shards por usuário =====
+# Quase toda escrita é de um telegram_id só; com um arquivo por shard, usuários
+# em shards diferentes não disputam o mesmo lock de escrita (ganho aparece com
+# vários processos/workers escrevendo ao mesmo tempo). O que cruza shards:
+#
+# - crédito de invoice: o usuário e quem o indicou podem estar em shards
+#   diferentes, e pagamentos fica no banco principal. Cada crédito grava uma
+#   chave em `creditos` do shard na mesma transação do UPDATE de saldo, então
+#   é exatamente-uma-vez por shard; pagamentos/indicação são idempotentes e
+#   rodam de novo no retry de um webhook que caiu no meio;
+# - reserva de saque: a checagem do cofre soma withdrawals de todos os
+#   shards, sob BEGIN IMMEDIATE no banco principal (serializa as reservas);
+# - ids de withdrawal são globais: id_local * N + shard.
+#
+# O número de shards fica gravado em PRAGMA user_version de cada arquivo;
+# trocar SQLITE_SHARDS com dados existentes exige migrar os dados antes.
+SHARD_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS usuarios (
+        telegram_id INTEGER PRIMARY KEY,
+        saldo_cash REAL DEFAULT 0,
+        saldo_cash_pagamentos REAL DEFAULT 0,
+        saldo_ton REAL DEFAULT 0,
+        saldo_materiais REAL DEFAULT 0,
+        carteira_ton TEXT,
+        criado_em TEXT,
+        ultimo_bonus TEXT,
+        bloqueado_em TEXT,
+        lembrete_em TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS animais (
+        nome TEXT PRIMARY KEY,
+        preco INTEGER,
+        rendimento REAL,
+        emoji TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS inventario (
+        telegram_id INTEGER,
+        animal TEXT,
+        quantidade INTEGER DEFAULT 0,
+        ultima_coleta TEXT,
+        PRIMARY KEY (telegram_id, animal)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        requested_ton REAL NOT NULL,
+        wallet TEXT NOT NULL,
+        status TEXT NOT NULL CHECK(status IN ('pending','processing','done','failed')) DEFAULT 'pending',
+        idempotency_key TEXT UNIQUE NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cb_tokens (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        action TEXT NOT NULL,
+        payload TEXT,
+        expires_at INTEGER NOT NULL,
+        used INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS creditos (
+        chave TEXT PRIMARY KEY,
+        telegram_id INTEGER NOT NULL,
+        valor REAL NOT NULL,
+        criado_em TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_inventario_uid ON inventario(telegram_id)",
+    "DROP INDEX IF EXISTS idx_inv_coleta",  # sem leitor (ver migração 8 no bot_main)
+    "CREATE INDEX IF NOT EXISTS idx_wd_user ON withdrawals(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_wd_status ON withdrawals(status, updated_at)",
+]
+
+
+def shard_of(uid: int, n: int) -> int:
+    return zlib.crc32(int(uid).to_bytes(8, "big", signed=True)) % n
+
+
+def shard_paths(db_path: str, n: int) -> list[str]:
+    base, ext = os.path.splitext(db_path)
+    return [f"{base}.shard{k}{ext or '.sqlite3'}" for k in range(n)]
+
+
+class _Shards:
+    def __init__(self, connect, main_path: str, paths: list[str]):
+        self.main = functools.partial(connect, main_path)
+        self.conns = [functools.partial(connect, p) for p in paths]
+        self.n = len(paths)
+
+    def of(self, uid: int) -> int:
+        return shard_of(uid, self.n)
+
+    def conn(self, uid: int):
+        return self.conns[self.of(uid)]
+
+
+class _ShardedRepo:
+    def __init__(self, shards: _Shards, repos: list, arquivo=None):
+        self.shards = shards
+        self.repos = repos
+        self.arquivo = arquivo
+
+    def _repo(self, uid: int):
+        return self.repos[self.shards.of(uid)]
+
+
+def _por_usuario(nome: str):
+    # método que só repassa ao repositório do shard do usuário (1º argumento)
+    async def metodo(self, uid, *args, **kwargs):
+        return await getattr(self._repo(uid), nome)(uid, *args, **kwargs)
+    metodo.__name__ = nome
+    return metodo
+
+
+_ZERA_SALDOS = """
+    UPDATE usuarios SET
+        saldo_cash=0,
+        saldo_cash_pagamentos=0,
+        saldo_ton=0,
+        saldo_materiais=0
+    WHERE telegram_id=?
+"""
+
+
+class ShardedUsers(_ShardedRepo, UsersRepo):
+    ensure = _por_usuario("ensure")
+    touch = _por_usuario("touch")
+    balances = _por_usuario("balances")
+    materials = _por_usuario("materials")
+    wallet = _por_usuario("wallet")
+    set_wallet = _por_usuario("set_wallet")
+    last_claim = _por_usuario("last_claim")
+    claim_reward = _por_usuario("claim_reward")
+    sell_materials = _por_usuario("sell_materials")
+    swap_pag_to_ton = _por_usuario("swap_pag_to_ton")
+    credit_ton = _por_usuario("credit_ton")
+    add_balance = _por_usuario("add_balance")
+    set_balance = _por_usuario("set_balance")
+    reset_balances = _por_usuario("reset_balances")
+
+    async def purge(self, uid, hard):
+        with self.shards.conn(uid)() as c:
+            c.execute("BEGIN IMMEDIATE")
+            c.execute(_ZERA_SALDOS, (uid,))
+            c.execute("DELETE FROM inventario WHERE telegram_id=?", (uid,))
+            if hard:
+                c.execute("DELETE FROM withdrawals WHERE user_id=?", (uid,))
+                c.execute("DELETE FROM usuarios WHERE telegram_id=?", (uid,))
+        if hard:
+            with (self.arquivo or self.shards.main)() as g:
+                g.execute("BEGIN IMMEDIATE")
+                g.execute("DELETE FROM saques WHERE telegram_id=?", (uid,))
+                g.execute("DELETE FROM pagamentos WHERE user_id=?", (uid,))
+                g.execute("DELETE FROM invoices WHERE user_id=?", (uid,))
+                g.execute("DELETE FROM indicacoes WHERE quem=? OR por=?", (uid, uid))
+                if self.arquivo:
+                    _apagar_arquivados(g, uid)
+
+    async def count(self, since=None):
+        return sum([await r.count(since) for r in self.repos])
+
+    async def recipients(self, after_uid, limit):
+        # cada shard devolve sua página em ordem; a global são os `limit` menores
+        paginas = [await r.recipients(after_uid, limit) for r in self.repos]
+        return list(heapq.merge(*paginas))[:limit]
+
+    async def count_recipients(self):
+        return sum([await r.count_recipients() for r in self.repos])
+
+    async def mark_blocked(self, uids, agora):
+        por_shard = defaultdict(list)
+        for uid in uids:
+            por_shard[self.shards.of(uid)].append(uid)
+        for k, lote in por_shard.items():
+            await self.repos[k].mark_blocked(lote, agora)
+
+
+class ShardedInventory(_ShardedRepo, InventoryRepo):
+    daily_yield = _por_usuario("daily_yield")
+    production = _por_usuario("production")
+    fill_missing_collect = _por_usuario("fill_missing_collect")
+    buy = _por_usuario("buy")
+    collect = _por_usuario("collect")
+
+
+class ShardedPayments(PaymentsRepo):
+    def __init__(self, shards: _Shards, arquivo=None):
+        self.shards = shards
+        self.arquivo = arquivo
+
+    def _creditar(self, uid: int, chave: str, cash: int, agora: str) -> bool:
+        with self.shards.conn(uid)() as c:
+            c.execute("BEGIN IMMEDIATE")
+            if c.execute(
+                "INSERT OR IGNORE INTO creditos (chave, telegram_id, valor, criado_em) VALUES (?, ?, ?, ?)",
+                (chave, uid, cash, agora)
+            ).rowcount != 1:
+                return False
+            c.execute("INSERT OR IGNORE INTO usuarios (telegram_id, criado_em) VALUES (?, ?)", (uid, agora))
+            if cash > 0:
+                c.execute(
+                    "UPDATE usuarios SET saldo_cash = COALESCE(saldo_cash,0) + ? WHERE telegram_id=?",
+                    (cash, uid)
+                )
+        return True
+
+    async def credit_invoice(self, invoice_id, uid, reais, cash, ref_pct):
+        agora = _iso_now()
+        novo = self._creditar(uid, f"inv:{invoice_id}", cash, agora)
+        with (self.arquivo or self.shards.main)() as g:
+            g.execute("BEGIN IMMEDIATE")
+            if not (self.arquivo and _invoice_arquivada(g, invoice_id)):
+                g.execute(
+                    "INSERT OR IGNORE INTO pagamentos (invoice_id, user_id, valor_reais, cash, criado_em) VALUES (?,?,?,?,?)",
+                    (invoice_id, uid, reais, cash, agora)
+                )
+            row = g.execute("SELECT por FROM indicacoes WHERE quem=?", (uid,)).fetchone()
+
+        ref_id, bonus = None, 0
+        if row:
+            ref_id = int(row["por"])
+            bonus = int(round(cash * ref_pct / 100.0))
+            if bonus > 0 and not self._creditar(ref_id, f"ref:{invoice_id}", bonus, agora):
+                bonus = 0
+        if not novo:
+            return None
+        return {"ref_id": ref_id, "bonus": bonus}
+
+    async def payers(self):
+        with (self.arquivo or self.shards.main)() as g:
+            return g.execute(_sql_pagantes(self.arquivo)).fetchone()["n"]
+
+    async def credited(self, invoice_id):
+        with self.shards.main() as g:
+            return _invoice_creditada(g, invoice_id)
+
+    async def record_invoice(self, invoice_id, uid, reais, url):
+        with self.shards.main() as g:
+            _registrar_invoice(g, invoice_id, uid, reais, url)
+
+    async def open_invoices(self, since, limit):
+        with self.shards.main() as g:
+            return _invoices_abertas(g, since, limit)
+
+    async def close_invoices(self, invoice_ids, status):
+        with self.shards.main() as g:
+            _fechar_invoices(g, invoice_ids, status)
+
+    async def prune_invoices(self, before):
+        with self.shards.main() as g:
+            return _podar_invoices(g, before)
+
+
+class ShardedWithdrawals(_ShardedRepo, WithdrawalsRepo):
+    def _local(self, wid: int) -> tuple[SqliteWithdrawals, int]:
+        return self.repos[wid % self.shards.n], wid // self.shards.n
+
+    def _reserved_all(self, snapshot_at: str) -> float:
+        total = 0.0
+        for conn in self.shards.conns:
+            with conn() as c:
+                total += SqliteWithdrawals._reserved(c, snapshot_at)
+        return total
+
+    async def stuck(self, uid, max_age_minutes, limit, after_id=0):
+        n = self.shards.n
+        ks = [self.shards.of(uid)] if uid is not None else range(n)
+        rows = []
+        for k in ks:
+            # id global = local * n + k; local > (after_id - k) / n
+            for r in await self.repos[k].stuck(uid, max_age_minutes, limit, (after_id - k) // n):
+                r["id"] = r["id"] * n + k
+                rows.append(r)
+        rows.sort(key=lambda r: r["id"])
+        return rows[:limit]
+
+    async def settle(self, done, failed):
+        # uma transação por shard (cada arquivo tem o seu lock de escrita)
+        por_shard = defaultdict(lambda: ([], []))
+        for lista, ids in ((0, done), (1, failed)):
+            for wid in ids:
+                por_shard[wid % self.shards.n][lista].append(wid // self.shards.n)
+        out = {"done": 0, "estornos": []}
+        for k, (d, f) in sorted(por_shard.items()):
+            r = await self.repos[k].settle(d, f)
+            out["done"] += r["done"]
+            out["estornos"] += [(wid * self.shards.n + k, uid, ton) for wid, uid, ton in r["estornos"]]
+        return out
+
+    async def reserved(self, snapshot_at):
+        return self._reserved_all(snapshot_at)
+
+    async def reserve(self, uid, amount_ton, wallet, idemp, avail, snapshot_at):
+        k = self.shards.of(uid)
+        with self.shards.main() as g:
+            g.execute("BEGIN IMMEDIATE")  # uma reserva por vez, em todos os shards e processos
+            if avail is not None and avail - self._reserved_all(snapshot_at) + 1e-9 < amount_ton:
+                return None, "cofre"
+            wid, motivo = await self.repos[k].reserve(uid, amount_ton, wallet, idemp, None, snapshot_at)
+        return (wid * self.shards.n + k if wid else None), motivo
+
+    async def set_status(self, wid, status):
+        repo, local = self._local(wid)
+        return await repo.set_status(local, status)
+
+    async def refund(self, wid, uid, amount_ton):
+        repo, local = self._local(wid)
+        return await repo.refund(local, uid, amount_ton)
+
+
+class ShardedTokens(_ShardedRepo, TokensRepo):
+    new = _por_usuario("new")
+
+    async def use(self, token, uid, action):
+        return await self._repo(uid).use(token, uid, action)
+
+
+class ShardedSqliteStorage(Storage):
+    backend = "sqlite-shards"
+
+    def __init__(self, connect, main_path: str, paths: list[str], arquivo=None):
+        self.shards = sh = _Shards(connect, main_path, paths)
+        self.users = ShardedUsers(sh, [SqliteUsers(c) for c in sh.conns], arquivo)
+        self.inventory = ShardedInventory(sh, [SqliteInventory(c) for c in sh.conns])
+        self.payments = ShardedPayments(sh, arquivo)
+        self.withdrawals = ShardedWithdrawals(sh, [SqliteWithdrawals(c) for c in sh.conns])
+        self.tokens = ShardedTokens(sh, [SqliteTokens(c) for c in sh.conns])
+        self.referrals = SqliteReferrals(sh.main)
+
+    def create_schema(self, animais):
+        """Cria as tabelas em cada shard (idempotente) e sincroniza o catálogo de animais."""
+        for k, conn in enumerate(self.shards.conns):
+            with conn() as c:
+                auto_vacuum_incremental(c)
+                c.execute("BEGIN IMMEDIATE")
+                n = c.execute("PRAGMA user_version").fetchone()[0]
+                if n and n != self.shards.n:
+                    raise RuntimeError(f"shard {k} foi criado com {n} shards, não {self.shards.n}")
+                for ddl in SHARD_SCHEMA:
+                    c.execute(ddl)
+                c.executemany(
+                    """
+                    INSERT INTO animais (nome, preco, rendimento, emoji) VALUES (?,?,?,?)
+                    ON CONFLICT(nome) DO UPDATE SET
+                        preco=excluded.preco, rendimento=excluded.rendimento, emoji=excluded.emoji
+                    """,
+                    animais
+                )
+                c.execute(f"PRAGMA user_version = {self.shards.n}")
+
+
+# ===== Postgres (asyncpg) =====
+PG_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS usuarios (
+        telegram_id BIGINT PRIMARY KEY,
+        saldo_cash DOUBLE PRECISION DEFAULT 0,
+        saldo_cash_pagamentos DOUBLE PRECISION DEFAULT 0,
+        saldo_ton DOUBLE PRECISION DEFAULT 0,
+        saldo_materiais DOUBLE PRECISION DEFAULT 0,
+        carteira_ton TEXT,
+        criado_em TEXT,
+        ultimo_bonus TEXT,
+        bloqueado_em TEXT,
+        lembrete_em TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS animais (
+        nome TEXT PRIMARY KEY,
+        preco INTEGER,
+        rendimento DOUBLE PRECISION,
+        emoji TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS inventario (
+        telegram_id BIGINT,
+        animal TEXT,
+        quantidade INTEGER DEFAULT 0,
+        ultima_coleta TEXT,
+        PRIMARY KEY (telegram_id, animal)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS indicacoes (
+        quem BIGINT PRIMARY KEY,
+        por  BIGINT,
+        criado_em TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS pagamentos (
+        invoice_id TEXT PRIMARY KEY,
+        user_id BIGINT,
+        valor_reais DOUBLE PRECISION,
+        cash INTEGER,
+        criado_em TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS withdrawals (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        requested_ton DOUBLE PRECISION NOT NULL,
+        wallet TEXT NOT NULL,
+        status TEXT NOT NULL CHECK(status IN ('pending','processing','done','failed')) DEFAULT 'pending',
+        idempotency_key TEXT UNIQUE NOT NULL,
+        created_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc'),
+        updated_at TIMESTAMP DEFAULT (now() AT TIME ZONE 'utc')
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS cb_tokens (
+        id TEXT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        action TEXT NOT NULL,
+        payload TEXT,
+        expires_at BIGINT NOT NULL,
+        used INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_indicacoes_por ON indicacoes(por)",
+    """
+    CREATE TABLE IF NOT EXISTS invoices (
+        invoice_id TEXT PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        valor_reais DOUBLE PRECISION NOT NULL,
+        url TEXT,
+        status TEXT NOT NULL DEFAULT 'active',
+        criado_em TEXT NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_pag_user ON pagamentos(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_invoices_abertas ON invoices(status, criado_em)",
+    "CREATE INDEX IF NOT EXISTS idx_wd_user ON withdrawals(user_id)",
+    "CREATE INDEX IF NOT EXISTS idx_wd_status ON withdrawals(status, updated_at)",
+]
+
+# chave do pg_advisory_xact_lock que serializa as reservas de saque (o papel
+# do BEGIN IMMEDIATE no SQLite: a checagem do cofre soma withdrawals de todos)
+_PG_LOCK_SAQUES = 0x5AC0E5
+
+_PG_UTC_NOW = "(now() AT TIME ZONE 'utc')"
+
+
+def _pg_rowcount(status: str) -> int:
+    # asyncpg devolve o status do comando, ex.: "UPDATE 1", "INSERT 0 1"
+    try:
+        return int(status.rsplit(" ", 1)[-1])
+    except (ValueError, AttributeError):
+        return 0
+
+
+class _PgRepo:
+    def __init__(self, pool):
+        self.pool = pool
+
+
+class PgUsers(_PgRepo, UsersRepo):
+    async def ensure(self, uid):
+        st = await self.pool.execute(
+            "INSERT INTO usuarios (telegram_id, criado_em) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+            uid, _iso_now()
+        )
+        return _pg_rowcount(st) == 1
+
+    async def touch(self, uid):
+        async with self.pool.acquire() as con:
+            st = await con.execute(
+                "INSERT INTO usuarios (telegram_id, criado_em) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                uid, _iso_now()
+            )
+            await con.execute(
+                "UPDATE usuarios SET bloqueado_em=NULL WHERE telegram_id=$1 AND bloqueado_em IS NOT NULL",
+                uid
+            )
+        return _pg_rowcount(st) == 1
+
+    async def balances(self, uid):
+        r = await self.pool.fetchrow("""
+            SELECT COALESCE(saldo_cash,0)            AS cash,
+                   COALESCE(saldo_cash_pagamentos,0) AS pag,
+                   COALESCE(saldo_ton,0)             AS ton,
+                   COALESCE(saldo_materiais,0)       AS mats
+              FROM usuarios WHERE telegram_id=$1
+        """, uid)
+        return dict(r) if r else None
+
+    async def materials(self, uid):
+        m = await self.pool.fetchval("SELECT COALESCE(saldo_materiais,0) FROM usuarios WHERE telegram_id=$1", uid)
+        return float(m or 0.0)
+
+    async def wallet(self, uid):
+        return await self.pool.fetchval("SELECT carteira_ton FROM usuarios WHERE telegram_id=$1", uid) or None
+
+    async def set_wallet(self, uid, wallet):
+        await self.pool.execute(
+            """
+            INSERT INTO usuarios (telegram_id, criado_em, carteira_ton) VALUES ($1, $2, $3)
+            ON CONFLICT (telegram_id) DO UPDATE SET carteira_ton = excluded.carteira_ton
+            """,
+            uid, _iso_now(), wallet
+        )
+
+    async def last_claim(self, uid, campo):
+        col = CAMPOS_COOLDOWN[campo]
+        return await self.pool.fetchval(f"SELECT {col} FROM usuarios WHERE telegram_id=$1", uid)
+
+    async def claim_reward(self, uid, campo, saldo, valor, agora, desde):
+        col, scol = CAMPOS_COOLDOWN[campo], CAMPOS_SALDO[saldo]
+        # ISO em TEXT: compara byte a byte, como o SQLite (sem collation do locale)
+        s = await self.pool.fetchval(
+            f"UPDATE usuarios SET {scol} = COALESCE({scol},0) + $1, {col} = $2 "
+            f'WHERE telegram_id=$3 AND ({col} IS NULL OR {col} <= $4 COLLATE "C") RETURNING {scol}',
+            valor, agora, uid, desde
+        )
+        if s is not None:
+            return float(s), None
+        return None, await self.last_claim(uid, campo)
+
+    async def sell_materials(self, uid, usado, to_pag, to_cash):
+        m = await self.pool.fetchval("""
+            UPDATE usuarios
+               SET saldo_materiais = saldo_materiais - $1,
+                   saldo_cash_pagamentos = COALESCE(saldo_cash_pagamentos,0) + $2,
+                   saldo_cash = COALESCE(saldo_cash,0) + $3
+             WHERE telegram_id = $4 AND saldo_materiais >= $1
+         RETURNING saldo_materiais
+        """, usado, to_pag, to_cash, uid)
+        return float(m) if m is not None else None
+
+    async def swap_pag_to_ton(self, uid, amount, ton_out):
+        s = await self.pool.fetchval(
+            "UPDATE usuarios SET saldo_cash_pagamentos=saldo_cash_pagamentos-$1, saldo_ton=COALESCE(saldo_ton,0)+$2 "
+            "WHERE telegram_id=$3 AND saldo_cash_pagamentos >= $1 RETURNING saldo_ton",
+            float(amount), ton_out, uid
+        )
+        return float(s) if s is not None else None
+
+    async def credit_ton(self, uid, amount):
+        await self.pool.execute(
+            "UPDATE usuarios SET saldo_ton = COALESCE(saldo_ton,0) + $1 WHERE telegram_id=$2", amount, uid
+        )
+
+    async def add_balance(self, uid, campo, valor):
+        col = CAMPOS_SALDO[campo]
+        await self.pool.execute(f"UPDATE usuarios SET {col}=COALESCE({col},0)+$1 WHERE telegram_id=$2", float(valor), uid)
+
+    async def set_balance(self, uid, campo, valor):
+        col = CAMPOS_SALDO[campo]
+        await self.pool.execute(f"UPDATE usuarios SET {col}=$1 WHERE telegram_id=$2", float(valor), uid)
+
+    async def reset_balances(self, uid):
+        await self.pool.execute("""
+            UPDATE usuarios SET
+                saldo_cash=0,
+                saldo_cash_pagamentos=0,
+                saldo_ton=0,
+                saldo_materiais=0
+            WHERE telegram_id=$1
+        """, uid)
+
+    async def purge(self, uid, hard):
+        async with self.pool.acquire() as con, con.transaction():
+            await con.execute("""
+                UPDATE usuarios SET
+                    saldo_cash=0,
+                    saldo_cash_pagamentos=0,
+                    saldo_ton=0,
+                    saldo_materiais=0
+                WHERE telegram_id=$1
+            """, uid)
+            await con.execute("DELETE FROM inventario WHERE telegram_id=$1", uid)
+            if hard:
+                await con.execute("DELETE FROM withdrawals WHERE user_id=$1", uid)
+                await con.execute("DELETE FROM pagamentos WHERE user_id=$1", uid)
+                await con.execute("DELETE FROM invoices WHERE user_id=$1", uid)
+                await con.execute("DELETE FROM indicacoes WHERE quem=$1 OR por=$1", uid)
+                await con.execute("DELETE FROM usuarios WHERE telegram_id=$1", uid)
+
+    async def count(self, since=None):
+        if since is None:
+            return await self.pool.fetchval("SELECT COUNT(*) FROM usuarios")
+        return await self.pool.fetchval("SELECT COUNT(*) FROM usuarios WHERE criado_em >= $1", since)
+
+    async def recipients(self, after_uid, limit):
+        rows = await self.pool.fetch(
+            "SELECT telegram_id FROM usuarios WHERE telegram_id > $1 AND bloqueado_em IS NULL "
+            "ORDER BY telegram_id LIMIT $2",
+            after_uid, limit
+        )
+        return [r["telegram_id"] for r in rows]
+
+    async def count_recipients(self):
+        return await self.pool.fetchval("SELECT COUNT(*) FROM usuarios WHERE bloqueado_em IS NULL")
+
+    async def mark_blocked(self, uids, agora):
+        if uids:
+            await self.pool.execute(
+                "UPDATE usuarios SET bloqueado_em=$1 WHERE telegram_id = ANY($2::bigint[])",
+                agora, list(uids)
+            )
+
+
+# produção por item até `agora`: rendimento é por dia, como no julianday do SQLite
+_PG_PROD_ITEM = (
+    "COALESCE(a.rendimento * i.quantidade * GREATEST(0, "
+    "EXTRACT(EPOCH FROM ($1::text::timestamp - NULLIF(TRIM(i.ultima_coleta), '')::timestamp)) / 86400.0), 0)"
+)
+
+
+class PgInventory(_PgRepo, InventoryRepo):
+    async def daily_yield(self, uid):
+        s = await self.pool.fetchval("""
+            SELECT SUM(quantidade * rendimento)
+            FROM inventario JOIN animais ON inventario.animal = animais.nome
+            WHERE inventario.telegram_id=$1
+        """, uid)
+        return s or 0
+
+    async def production(self, uid):
+        rows = await self.pool.fetch("""
+            SELECT i.animal, i.quantidade, i.ultima_coleta, a.rendimento, a.emoji
+            FROM inventario i
+            JOIN animais a ON a.nome = i.animal
+            WHERE i.telegram_id = $1
+            ORDER BY a.preco ASC
+        """, uid)
+        return [dict(r) for r in rows]
+
+    async def fill_missing_collect(self, uid, agora):
+        await self.pool.execute("""
+            UPDATE inventario
+               SET ultima_coleta = $1
+             WHERE telegram_id = $2 AND (ultima_coleta IS NULL OR TRIM(ultima_coleta) = '')
+        """, agora, uid)
+
+    async def buy(self, uid, animal, preco, agora):
+        async with self.pool.acquire() as con, con.transaction():
+            st = await con.execute(
+                "UPDATE usuarios SET saldo_cash=saldo_cash-$1 WHERE telegram_id=$2 AND saldo_cash >= $1",
+                float(preco), uid
+            )
+            if _pg_rowcount(st) != 1:
+                return False
+            await con.execute(
+                """
+                INSERT INTO inventario (telegram_id, animal, quantidade, ultima_coleta) VALUES ($1, $2, 1, $3)
+                ON CONFLICT (telegram_id, animal) DO UPDATE
+                   SET quantidade = inventario.quantidade + 1, ultima_coleta = excluded.ultima_coleta
+                """,
+                uid, animal, agora
+            )
+        return True
+
+    async def collect(self, uid, agora):
+        async with self.pool.acquire() as con, con.transaction():
+            # FOR UPDATE nas linhas do inventário: duas coletas simultâneas não contam o mesmo período
+            rows = await con.fetch(
+                f"""
+                SELECT {_PG_PROD_ITEM} AS prod
+                  FROM inventario i
+                  JOIN animais a ON a.nome = i.animal
+                 WHERE i.telegram_id = $2
+                   FOR UPDATE OF i
+                """,
+                agora, uid
+            )
+            total = round(sum(r["prod"] for r in rows), 6)
+            if total <= 0.01:
+                novo = await con.fetchval("SELECT COALESCE(saldo_materiais,0) FROM usuarios WHERE telegram_id=$1", uid)
+                return 0, 0.0, float(novo or 0.0)
+            novo = await con.fetchval(
+                "UPDATE usuarios SET saldo_materiais = COALESCE(saldo_materiais,0) + $1 "
+                "WHERE telegram_id=$2 RETURNING saldo_materiais",
+                total, uid
+            )
+            await con.execute("UPDATE inventario SET ultima_coleta=$1 WHERE telegram_id=$2", agora, uid)
+        return 1, total, float(novo or 0.0)
+
+
+class PgPayments(_PgRepo, PaymentsRepo):
+    async def credit_invoice(self, invoice_id, uid, reais, cash, ref_pct):
+        agora = _iso_now()
+        async with self.pool.acquire() as con, con.transaction():
+            st = await con.execute(
+                "INSERT INTO pagamentos (invoice_id, user_id, valor_reais, cash, criado_em) VALUES ($1,$2,$3,$4,$5) "
+                "ON CONFLICT (invoice_id) DO NOTHING",
+                invoice_id, uid, reais, cash, agora
+            )
+            if _pg_rowcount(st) != 1:
+                return None
+
+            await con.execute(
+                """
+                INSERT INTO usuarios (telegram_id, criado_em, saldo_cash) VALUES ($1, $2, $3)
+                ON CONFLICT (telegram_id) DO UPDATE SET saldo_cash = COALESCE(usuarios.saldo_cash,0) + excluded.saldo_cash
+                """,
+                uid, agora, float(max(cash, 0))
+            )
+
+            ref_id, bonus = None, 0
+            por = await con.fetchval("SELECT por FROM indicacoes WHERE quem=$1", uid)
+            if por is not None:
+                ref_id = int(por)
+                bonus = int(round(cash * ref_pct / 100.0))
+                if bonus > 0:
+                    await con.execute(
+                        """
+                        INSERT INTO usuarios (telegram_id, criado_em, saldo_cash) VALUES ($1, $2, $3)
+                        ON CONFLICT (telegram_id) DO UPDATE SET saldo_cash = COALESCE(usuarios.saldo_cash,0) + excluded.saldo_cash
+                        """,
+                        ref_id, agora, float(bonus)
+                    )
+        return {"ref_id": ref_id, "bonus": bonus}
+
+    async def payers(self):
+        return await self.pool.fetchval("SELECT COUNT(DISTINCT user_id) FROM pagamentos")
+
+    async def credited(self, invoice_id):
+        return await self.pool.fetchval("SELECT 1 FROM pagamentos WHERE invoice_id=$1", invoice_id) is not None
+
+    async def record_invoice(self, invoice_id, uid, reais, url):
+        await self.pool.execute(
+            "INSERT INTO invoices (invoice_id, user_id, valor_reais, url, status, criado_em) "
+            "VALUES ($1,$2,$3,$4,'active',$5) ON CONFLICT (invoice_id) DO NOTHING",
+            invoice_id, uid, reais, url, _iso_now()
+        )
+
+    async def open_invoices(self, since, limit):
+        rows = await self.pool.fetch(
+            """
+            SELECT i.invoice_id
+              FROM invoices i
+             WHERE i.status = 'active' AND i.criado_em >= $1
+               AND NOT EXISTS (SELECT 1 FROM pagamentos p WHERE p.invoice_id = i.invoice_id)
+             ORDER BY i.criado_em
+             LIMIT $2
+            """,
+            since, limit
+        )
+        return [r["invoice_id"] for r in rows]
+
+    async def close_invoices(self, invoice_ids, status):
+        await self.pool.execute(
+            "UPDATE invoices SET status=$1 WHERE invoice_id = ANY($2::text[]) AND status='active'",
+            status, list(invoice_ids)
+        )
+
+    async def prune_invoices(self, before):
+        st = await self.pool.execute("DELETE FROM invoices WHERE criado_em < $1", before)
+        return _pg_rowcount(st)
+
+
+class PgWithdrawals(_PgRepo, WithdrawalsRepo):
+    async def stuck(self, uid, max_age_minutes, limit, after_id=0):
+        sql = f"""
+            SELECT id, user_id, requested_ton, idempotency_key,
+                   to_char(created_at, 'YYYY-MM-DD HH24:MI:SS') AS created_at
+              FROM withdrawals
+             WHERE status IN ('pending','processing')
+               AND created_at <= {_PG_UTC_NOW} - make_interval(mins => $1)
+               AND id > $2
+        """
+        args = [max_age_minutes, after_id]
+        if uid is not None:
+            sql += " AND user_id = $4"
+            args.append(uid)
+        sql += " ORDER BY id LIMIT $3"
+        args.insert(2, limit)
+        return [dict(r) for r in await self.pool.fetch(sql, *args)]
+
+    async def settle(self, done, failed):
+        async with self.pool.acquire() as con, con.transaction():
+            n = _pg_rowcount(await con.execute(
+                f"UPDATE withdrawals SET status='done', updated_at={_PG_UTC_NOW} "
+                "WHERE id = ANY($1::bigint[]) AND status IN ('pending','processing')", list(done)
+            ))
+            rows = await con.fetch(
+                f"UPDATE withdrawals SET status='failed', updated_at={_PG_UTC_NOW} "
+                "WHERE id = ANY($1::bigint[]) AND status IN ('pending','processing') "
+                "RETURNING id, user_id, requested_ton", list(failed)
+            )
+            if rows:
+                await con.executemany(
+                    "UPDATE usuarios SET saldo_ton = COALESCE(saldo_ton,0) + $1 WHERE telegram_id=$2",
+                    [(r["requested_ton"], r["user_id"]) for r in rows]
+                )
+        return {"done": n, "estornos": [(r["id"], r["user_id"], float(r["requested_ton"])) for r in rows]}
+
+    @staticmethod
+    async def _reserved(con, snapshot_at):
+        s = await con.fetchval(
+            """
+            SELECT COALESCE(SUM(requested_ton), 0)
+              FROM withdrawals
+             WHERE status IN ('pending','processing')
+                OR (status = 'done' AND updated_at >= $1::text::timestamp)
+            """,
+            snapshot_at or "1970-01-01 00:00:00"
+        )
+        return float(s or 0.0)
+
+    async def reserved(self, snapshot_at):
+        return await self._reserved(self.pool, snapshot_at)
+
+    async def reserve(self, uid, amount_ton, wallet, idemp, avail, snapshot_at):
+        async with self.pool.acquire() as con, con.transaction():
+            await con.execute("SELECT pg_advisory_xact_lock($1)", _PG_LOCK_SAQUES)
+            if avail is not None and avail - await self._reserved(con, snapshot_at) + 1e-9 < amount_ton:
+                return None, "cofre"
+
+            n = await con.fetchval(
+                f"""
+                SELECT COUNT(*)
+                  FROM withdrawals
+                 WHERE user_id = $1
+                   AND status = 'processing'
+                   AND created_at > {_PG_UTC_NOW} - interval '15 minutes'
+                """,
+                uid
+            )
+            if n > 0:
+                return None, "lock"
+
+            st = await con.execute(
+                "UPDATE usuarios SET saldo_ton = saldo_ton - $1 WHERE telegram_id=$2 AND saldo_ton >= $1",
+                amount_ton, uid
+            )
+            if _pg_rowcount(st) != 1:
+                return None, "saldo"
+
+            wid = await con.fetchval(
+                """INSERT INTO withdrawals (user_id, requested_ton, wallet, status, idempotency_key)
+                   VALUES ($1,$2,$3,'processing',$4) RETURNING id""",
+                uid, amount_ton, wallet, idemp
+            )
+            return wid, "ok"
+
+    async def set_status(self, wid, status):
+        return _pg_rowcount(await self.pool.execute(
+            f"UPDATE withdrawals SET status=$1, updated_at={_PG_UTC_NOW} "
+            "WHERE id=$2 AND status IN ('pending','processing')", status, wid
+        )) == 1
+
+    async def refund(self, wid, uid, amount_ton):
+        async with self.pool.acquire() as con, con.transaction():
+            if _pg_rowcount(await con.execute(
+                f"UPDATE withdrawals SET status='failed', updated_at={_PG_UTC_NOW} "
+                "WHERE id=$1 AND status IN ('pending','processing')", wid
+            )) != 1:
+                return False
+            await con.execute("UPDATE usuarios SET saldo_ton = saldo_ton + $1 WHERE telegram_id=$2", amount_ton, uid)
+        return True
+
+
+class PgTokens(_PgRepo, TokensRepo):
+    async def new(self, uid, action, payload="", ttl=600):
+        token = uuid.uuid4().hex[:8]
+        await self.pool.execute(
+            """
+            INSERT INTO cb_tokens (id, user_id, action, payload, expires_at, used, created_at)
+            VALUES ($1, $2, $3, $4, $5, 0, $6)
+            ON CONFLICT (id) DO UPDATE SET
+                user_id=excluded.user_id, action=excluded.action, payload=excluded.payload,
+                expires_at=excluded.expires_at, used=0, created_at=excluded.created_at
+            """,
+            token, uid, action, payload, int(time.time()) + ttl, _iso_now()
+        )
+        return token
+
+    async def use(self, token, uid, action):
+        # um único UPDATE condicional: dois cliques simultâneos não consomem o mesmo token
+        r = await self.pool.fetchrow(
+            """
+            UPDATE cb_tokens SET used=1
+             WHERE id=$1 AND user_id=$2 AND action=$3 AND used=0 AND expires_at >= $4
+         RETURNING payload
+            """,
+            token, uid, action, int(time.time())
+        )
+        if r is not None:
+            return True, (r["payload"] if r["payload"] is not None else ""), ""
+        row = await self.pool.fetchrow(
+            "SELECT user_id, action, payload, expires_at, used FROM cb_tokens WHERE id=$1", token
+        )
+        return False, None, _token_motivo(row, uid, action) or "usado"
+
+
+class PgReferrals(_PgRepo, ReferralsRepo):
+    async def register(self, quem, por):
+        st = await self.pool.execute(
+            "INSERT INTO indicacoes (quem, por, criado_em) VALUES ($1, $2, $3) ON CONFLICT DO NOTHING",
+            quem, por, _iso_now()
+        )
+        return _pg_rowcount(st) == 1
+
+    async def count(self, por):
+        return await self.pool.fetchval("SELECT COUNT(*) FROM indicacoes WHERE por=$1", por)
+
+
+class PostgresStorage(Storage):
+    backend = "postgres"
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.users = PgUsers(pool)
+        self.inventory = PgInventory(pool)
+        self.payments = PgPayments(pool)
+        self.withdrawals = PgWithdrawals(pool)
+        self.tokens = PgTokens(pool)
+        self.referrals = PgReferrals(pool)
+
+    @classmethod
+    async def open(cls, dsn: str, min_size: int = 2, max_size: int = 20) -> "PostgresStorage":
+        try:
+            import asyncpg
+        except ImportError as e:
+            raise RuntimeError("STORAGE_BACKEND=postgres requer o pacote asyncpg (pip install asyncpg)") from e
+        if not dsn:
+            raise RuntimeError("STORAGE_BACKEND=postgres requer DATABASE_URL")
+        pool = await asyncpg.create_pool(dsn, min_size=min_size, max_size=max_size)
+        return cls(pool)
+
+    async def create_schema(self, animais):
+        """Cria as tabelas (idempotente) e sincroniza o catálogo de animais."""
+        async with self.pool.acquire() as con, con.transaction():
+            for ddl in PG_SCHEMA:
+                await con.execute(ddl)
+            await con.executemany(
+                """
+                INSERT INTO animais (nome, preco, rendimento, emoji) VALUES ($1, $2, $3, $4)
+                ON CONFLICT (nome) DO UPDATE SET
+                    preco=excluded.preco, rendimento=excluded.rendimento, emoji=excluded.emoji
+                """,
+                [(nome, preco, float(rendimento), emoji) for nome, preco, rendimento, emoji in animais]
+            )
+
+    async def close(self):
+        await self.pool.close()